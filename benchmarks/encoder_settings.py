@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# Benchmark of the encoder settings of transcode-h264-v3.py on your own recordings.
+#
+# Every short sample recording of a directory is encoded with every combination of the
+# encoder backends, presets, constant rate factors, thread counts and de-interlacing
+# filters given (presets and crfs in x264 terms, mapped onto each backend), using
+# the same encode_args() command builder as the transcode (video only, the audio is
+# encoded separately by the script). --two-pass-bitrates adds two-pass encodes at target
+# bitrates to compare with the CRF encodes, for the backends that run two-pass encodes.
+# For every encode it measures
+#   fps       frames encoded per wall clock sec (of both passes)
+#   cpu       cpu secs spent by the encoder (user + system) per sec of video
+#   size      output size relative to the input file, the compressionRatio achieved
+#   ssim      structural similarity of the output to the de-interlaced input (1.0 = identical)
+#   miss      difference of the bitrate of a two-pass encode from its target
+# The samples are grouped into HD (720 lines and more) and SD. For every class the settings
+# that no other settings beat in cpu, size and ssim at once (the Pareto front) are listed,
+# and of those the smallest output that reaches --min-ssim and encodes at least --min-speed
+# times realtime is recommended, e.g.
+#
+#   benchmarks/encoder_settings.py /var/lib/mythtv/samples --presets=veryfast,fast,medium,slow \
+#       --crfs=19,21,23 --deinterlacers=yadif=0:-1:1,bwdif=0:-1:1
+#
+#   benchmarks/encoder_settings.py /var/lib/mythtv/samples --encoders=libx264,libx265,libsvtav1 \
+#       --presets=fast,medium --crfs=21
+#
+# The samples should be a few minutes of typical recordings of each resolution, cut with
+# e.g. ffmpeg -ss 600 -t 120 -i recording.ts -c copy sample.ts
+
+from optparse import OptionParser
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchdir)
+from orchestration import load_script
+
+# settings of the script that restrict the encode to the video of the sample
+settings = {'renditions':[], 'preview_offsets':[], 'storyboard_tiles':'', 'cache_policy_cmd':'',
+            'ffmpeg_stats_period':0, 'debug':False}
+
+def resolution_class(probe=''):
+    # 'HD' or 'SD' by the height of the first video stream, None without video
+    m = re.search('Stream #0:[0-9]+.*?: Video: .*?, ([0-9]{2,})x([0-9]{2,})', probe)
+    if m is None:
+        return None
+    return 'HD' if int(m.group(2)) >= 720 else 'SD'
+
+def measure_ssim(script=None, outfile=None, sample=None, deinterlacer=''):
+    # mean ssim of outfile against sample de-interlaced by the same filter, so the
+    # value measures the loss of the encode, None if ffmpeg did not report it
+    cmd = [script.transcoder, '-nostdin', '-i', outfile, '-i', sample,
+           '-lavfi', '[1:v:0]%s[ref];[0:v:0][ref]ssim' % deinterlacer, '-f', 'null', '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    output = script.OutputBuffer()
+    output.read(proc.stderr)
+    proc.wait()
+    m = re.search('SSIM .*All:([0-9.]+)', output.text())
+    return float(m.group(1)) if m else None
+
+def run_timed(script=None, args=[]):
+    # run an encoder command, returns its exit code, wall and cpu secs and its output
+    output = script.OutputBuffer()
+    began = time.time()
+    proc = script.start_process(' '.join(args), output)
+    # the rusage of the shell includes the encoder it waited for
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - began
+    output.wait()
+    return proc.returncode, wall, rusage.ru_utime + rusage.ru_stime, output
+
+def encode_cell(script=None, sample=None, duration_secs=0, cell={}, workdir=None, ssim=True):
+    # encode sample with the settings of cell and return its measurements
+    script.encode_threads = cell['threads']
+    script.deinterlace_filter = cell['deinterlacer']
+    outfile = os.path.join(workdir, 'cell.mp4')
+    plan = {'audio':[], 'subtitle':[]}
+    vbitrate_param = script.video_rate_param(cell['crf'], cell['bitrate'], cell['encoder'])
+    wall, cpu = 0.0, 0.0
+    passlogfile = None
+    if cell['bitrate'] > 0:
+        passlogfile = os.path.join(workdir, 'cell.pass')
+        returncode, wall, cpu, output = run_timed(script, script.first_pass_args(cell['preset'], vbitrate_param,
+                                                                                 sample, passlogfile))
+        if returncode != 0:
+            print('First pass of "%s" with %s failed: %s' % (sample, cell, output.last_line()))
+            return None
+    returncode, secs, cpu_secs, output = run_timed(script, script.encode_args(cell['preset'], vbitrate_param, '',
+                                                                              sample, outfile, duration_secs,
+                                                                              plan, True, passlogfile, None,
+                                                                              cell['encoder']))
+    if returncode != 0 or not os.path.exists(outfile):
+        print('Encode of "%s" with %s failed: %s' % (sample, cell, output.last_line()))
+        return None
+    status = script.parse_status_line(output.status or '') or {}
+    result = {'wall_secs':wall + secs, 'cpu_secs':cpu + cpu_secs,
+              'frames':status.get('frame', 0), 'bytes':os.path.getsize(outfile),
+              'ssim':measure_ssim(script, outfile, sample, cell['deinterlacer']) if ssim else None}
+    if cell['bitrate'] > 0:
+        result['miss'] = result['bytes']*8/(1024*duration_secs)/cell['bitrate'] - 1
+    os.remove(outfile)
+    return result
+
+def summarize(cell={}, encodes=[]):
+    # the measurements of the encodes of all samples of a class with the settings of cell
+    video_secs = sum([e['duration_secs'] for e in encodes])
+    ssims = [e['ssim'] for e in encodes if e['ssim'] is not None]
+    return dict(cell, samples=len(encodes),
+                fps=sum([e['frames'] for e in encodes])/max(0.001, sum([e['wall_secs'] for e in encodes])),
+                speed=video_secs/max(0.001, sum([e['wall_secs'] for e in encodes])),
+                cpu=sum([e['cpu_secs'] for e in encodes])/max(0.001, video_secs),
+                size=sum([e['bytes'] for e in encodes])/float(max(1, sum([e['input_bytes'] for e in encodes]))),
+                ssim=sum(ssims)/len(ssims) if ssims else None,
+                miss=max([e['miss'] for e in encodes], key=abs) if cell['bitrate'] > 0 else None)
+
+def dominates(a={}, b={}):
+    # a is at least as good as b in cpu, size and ssim and better in one of them
+    ssim_a = a['ssim'] if a['ssim'] is not None else 0.0
+    ssim_b = b['ssim'] if b['ssim'] is not None else 0.0
+    return a['cpu'] <= b['cpu'] and a['size'] <= b['size'] and ssim_a >= ssim_b \
+           and (a['cpu'] < b['cpu'] or a['size'] < b['size'] or ssim_a > ssim_b)
+
+def pareto_front(cells=[]):
+    return [c for c in cells if not any([dominates(other, c) for other in cells])]
+
+def acceptable(cell={}, min_ssim=0.0, min_speed=0.0):
+    return (cell['ssim'] is None or cell['ssim'] >= min_ssim) and cell['speed'] >= min_speed
+
+def recommend(front=[], min_ssim=0.0, min_speed=0.0):
+    # the smallest output of the front reaching min_ssim at min_speed times realtime,
+    # the best ssim if no settings reach both
+    candidates = [c for c in front if acceptable(c, min_ssim, min_speed)]
+    if candidates:
+        return min(candidates, key=lambda c: (c['size'], c['cpu']))
+    if front:
+        return max(front, key=lambda c: (c['ssim'] or 0.0, -c['cpu']))
+    return None
+
+def cell_rate(cell={}):
+    if cell['bitrate'] > 0:
+        return '%dk 2pass' % cell['bitrate']
+    return 'crf %d' % cell['crf']
+
+def cell_name(cell={}):
+    return '%s %s %s threads %d %s' % (cell['encoder'], cell['preset'], cell_rate(cell), cell['threads'],
+                                       cell['deinterlacer'])
+
+def print_class(name='', cells=[], front=[], best=None, min_ssim=0.0, min_speed=0.0):
+    print('%s: %d settings, %d on the Pareto front' % (name, len(cells), len(front)))
+    print('  %-9s %-8s %-11s %7s %-16s %7s %6s %7s %6s %7s %6s' % ('encoder', 'preset', 'rate', 'threads',
+                                                                    'deinterlacer', 'fps', 'speed', 'cpu/s',
+                                                                    'size', 'ssim', 'miss'))
+    for c in sorted(cells, key=lambda c: (c['cpu'], c['size'])):
+        print('%s %-9s %-8s %-11s %7d %-16s %7.1f %5.1fx %7.2f %5.1f%% %7s %6s' \
+              % ('*' if c is best else '+' if c in front else ' ', c['encoder'], c['preset'], cell_rate(c),
+                 c['threads'],
+                 c['deinterlacer'], c['fps'], c['speed'], c['cpu'], 100*c['size'],
+                 '%.4f' % c['ssim'] if c['ssim'] is not None else '-',
+                 '%+.1f%%' % (100*c['miss']) if c['miss'] is not None else ''))
+    if best is not None and not acceptable(best, min_ssim, min_speed):
+        print('  no settings reach ssim %.3f at %.1fx realtime, showing the best ssim' % (min_ssim, min_speed))
+    if best is not None:
+        print('  recommended: %s (compressionRatio %.2f)' % (cell_name(best), best['size']))
+        print("  preset_%s = '%s'" % ('HD' if name == 'HD' else 'nonHD', best['preset']))
+        print("  encoder_%s = '%s'" % ('HD' if name == 'HD' else 'nonHD', best['encoder']))
+        if best['bitrate'] > 0:
+            print('  two_pass = True\n  hdvideo_tgt_bitrate = %d' % best['bitrate'])
+        else:
+            print("  crf = '%s'" % best['crf'])
+        print("  encode_threads = %d\n  deinterlace_filter = '%s'" % (best['threads'], best['deinterlacer']))
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options] SAMPLEDIR')
+    parser.add_option('--encoders', action='store', type='string', dest='encoders', default='libx264',
+            help='Comma separated encoder backends, e.g. libx264,libx265,libsvtav1')
+    parser.add_option('--presets', action='store', type='string', dest='presets',
+            default='veryfast,faster,fast,medium,slow', help='Comma separated x264 presets (speed tiers)')
+    parser.add_option('--crfs', action='store', type='string', dest='crfs', default='19,21,23',
+            help='Comma separated x264 constant rate factors (quality targets)')
+    parser.add_option('--two-pass-bitrates', action='store', type='string', dest='bitrates', default='',
+            help='Comma separated target bitrates (kbps) of two-pass encodes to compare with the CRF encodes')
+    parser.add_option('--threads', action='store', type='string', dest='threads', default='4',
+            help='Comma separated encoder thread counts, 0 = x264 default')
+    parser.add_option('--deinterlacers', action='store', type='string', dest='deinterlacers',
+            default='yadif=0:-1:1', help='Comma separated de-interlacing filters, e.g. yadif=0:-1:1,bwdif=0:-1:1')
+    parser.add_option('--no-ssim', action='store_false', dest='ssim', default=True,
+            help='Do not measure the ssim of the encodes')
+    parser.add_option('--min-ssim', action='store', type='float', dest='min_ssim', default=0.97,
+            help='Lowest ssim a recommended setting may have')
+    parser.add_option('--min-speed', action='store', type='float', dest='min_speed', default=1.0,
+            help='Lowest encode speed a recommended setting may have, as a multiple of realtime')
+    parser.add_option('--transcoder', action='store', type='string', dest='transcoder',
+            help='ffmpeg to benchmark instead of the transcoder setting of the script')
+    parser.add_option('--output', action='store', type='string', dest='output',
+            default='encoder-settings-results.json', help='Results file')
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a directory of sample recordings is required')
+
+    script = load_script()
+    for name, value in settings.items():
+        setattr(script, name, value)
+    if opts.transcoder:
+        script.transcoder = opts.transcoder
+    encoders = opts.encoders.split(',')
+    for encoder in encoders:
+        if encoder not in script.ENCODERS:
+            parser.error('unknown encoder "%s", use %s' % (encoder, ','.join(sorted(script.ENCODERS))))
+    # deinterlacers are split on commas between filters, not on the commas of a filter chain
+    rates = [(int(crf), 0) for crf in opts.crfs.split(',') if crf] \
+            + [(0, int(bitrate)) for bitrate in opts.bitrates.split(',') if bitrate]
+    cells = [{'encoder':encoder, 'preset':preset, 'crf':crf, 'bitrate':bitrate, 'threads':int(threads),
+              'deinterlacer':deinterlacer}
+             for encoder in encoders for preset in opts.presets.split(',') for crf, bitrate in rates
+             if bitrate == 0 or script.ENCODERS[encoder]['two_pass']
+             for threads in opts.threads.split(',')
+             for deinterlacer in re.split(',(?=[a-z_0-9]+=)', opts.deinterlacers)]
+
+    samples = []
+    for filename in sorted(os.listdir(args[0])):
+        if not filename.endswith(script.watch_extensions):
+            continue
+        sample = os.path.join(args[0], filename)
+        duration_secs, probe = script.get_duration(None, None, script.transcoder, sample)
+        rclass = resolution_class(probe)
+        if duration_secs <= 0 or rclass is None:
+            print('Skipping "%s", unable to read its duration or resolution.' % sample)
+            continue
+        samples.append({'filename':sample, 'class':rclass, 'duration_secs':duration_secs,
+                        'input_bytes':os.path.getsize(sample)})
+    if not samples:
+        print('No sample recordings (%s) found in "%s".' % (', '.join(script.watch_extensions), args[0]))
+        sys.exit(1)
+
+    # every encode of every sample, the cells are run in order so a slow preset cannot
+    # run concurrently with the one it is compared against
+    encodes = []
+    workdir = tempfile.mkdtemp(prefix='transcode-settings-')
+    try:
+        for n, cell in enumerate(cells):
+            print('[%d/%d] %s' % (n + 1, len(cells), cell_name(cell)))
+            for sample in samples:
+                result = encode_cell(script, sample['filename'], sample['duration_secs'], cell, workdir,
+                                     opts.ssim)
+                if result is not None:
+                    result.update({'cell':n, 'sample':sample['filename'], 'class':sample['class'],
+                                   'input_bytes':sample['input_bytes'], 'duration_secs':sample['duration_secs']})
+                    encodes.append(result)
+    finally:
+        for filename in os.listdir(workdir):
+            os.remove(os.path.join(workdir, filename))
+        os.rmdir(workdir)
+
+    classes = {}
+    for rclass in sorted(set([s['class'] for s in samples])):
+        summaries = []
+        for n, cell in enumerate(cells):
+            cell_encodes = [e for e in encodes if e['cell'] == n and e['class'] == rclass]
+            if cell_encodes:
+                summaries.append(summarize(cell, cell_encodes))
+        front = pareto_front(summaries)
+        best = recommend(front, opts.min_ssim, opts.min_speed)
+        print_class(rclass, summaries, front, best, opts.min_ssim, opts.min_speed)
+        classes[rclass] = {'cells':summaries, 'pareto':[summaries.index(c) for c in front],
+                           'recommended':summaries.index(best) if best is not None else None}
+
+    version = subprocess.run([script.transcoder, '-version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL).stdout.decode('utf-8', 'replace').split('\n')[0]
+    with open(opts.output, 'w') as f:
+        json.dump({'meta':{'date':datetime.datetime.now().isoformat(), 'host':platform.node(),
+                           'cpus':os.cpu_count(), 'transcoder':version, 'min_ssim':opts.min_ssim,
+                           'min_speed':opts.min_speed},
+                   'samples':samples, 'encodes':encodes, 'classes':classes}, f, indent=1)
+
+if __name__ == '__main__':
+    main()
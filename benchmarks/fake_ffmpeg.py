@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Stand-in for ffmpeg as run by transcode-h264-v3.py. It answers probes with the
+# stream information of an HD mpeg2 recording, and "encodes" by writing its outputs
+# while printing ffmpeg status lines at a controlled rate. Verification decodes
+# succeed at once, bitrate scans report 7 Mbps of video, stream health scans list
+# evenly timestamped packets and ssim measurements report a fixed value. The behaviour
+# is set by environment variables:
+#   FAKE_FFMPEG_DURATION  duration of every input in secs (default 120)
+#   FAKE_FFMPEG_SPEED     encode speed as a multiple of realtime (default 4)
+#   FAKE_FFMPEG_KBPS      bitrate of the encoded video (default 2000) unless a target
+#                         bitrate is given
+#   FAKE_FFMPEG_GAP       secs the video timestamps jump forward in the middle of the
+#                         recording as listed by a stream health scan (default 0)
+#   FAKE_FFMPEG_LOG       file the start, first status line and exit of every encode
+#                         are appended to as "<time> <event> <output file>"
+
+import os
+import sys
+import time
+
+duration = float(os.environ.get('FAKE_FFMPEG_DURATION', '120'))
+speed = float(os.environ.get('FAKE_FFMPEG_SPEED', '4'))
+kbps = int(os.environ.get('FAKE_FFMPEG_KBPS', '2000'))
+gap = float(os.environ.get('FAKE_FFMPEG_GAP', '0'))
+framerate = 29.97
+
+def log(event='', outfile=''):
+    logfile = os.environ.get('FAKE_FFMPEG_LOG')
+    if logfile:
+        with open(logfile, 'a') as f:
+            f.write('%.6f %s %s\n' % (time.time(), event, outfile))
+
+def probe(filename=''):
+    # ffmpeg -i without an output prints the input information and fails
+    secs = int(duration)
+    video = 'h264 (High)' if filename.endswith('.mp4') else 'mpeg2video (Main)'
+    sys.stderr.write("Input #0, mpegts, from '%s':\n"
+                     "  Duration: %02d:%02d:%02d.00, start: 1.400000, bitrate: 8000 kb/s\n"
+                     "    Stream #0:0[0x31]: Video: %s, yuv420p(tv, top first), 1280x720 "
+                     "[SAR 1:1 DAR 16:9], %.2f fps, %.2f tbr, 90k tbn\n"
+                     "    Stream #0:1[0x34](eng): Audio: ac3, 48000 Hz, 5.1(side), fltp, 384 kb/s\n"
+                     "At least one output file must be specified\n"
+                     % (filename, secs/3600, secs/60 % 60, secs % 60, video, framerate, framerate))
+    return 1
+
+def encode(outputs=[], stats_period=0.5, kbps=kbps):
+    # write the outputs while printing a status line every stats_period secs
+    log('start', outputs[0])
+    sys.stderr.write('Input #0, mpegts\n  Duration: 00:00:00.00\nOutput #0, mp4\n')
+    elapsed = 0.0
+    first = True
+    with open(outputs[0], 'wb') as f:
+        while elapsed < duration:
+            time.sleep(stats_period)
+            elapsed = min(duration, elapsed + stats_period*speed)
+            size = int(elapsed*kbps*1024/8)
+            f.truncate(size)
+            sys.stderr.write('frame=%6d fps=%.1f q=28.0 size=%8dkB time=%02d:%02d:%05.2f '
+                             'bitrate=%.1fkbits/s speed=%.1fx\r'
+                             % (elapsed*framerate, framerate*speed, size/1024, elapsed/3600,
+                                elapsed/60 % 60, elapsed % 60, kbps, speed))
+            sys.stderr.flush()
+            if first:
+                log('status', outputs[0])
+                first = False
+    for outfile in outputs[1:]:
+        with open(outfile, 'wb') as f:
+            f.write(b'\0'*1024)
+    sys.stderr.write('\nvideo:%dkB audio:0kB\n' % (size/1024))
+    log('exit', outputs[0])
+    return 0
+
+def packets():
+    # framecrc listing of the video and audio packets of a stream health scan
+    sys.stdout.write('#tb 0: 1/90000\n#tb 1: 1/90000\n')
+    start = 126000
+    for frame in range(int(duration*framerate)):
+        dts = start + int(frame*90000/framerate)
+        if frame > duration*framerate/2:
+            dts = dts + int(gap*90000)
+        sys.stdout.write('0, %10d, %10d, %8d, %8d, 0x00000000\n' % (dts, dts, 3003, 20000))
+        if frame % 2 == 0:
+            sys.stdout.write('1, %10d, %10d, %8d, %8d, 0x00000000\n' % (dts, dts, 2880, 1536))
+    return 0
+
+def main(args=[]):
+    inputs = [args[i + 1] for i, arg in enumerate(args) if arg == '-i']
+    if args == ['-version']:
+        sys.stdout.write('ffmpeg version fake\n')
+        return 0
+    if '-f' in args and args[args.index('-f') + 1] == 'framecrc':
+        return packets()
+    if '-f' in args and args[args.index('-f') + 1] == 'null':
+        # verification decode, the first pass of a two-pass encode, or the quality measurement
+        # of an encode
+        if '-pass' in args and args[args.index('-pass') + 1] == '1':
+            with open('%s-0.log' % args[args.index('-passlogfile') + 1], 'w') as f:
+                f.write('#options: fake\n')
+        elif '-lavfi' in args and 'ssim' in args[args.index('-lavfi') + 1]:
+            sys.stderr.write('[Parsed_ssim_1 @ 0x0] SSIM Y:0.981 U:0.990 V:0.989 All:0.984 (17.9)\n')
+        elif '-c' in args and args[args.index('-c') + 1] == 'copy':
+            # bitrate scan of a window of the mpeg2 recording, 7 Mbps video and 384 kbps audio
+            secs = float(args[args.index('-t') + 1]) if '-t' in args else duration
+            sys.stderr.write('Input file #0 (%s):\n'
+                             '  Input stream #0:0 (video): %d packets read (%d bytes);\n'
+                             '  Input stream #0:1 (audio): %d packets read (%d bytes);\n'
+                             % (inputs[0], secs*framerate, secs*7000*1024/8, secs*31, secs*384*1024/8))
+        return 0
+    # the outputs are the arguments that are neither options nor option values
+    outputs = []
+    for i, arg in enumerate(args):
+        if i > 0 and not arg.startswith('-') and not args[i - 1].startswith('-'):
+            outputs.append(arg)
+    if not outputs:
+        return probe(inputs[0])
+    if '-vn' in args or '-c' in args and args[args.index('-c') + 1] == 'copy':
+        # separate audio encode, the final mux or the repair remux of a recording
+        with open(outputs[0], 'wb') as f:
+            f.write(b'\0'*(os.path.getsize(inputs[0]) if len(inputs) > 1 or outputs[0].endswith('.ts')
+                            else 64*1024))
+        return 0
+    stats_period = 0.5
+    if '-stats_period' in args:
+        stats_period = float(args[args.index('-stats_period') + 1])
+    if '-b:v' in args:
+        return encode(outputs, stats_period, int(args[args.index('-b:v') + 1].rstrip('k')))
+    return encode(outputs, stats_period)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
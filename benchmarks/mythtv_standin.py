@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# In-memory stand-in for the parts of the MythTV python bindings used by
+# transcode-h264-v3.py, for benchmarking the orchestration of the script without
+# a mythtv backend or database. Every recording, job and database access lives in
+# the Store and every write to the "database" is timestamped and counted there.
+
+import datetime as _datetime
+import socket
+import threading
+import time
+import types
+
+class Store:
+    # recordings by (chanid, starttime), jobs by id and the recorded database events
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recordings = {}
+        self.jobs = {}
+        self.dirname = None
+        self.queries = 0
+        # (time, jobid or None, kind, data) for every write
+        self.events = []
+
+    def add_event(self, jobid=None, kind='', data=None):
+        with self.lock:
+            self.events.append((time.time(), jobid, kind, data))
+
+    def add_query(self):
+        with self.lock:
+            self.queries = self.queries + 1
+
+store = Store()
+
+class MythError(Exception):
+    def __init__(self, stderr=b'', retcode=1):
+        Exception.__init__(self, stderr)
+        self.stderr = stderr
+        self.retcode = retcode
+
+class MythLog:
+    helptext = 'stand-in bindings, no log levels'
+
+    @staticmethod
+    def _setlevel(level=None):
+        pass
+
+class datetime(_datetime.datetime):
+    def utcisoformat(self):
+        return self.strftime('%Y-%m-%dT%H:%M:%S')
+
+class Cursor:
+    # answers every query with an empty result
+    def execute(self, query='', args=None):
+        store.add_query()
+
+    def executemany(self, query='', rows=[]):
+        store.add_query()
+
+    def fetchone(self):
+        return (0,)
+
+    def fetchall(self):
+        return []
+
+class MythDB:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return Cursor()
+
+    def __exit__(self, *exc):
+        return False
+
+    def gethostname(self):
+        return socket.gethostname()
+
+    def searchJobs(self, **kwargs):
+        store.add_query()
+        return []
+
+class Job:
+    RUN = 0
+    PAUSE = 1
+    RESUME = 2
+    STOP = 4
+    QUEUED = 1
+    PENDING = 2
+    STARTING = 3
+    RUNNING = 4
+    STOPPING = 5
+    PAUSED = 6
+    FINISHED = 272
+    ABORTED = 288
+    ERRORED = 304
+    CANCELLED = 320
+    COMMFLAG = 2
+
+    def __init__(self, jobid=None, db=None):
+        data = store.jobs[int(jobid)]
+        self.id = int(jobid)
+        self.chanid = data['chanid']
+        self.starttime = data['starttime']
+        self.cmds = Job.RUN
+        self.status = Job.QUEUED
+        self.comment = ''
+
+    def _pull(self):
+        store.add_query()
+
+    def update(self, data={}):
+        self.__dict__.update(data)
+        store.add_event(self.id, 'job', dict(data))
+
+class Markup(list):
+    MARK_CUT_END = 0
+    MARK_CUT_START = 1
+    MARK_COMM_START = 4
+    MARK_COMM_END = 5
+
+    def __init__(self, key=None):
+        list.__init__(self)
+        self.key = key
+
+    def commit(self):
+        store.add_event(store.recordings[self.key]['jobid'], 'markup', None)
+
+class Seek:
+    def __init__(self, key=None):
+        self.key = key
+
+    def clean(self):
+        store.add_event(store.recordings[self.key]['jobid'], 'seek', None)
+
+class Recorded:
+    def __init__(self, key=None, db=None):
+        chanid, starttime = key
+        self.key = (int(chanid), starttime.replace(tzinfo=None))
+        data = store.recordings[self.key]
+        self.__dict__.update(data['fields'])
+        self.starttime = data['starttime']
+        self.markup = Markup(self.key)
+        self.seek = Seek(self.key)
+
+    def update(self):
+        store.add_event(store.recordings[self.key]['jobid'], 'recorded', None)
+
+class System:
+    # mythutil, mythcommflag and the other mythtv tools succeed without output
+    def __init__(self, path=None, db=None):
+        self.path = path
+
+    def __call__(self, *args):
+        return b''
+
+    def command(self, *args):
+        return b''
+
+class MythBE:
+    # a backend without scheduled recordings
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def getUpcomingRecordings(self):
+        store.add_query()
+        return []
+
+class Video:
+    def __init__(self, db=None):
+        pass
+
+    def create(self, data={}):
+        store.add_event(None, 'video', dict(data))
+        return self
+
+def findfile(basename=None, storagegroup=None, db=None):
+    return types.SimpleNamespace(dirname=store.dirname)
+
+def add_recording(chanid=0, starttime=None, basename=None, filesize=0, jobid=None):
+    # a recording of the stand-in database and the transcode job queued for it
+    starttime = datetime(*starttime.timetuple()[:6])
+    fields = {'basename':basename, 'storagegroup':'Default', 'filesize':filesize,
+              'commflagged':0, 'cutlist':0, 'bookmark':0, 'transcoded':0,
+              'title':'Benchmark', 'subtitle':'%d' % jobid, 'description':'',
+              'season':0, 'episode':0, 'inetref':''}
+    store.recordings[(chanid, starttime.replace(tzinfo=None))] = {'jobid':jobid, 'fields':fields,
+                                                                   'starttime':starttime}
+    store.jobs[jobid] = {'chanid':chanid, 'starttime':starttime}
+
+def module():
+    # the stand-in as a module to install as sys.modules['MythTV']
+    m = types.ModuleType('MythTV')
+    for name in ('Job', 'Recorded', 'Video', 'System', 'MythDB', 'MythBE', 'findfile', 'MythError',
+                 'MythLog', 'datetime'):
+        setattr(m, name, globals()[name])
+    return m
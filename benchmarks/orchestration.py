@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Hermetic benchmark of the orchestration overhead of transcode-h264-v3.py.
+#
+# runjob() is run for 1 to 32 concurrent jobs against the in-memory mythtv stand-in
+# of mythtv_standin.py and the fake encoder fake_ffmpeg.py, so neither mythtv nor
+# ffmpeg has to be installed. For every job it measures
+#   startup   secs from the call of runjob() until the encoder started
+#   progress  secs from the first encoder status line until the job showed progress
+#             (until the encoder exited if the job never showed progress)
+#   finalize  secs from the exit of the encoder until the job was finished
+#   writes    job, recording and markup updates written to the database
+# and per run the wall time and the database queries per job. The results are
+# written to a JSON file that a later run can be compared with, e.g.
+#
+#   benchmarks/orchestration.py --output before.json
+#   benchmarks/orchestration.py --output after.json --compare before.json
+
+from optparse import OptionParser
+import contextlib
+import datetime
+import functools
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchdir)
+import mythtv_standin
+
+# settings of the script that keep the runs hermetic and comparable
+settings = {'generate_commcutlist':False, 'governor':False, 'abortSizeRatio':0, 'profile_cache':'',
+            'audit_cache':'', 'cache_policy_cmd':'', 'build_seektable':False, 'debug':False}
+
+def load_script():
+    # transcode-h264-v3.py as a module using the stand-in mythtv bindings
+    sys.modules['MythTV'] = mythtv_standin.module()
+    spec = importlib.util.spec_from_file_location('transcode',
+                                                  os.path.join(benchdir, '..', 'transcode-h264-v3.py'))
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script
+
+def percentile(values=[], pct=50):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*pct/100))]
+
+def summarize(values=[]):
+    return {'mean':sum(values)/len(values) if values else 0.0,
+            'p50':percentile(values, 50), 'p95':percentile(values, 95),
+            'max':max(values) if values else 0.0}
+
+def run(script=None, jobs=1, filesize=0, workdir=None):
+    # transcode jobs recordings concurrently and return the measurements of the run
+    store = mythtv_standin.store
+    store.__init__()
+    store.dirname = workdir
+    logfile = os.path.join(workdir, 'ffmpeg.log')
+    os.environ['FAKE_FFMPEG_LOG'] = logfile
+    start = datetime.datetime(2024, 1, 1)
+    basenames = {}
+    for jobid in range(1, jobs + 1):
+        basename = '%d_%s.ts' % (1000 + jobid, start.strftime('%Y%m%d%H%M%S'))
+        with open(os.path.join(workdir, basename), 'wb') as f:
+            f.truncate(filesize)
+        mythtv_standin.add_recording(1000 + jobid, start, basename, filesize, jobid)
+        basenames[basename.rsplit('.', 1)[0]] = jobid
+
+    called = {}
+    def call(jobid=None, supervisor=None):
+        called[jobid] = time.time()
+        script.runjob(jobid=jobid, supervisor=supervisor)
+
+    began = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if jobs == 1:
+            try:
+                call(1)
+            except SystemExit:
+                pass
+        else:
+            supervisor = script.Supervisor(jobs)
+            supervisor.run([functools.partial(call, jobid, supervisor) for jobid in range(1, jobs + 1)])
+    wall = time.time() - began
+
+    # encoder events by job, keyed by the recording the output file is named after
+    encoder = {}
+    with open(logfile) as f:
+        for line in f:
+            t, event, outfile = line.split(' ', 2)
+            jobid = basenames[os.path.basename(outfile).split('.', 1)[0]]
+            encoder.setdefault(jobid, {}).setdefault(event, float(t))
+    startup, progress, finalize, writes = [], [], [], []
+    finished = 0
+    for jobid in range(1, jobs + 1):
+        events = [e for e in store.events if e[1] == jobid]
+        writes.append(len(events))
+        enc = encoder.get(jobid, {})
+        shown = [t for t, j, kind, data in events
+                 if kind == 'job' and data.get('comment', '').startswith('Transcoding to mp4')]
+        done = [t for t, j, kind, data in events
+                if kind == 'job' and data.get('status') == mythtv_standin.Job.FINISHED]
+        if 'start' in enc:
+            startup.append(enc['start'] - called[jobid])
+        if 'status' in enc and shown:
+            progress.append(max(0.0, shown[0] - enc['status']))
+        elif 'status' in enc and 'exit' in enc:
+            progress.append(enc['exit'] - enc['status'])
+        if 'exit' in enc and done:
+            finalize.append(done[0] - enc['exit'])
+            finished = finished + 1
+    return {'jobs':jobs, 'finished':finished, 'wall_secs':wall,
+            'startup_secs':summarize(startup), 'progress_latency_secs':summarize(progress),
+            'finalize_secs':summarize(finalize),
+            'db_writes_per_job':sum(writes)/float(jobs), 'db_queries_per_job':store.queries/float(jobs)}
+
+def print_results(results=[], baseline={}):
+    print('%5s %5s %8s %9s %9s %9s %9s %8s %9s' % ('jobs', 'done', 'wall', 'startup', 'progress',
+                                                   'finalize', 'fin-p95', 'writes', 'queries'))
+    for r in results:
+        line = '%5d %5d %8.2f %9.3f %9.3f %9.3f %9.3f %8.1f %9.1f' \
+               % (r['jobs'], r['finished'], r['wall_secs'], r['startup_secs']['mean'],
+                  r['progress_latency_secs']['mean'], r['finalize_secs']['mean'],
+                  r['finalize_secs']['p95'], r['db_writes_per_job'], r['db_queries_per_job'])
+        b = baseline.get(r['jobs'])
+        if b is not None:
+            line = line + '   (wall %+.0f%%, finalize %+.3f, writes %+.1f)' \
+                   % (100*(r['wall_secs']/b['wall_secs'] - 1),
+                      r['finalize_secs']['mean'] - b['finalize_secs']['mean'],
+                      r['db_writes_per_job'] - b['db_writes_per_job'])
+        print(line)
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--jobs', action='store', type='string', dest='jobs', default='1,2,4,8,16,32',
+            help='Comma separated numbers of concurrent jobs to run')
+    parser.add_option('--duration', action='store', type='float', dest='duration', default=120,
+            help='Duration of the fake recordings in secs')
+    parser.add_option('--speed', action='store', type='float', dest='speed', default=4,
+            help='Speed of the fake encoder as a multiple of realtime')
+    parser.add_option('--filesize', action='store', type='int', dest='filesize', default=8,
+            help='Size of the fake recordings in MB')
+    parser.add_option('--set', action='append', dest='set', default=[],
+            help='Override a setting of the script, e.g. --set POLL_INTERVAL=2')
+    parser.add_option('--output', action='store', type='string', dest='output',
+            default='orchestration-results.json', help='Results file')
+    parser.add_option('--compare', action='store', type='string', dest='compare',
+            help='Results file of an earlier run to compare with')
+    opts, args = parser.parse_args()
+
+    os.environ['FAKE_FFMPEG_DURATION'] = '%s' % opts.duration
+    os.environ['FAKE_FFMPEG_SPEED'] = '%s' % opts.speed
+    script = load_script()
+    overrides = dict(settings)
+    for setting in opts.set:
+        name, sep, value = setting.partition('=')
+        overrides[name] = json.loads(value) if value[:1] in '0123456789[{-tfn' else value
+    overrides['transcoder'] = os.path.join(benchdir, 'fake_ffmpeg.py')
+    for name, value in overrides.items():
+        setattr(script, name, value)
+
+    results = []
+    for jobs in [int(n) for n in opts.jobs.split(',')]:
+        workdir = tempfile.mkdtemp(prefix='transcode-bench-')
+        try:
+            results.append(run(script, jobs, opts.filesize*1024*1024, workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = dict((r['jobs'], r) for r in json.load(f)['results'])
+    print_results(results, baseline)
+    commit = subprocess.run(['git', '-C', benchdir, 'rev-parse', '--short', 'HEAD'],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    with open(opts.output, 'w') as f:
+        json.dump({'meta':{'date':datetime.datetime.now().isoformat(), 'commit':commit,
+                           'python':platform.python_version(), 'host':platform.node(),
+                           'cpus':os.cpu_count(), 'duration':opts.duration, 'speed':opts.speed,
+                           'settings':dict((k, v) for k, v in overrides.items() if k != 'transcoder')},
+                   'results':results}, f, indent=1)
+
+if __name__ == '__main__':
+    main()
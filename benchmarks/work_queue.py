@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Test of the shared work queue of transcode-h264-v3.py with several local worker
+# processes sharing one directory.
+#
+# The recordings are queued in <workdir>/queue and every worker is a separate process
+# running --worker against its own copy of the in-memory mythtv stand-in of
+# mythtv_standin.py and the fake encoder fake_ffmpeg.py, so neither mythtv nor ffmpeg
+# has to be installed. Besides the recordings, --missing recordings are queued that
+# are not in the database (like recordings deleted while queued) and with --kill one
+# worker is killed while it transcodes so that its stale lease is taken over. Once
+# the queue is empty the run is checked:
+#   every recording was transcoded and replaced by exactly one worker
+#   every missing recording left the queue as failed after MAX_ATTEMPTS and is not queued again
+#   no lease, temporary or clock probe file was left behind
+# e.g.
+#
+#   benchmarks/work_queue.py --workers 4 --recordings 12 --missing 1 --kill
+#   benchmarks/work_queue.py --workers 2 --jobs 3
+
+from optparse import OptionParser
+import datetime
+import functools
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchdir)
+import mythtv_standin
+import orchestration
+
+START = datetime.datetime(2024, 1, 1)
+
+def basename(index=0):
+    return '%d_%s.ts' % (1000 + index, START.strftime('%Y%m%d%H%M%S'))
+
+def worker(workdir=None, recordings=0, jobs=1, overrides={}):
+    # one worker process transcoding from the queue until it is killed, like --worker --jobs
+    script = orchestration.load_script()
+    for name, value in overrides.items():
+        setattr(script, name, value)
+    mythtv_standin.store.dirname = workdir
+    for index in range(1, recordings + 1):
+        mythtv_standin.add_recording(1000 + index, START, basename(index),
+                                     os.path.getsize(os.path.join(workdir, basename(index))), index)
+    sys.stdout = open(os.path.join(workdir, 'worker-%d.log' % os.getpid()), 'w', buffering=1)
+    if jobs > 1:
+        supervisor = script.Supervisor(jobs)
+        supervisor.run([functools.partial(script.work, False,
+                                          functools.partial(script.runjob, supervisor=supervisor))]*jobs)
+    else:
+        script.work()
+
+def children(pid=0):
+    # processes started by pid, the encoders run in sessions of their own
+    found = []
+    for entry in os.listdir('/proc'):
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    found.append(int(entry))
+        except (OSError, ValueError, IndexError):
+            pass
+    return found
+
+def kill(pid=0):
+    # kill a worker and its encoder like a host that crashed
+    os.kill(pid, signal.SIGSTOP)
+    for child in children(pid):
+        try:
+            os.killpg(child, signal.SIGKILL)
+        except OSError:
+            os.kill(child, signal.SIGKILL)
+    os.kill(pid, signal.SIGKILL)
+
+def encodes(logfile=None):
+    # started and finished encodes by output file
+    started, finished = {}, {}
+    if os.path.exists(logfile):
+        with open(logfile) as f:
+            for line in f:
+                t, event, outfile = line.split(' ', 2)
+                name = os.path.basename(outfile.strip()).split('.', 1)[0]
+                if event == 'start':
+                    started[name] = started.get(name, 0) + 1
+                elif event == 'exit':
+                    finished[name] = finished.get(name, 0) + 1
+    return started, finished
+
+def queued(queue=None):
+    return [f for f in os.listdir(queue) if f.endswith('.job')]
+
+def run(opts=None, workdir=None):
+    queue = os.path.join(workdir, 'queue')
+    os.mkdir(queue)
+    logfile = os.path.join(workdir, 'ffmpeg.log')
+    os.environ['FAKE_FFMPEG_LOG'] = logfile
+    os.environ['FAKE_FFMPEG_DURATION'] = '%s' % opts.duration
+    os.environ['FAKE_FFMPEG_SPEED'] = '%s' % opts.speed
+    overrides = dict(orchestration.settings)
+    overrides.update({'transcoder':os.path.join(benchdir, 'fake_ffmpeg.py'), 'queue_dir':queue,
+                      'POLL_INTERVAL':opts.poll, 'LEASE_HEARTBEAT':opts.lease_timeout/4.0,
+                      'LEASE_TIMEOUT':opts.lease_timeout})
+    script = orchestration.load_script()
+    for name, value in overrides.items():
+        setattr(script, name, value)
+    for index in range(1, opts.recordings + 1):
+        with open(os.path.join(workdir, basename(index)), 'wb') as f:
+            f.truncate(opts.filesize*1024*1024)
+        script.enqueue(1000 + index, START)
+    for index in range(1, opts.missing + 1):
+        script.enqueue(2000 + index, START)
+
+    began = time.time()
+    env = dict(os.environ, WORK_QUEUE_SETTINGS=json.dumps(overrides))
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker-of', workdir,
+                                 '--recordings', '%d' % opts.recordings, '--jobs', '%d' % opts.jobs], env=env)
+               for n in range(opts.workers)]
+    killed = None
+    while queued(queue) and time.time() - began < opts.timeout:
+        if opts.kill and killed is None:
+            started, finished = encodes(logfile)
+            # the worker holding the lease of the first recording being encoded
+            for lease in [f for f in os.listdir(queue) if '.job.lease.' in f]:
+                name = lease.split('.', 1)[0]
+                if name in started and name not in finished:
+                    try:
+                        with open(os.path.join(queue, lease)) as f:
+                            pid = int(f.read().split()[1])
+                    except (OSError, IndexError, ValueError):
+                        continue
+                    if pid in [w.pid for w in workers]:
+                        kill(pid)
+                        killed = pid
+                        break
+        time.sleep(0.2)
+    wall = time.time() - began
+    for w in workers:
+        if w.poll() is None:
+            w.terminate()
+        w.wait()
+
+    started, finished = encodes(logfile)
+    problems = []
+    done = 0
+    for index in range(1, opts.recordings + 1):
+        name = basename(index).rsplit('.', 1)[0]
+        if not os.path.exists(os.path.join(workdir, name + '.mp4')):
+            problems.append('%s was not transcoded' % name)
+            continue
+        done = done + 1
+        if finished.get(name, 0) - (1 if killed else 0) > 1 or started.get(name, 0) > (2 if killed else 1):
+            problems.append('%s was transcoded %d times' % (name, started.get(name, 0)))
+    failed = [f for f in os.listdir(queue) if f.endswith('.failed')]
+    if len(failed) != opts.missing:
+        problems.append('%d of %d missing recordings failed' % (len(failed), opts.missing))
+    for f in failed:
+        with open(os.path.join(queue, f)) as jobfile:
+            fields = jobfile.read().split()
+        if len(fields) < 3 or int(fields[2]) != script.MAX_ATTEMPTS - 1:
+            problems.append('%s failed after %s retries' % (f, fields[2:] or 0))
+    # a failed recording is not queued again
+    for index in range(1, opts.missing + 1):
+        if script.enqueue(2000 + index, START):
+            problems.append('%d_%s was queued again after it failed' % (2000 + index, START.strftime('%Y%m%d%H%M%S')))
+    # the killed worker leaves its temporary files behind like a crashed host
+    leftover = [f for f in os.listdir(queue) if not f.endswith('.failed')] \
+               + [f for f in os.listdir(workdir) if (f.startswith('.clock-') or '.part.' in f or f.endswith('.tmp'))
+                  and not (killed and '-%d.' % killed in f)]
+    if leftover:
+        problems.append('left behind: %s' % ' '.join(sorted(leftover)))
+    takeovers = len([name for name, count in started.items() if count > 1])
+    if killed and takeovers != 1:
+        problems.append('%d leases taken over after killing a worker' % takeovers)
+    return {'workers':opts.workers, 'recordings':opts.recordings, 'missing':opts.missing,
+            'done':done, 'failed':len(failed), 'encodes':sum(started.values()),
+            'killed':killed is not None, 'takeovers':takeovers, 'wall_secs':wall,
+            'problems':problems}
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--workers', action='store', type='int', dest='workers', default=4,
+            help='Number of worker processes')
+    parser.add_option('--jobs', action='store', type='int', dest='jobs', default=1,
+            help='Number of transcodes run concurrently by every worker process')
+    parser.add_option('--recordings', action='store', type='int', dest='recordings', default=12,
+            help='Number of recordings queued')
+    parser.add_option('--missing', action='store', type='int', dest='missing', default=1,
+            help='Number of queued recordings that are not in the database')
+    parser.add_option('--kill', action='store_true', dest='kill', default=False,
+            help='Kill a worker while it transcodes so that its lease is taken over')
+    parser.add_option('--duration', action='store', type='float', dest='duration', default=20,
+            help='Duration of the fake recordings in secs')
+    parser.add_option('--speed', action='store', type='float', dest='speed', default=8,
+            help='Speed of the fake encoder as a multiple of realtime')
+    parser.add_option('--filesize', action='store', type='int', dest='filesize', default=8,
+            help='Size of the fake recordings in MB')
+    parser.add_option('--poll', action='store', type='float', dest='poll', default=1,
+            help='POLL_INTERVAL of the workers in secs')
+    parser.add_option('--lease-timeout', action='store', type='float', dest='lease_timeout', default=4,
+            help='LEASE_TIMEOUT of the workers in secs')
+    parser.add_option('--timeout', action='store', type='float', dest='timeout', default=300,
+            help='Give up once the queue is not empty after this many secs')
+    parser.add_option('--output', action='store', type='string', dest='output',
+            default='work-queue-results.json', help='Results file')
+    parser.add_option('--worker-of', action='store', type='string', dest='worker_of',
+            help='Internal: run as a worker on the given directory')
+    opts, args = parser.parse_args()
+
+    if opts.worker_of:
+        worker(opts.worker_of, opts.recordings, opts.jobs, json.loads(os.environ['WORK_QUEUE_SETTINGS']))
+        return
+
+    workdir = tempfile.mkdtemp(prefix='transcode-queue-')
+    try:
+        result = run(opts, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print('%7s %10s %7s %5s %6s %7s %9s %8s' % ('workers', 'recordings', 'missing', 'done', 'failed',
+                                                'encodes', 'takeovers', 'wall'))
+    print('%7d %10d %7d %5d %6d %7d %9d %8.2f' % (result['workers'], result['recordings'], result['missing'],
+                                                  result['done'], result['failed'], result['encodes'],
+                                                  result['takeovers'], result['wall_secs']))
+    for problem in result['problems']:
+        print('FAILED: %s' % problem)
+    with open(opts.output, 'w') as f:
+        json.dump({'meta':{'date':datetime.datetime.now().isoformat(), 'duration':opts.duration,
+                           'speed':opts.speed},
+                   'results':[result]}, f, indent=1)
+    sys.exit(1 if result['problems'] else 0)
+
+if __name__ == '__main__':
+    main()
@@ -27,19 +27,23 @@
 # Modifications - Drew 1/25/2016
 # - added fix for the markup data which is inaccurate, especially when commercials are removed
 #
-from MythTV import Job, Recorded, System, MythDB, findfile, MythError, MythLog, datetime
+from MythTV import Job, Recorded, Video, System, MythDB, MythBE, findfile, MythError, MythLog, datetime
 
 from optparse import OptionParser
 from glob import glob
-from shutil import copyfile
 import sys
 import os
 import errno
 import threading, time
+import asyncio, collections, concurrent.futures, functools
+import signal, subprocess, select
+import ctypes, ctypes.util, struct
+import socket
 from datetime import timedelta
 from dateutil.parser import parse
-import re, tempfile
-import queue # thread-safe
+import re
+import json, fcntl
+import traceback
 ########## IMPORTANT #####################
 #
 # YOU WILL NEED TO EDIT THE SETTINGS BELOW
@@ -63,6 +67,29 @@ require_commflagged = False
 #      False => flagged commercials are NOT removed from the output video file
 generate_commcutlist = True
 
+# cut_after_encode
+#       True => the encode starts right away while the commercials are flagged in parallel, and forces a
+#               keyframe every CUT_KEYFRAME_SECS. Afterwards the cutlist is applied to the h264 encode by a
+#               lossless stream copy cut at these keyframes. Running the job again on the transcoded
+#               recording applies a cutlist edited later the same way, without encoding it again
+#      False => (Default) the commercials are flagged and cut (mythtranscode) before the encode
+cut_after_encode = False
+CUT_KEYFRAME_SECS = 2 # secs
+# secs the cut waits after the encode for the commercial flagging of the recording to finish
+COMMFLAG_WAIT_TIMEOUT = 3600 # secs
+
+# stream_health_scan
+#       True => (Default) the staged recording is demuxed (without decoding) before the encode to find
+#               timestamp discontinuities, video missing at its start and corrupt packets, e.g. of
+#               hdhomerun recordings. A recording with such problems is repaired by a lossless remux
+#               that closes the timestamp gaps, drops the corrupt packets and starts with the video
+#      False => the recording is encoded as it is and problems only show when the encode fails
+stream_health_scan = True
+# a jump of the video timestamps of more than this (or backwards) is a discontinuity
+HEALTH_GAP_SECS = 1.0 # secs
+# video starting more than this after the audio is missing at the start
+HEALTH_LEAD_SECS = 1.0 # secs
+
 # estimateBitrate 
 #       True => (Default) the bitrate of the input file is estimated via size & duration
 #               ** Required True for "compressionRatio" option to work.
@@ -81,6 +108,16 @@ estimateBitrate = True
 #                   (output filesize) = compressionRatio * (input filesize)
 compressionRatio = 0.65
 
+# sampled_bitrate
+#       True => (Default) the bitrate compressionRatio applies to is the video bitrate of the input,
+#               measured by demuxing (without decoding) bitrate_windows windows of BITRATE_WINDOW_SECS
+#               spread over the recording, this takes seconds even for large recordings
+#      False => the bitrate is estimated from the file size and duration, which also counts the
+#               audio streams and the packet overhead and null padding of the transport stream
+sampled_bitrate = True
+bitrate_windows = 8
+BITRATE_WINDOW_SECS = 10 # secs
+
 # enforce a max (do not exceed) bitrate for encoded HD video
 # to disable set hd_max_bitrate=0
 hdvideo_max_bitrate = 5500  # 0 = disable or (kBits_per_sec,kbps)
@@ -94,6 +131,16 @@ device_bufsize = NUM_SECS_VIDEO_BUF*hdvideo_max_bitrate # (kBits_per_sec,kbps)
 #hdvideo_tgt_bitrate = 5000   # 0 = disable or (kBits_per_sec,kbps)
 hdvideo_tgt_bitrate = 0   # 0 = disable or (kBits_per_sec,kbps)
 
+# two_pass
+#       True => encodes at a target bitrate (hdvideo_tgt_bitrate or a bitrate set for the channel)
+#               run a fast analysis pass first and hit the target in the second pass. The stats of
+#               the first pass are kept next to the recording as <basename>.pass-0.log* until the
+#               job ends, so a job rerun after its host went down skips the first pass.
+#      False => (Default) encodes at a target bitrate are single pass average bitrate encodes
+two_pass = False
+# a second pass missing the target bitrate by more than this fraction is noted in the job comment
+TWO_PASS_TOLERANCE = 0.02
+
 # build_seektable
 #       True => Rebuild myth seek table.
 #               It allows accurate ffwd,rew / seeking on the transcoded output video
@@ -110,11 +157,58 @@ debug = False
 preset_HD = 'fast'
 preset_nonHD = 'slow'
 
+# video encoder backend by resolution, a channel can use another one (--set-profile encoder=NAME).
+# The x264 preset (speed tier), crf (quality target), hdvideo_max_bitrate and encode_threads are the
+# intent every backend of ENCODERS maps onto its own options. The renditions stay h264
+# libx264 => (Default) h264, plays everywhere
+# libx265 => HEVC, about 40% smaller at the same quality for about 4x the cpu
+# libsvtav1 => AV1, about 50% smaller at the same quality, needs an AV1 capable frontend
+encoder_HD = 'libx264'
+encoder_nonHD = 'libx264'
+# the backends: the ffmpeg encoder, its presets for the x264 preset names, its crf for an x264
+# crf (crf + crf_offset), the option of its encoder parameters and the names of its thread,
+# lookahead and reference frame parameters (None = not set), its memory use relative to x264,
+# whether it runs two-pass encodes (two_pass) and further output options
+ENCODERS = {'libx264':{'presets':{}, 'crf_offset':0, 'params':'-x264-params', 'threads':None,
+                       'lookahead':'rc-lookahead', 'ref':'ref', 'memory_scale':1.0, 'two_pass':True, 'args':''},
+            'libx265':{'presets':{}, 'crf_offset':5, 'params':'-x265-params', 'threads':'pools',
+                       'lookahead':'rc-lookahead', 'ref':'ref', 'memory_scale':2.0, 'two_pass':False,
+                       'args':'-tag:v hvc1'},
+            'libsvtav1':{'presets':{'ultrafast':12, 'superfast':11, 'veryfast':10, 'faster':9, 'fast':8,
+                                    'medium':7, 'slow':5, 'slower':4, 'veryslow':2},
+                         'crf_offset':10, 'params':'-svtav1-params', 'threads':'lp', 'lookahead':'lookahead',
+                         'ref':None, 'memory_scale':2.5, 'two_pass':False, 'args':''}}
+
 # h264 encode constant rate factor (used for non-HD) valid/sane values 18-28
 # lower values -> higher quality, larger output files,
 # higher values -> lower quality, smaller output files
 crf = '21'
 
+# number of encoder threads, 0 = let x264 choose (about 1.5 per cpu)
+encode_threads = 4
+
+# memory_budget
+#      0 => (Default) the encoder uses the lookahead, reference frames and threads of its preset
+#      MB => RSS ceiling of all transcodes of this host together. The x264 lookahead, threads and
+#            reference frames of an encode are limited so its predicted peak RSS fits the budget,
+#            and a job only starts its encode once its prediction fits next to the encodes of this
+#            host already running. The prediction is corrected by the peak RSS measured for the
+#            past jobs of the channel (see --profiles).
+memory_budget = 0
+# memory of an encode besides the frames buffered by x264 (decoder, filters, ffmpeg)
+MEMORY_BASE = 150 # MB
+# memory x264 needs per frame in flight (lookahead, threads, references) as a multiple of a raw frame
+MEMORY_FRAME_FACTOR = 4.0
+# file holding the memory reserved by the running transcodes of this host
+memory_reservations = '/tmp/transcode-h264-memory.json'
+# x264 lookahead and reference frames of the presets
+PRESET_LIMITS = {'ultrafast':(0, 1), 'superfast':(0, 1), 'veryfast':(10, 1), 'faster':(20, 2),
+                 'fast':(30, 2), 'medium':(40, 3), 'slow':(50, 5), 'slower':(60, 8), 'veryslow':(60, 16)}
+
+# de-interlacing filter applied to the video, e.g. 'bwdif=0:-1:1' is faster than yadif
+# on current ffmpeg, benchmarks/encoder_settings.py compares them on your recordings
+deinterlace_filter = 'yadif=0:-1:1'
+
 # if HD, copy input audio streams to the output audio streams
 abitrate_param_HD='-c:a copy'
 
@@ -141,6 +235,23 @@ abitrate_param_nonHD = '-c:a libfdk_aac -b:a 128k'
 # spa - Spanish
 language = 'eng'
 
+# stream_plan
+#       True => (Default) the audio and subtitle streams to keep are selected from the probe of the
+#               input by audio_languages and subtitle_languages, all other streams are not processed
+#      False => ffmpeg picks one audio and one subtitle stream
+stream_plan = True
+# audio streams in these languages are kept except audio descriptions, the first audio
+# stream is kept when no stream matches
+audio_languages = [language]
+# text subtitle streams in these languages are kept (converted to mov_text), bitmap
+# subtitles cannot be stored in mp4
+subtitle_languages = [language]
+# parallel_audio
+#       True => (Default) the kept audio streams are encoded (or copied) by a separate ffmpeg process
+#               running in parallel with the video encode and muxed with the video at the end
+#      False => the audio streams are encoded by the video encode process
+parallel_audio = True
+
 # interval between reads from the ffmpeg status file 
 # also defines the interval when waiting for a mythcommflag job to finish 
 POLL_INTERVAL=10 # secs
@@ -150,11 +261,211 @@ POLL_INTERVAL=10 # secs
 #NICELEVEL=5
 NICELEVEL=0
 
-class CleanExit:
-  pass
+# abortSizeRatio
+#      0.0 => never abort an encode because of its output size
+#      > 0 => (Default 1.0) the size of the output file is projected from the bytes written
+#             so far and the encoded time. The encode is aborted when the projection exceeds
+#             abortSizeRatio * (clipped input filesize), e.g., 1.0 aborts any encode that
+#             would produce a file larger than the mpeg2 source it came from.
+abortSizeRatio = 1.0
+# percent of the recording that has to be encoded before the size projection is trusted
+abortMinProgress = 5
+# number of times an aborted encode is restarted with a stronger setting (0 = fail the job)
+abortRestarts = 1
+# increase of the constant rate factor when a CRF encode is restarted
+abortCrfStep = 3
+
+# interval between checks for pause/resume/stop commands sent to the job from the
+# frontend or mythweb, the encoder and mythtranscode are signalled within this time
+JOBCTL_INTERVAL=2 # secs
+
+# governor
+#       True => (Default) the encode yields cpu and disk to live recordings, its priority is
+#               lowered (nice 19 and ionice idle class) or it is paused while recordings are
+#               in progress or the system is under load, and restored once they finish
+#      False => the encode always runs at NICELEVEL
+governor = True
+# number of recordings in progress that lower the encode priority/pause the encode (0 = disable)
+governor_throttle_recordings = 1
+governor_pause_recordings = 3
+# 1-minute load average per cpu that lowers the encode priority/pauses the encode (0 = disable)
+governor_throttle_load = 1.5
+governor_pause_load = 3.0
+# percent of time tasks stalled on i/o over the last 10 secs (/proc/pressure/io "some avg10")
+# that lowers the encode priority/pauses the encode (0 = disable)
+governor_throttle_iopressure = 20
+governor_pause_iopressure = 50
+
+# transcode_windows
+#      [] => (Default) transcodes run at any time
+#      ['DAYS HH:MM-HH:MM', ...] => local times in which transcodes run. Outside of them a job is held
+#                                   before it starts, a running encode is paused (SIGSTOP) when its
+#                                   window closes and continues when the next one opens, and the
+#                                   workers of the shared work queue do not lease recordings.
+#                                   DAYS is Mon-Sun, a range (Mon-Fri), a list (Sat,Sun) or *, a
+#                                   window ending before it starts ends the next day
+# e.g., overnight and at weekend daytimes
+# transcode_windows = ['* 23:00-07:00', 'Sat,Sun 09:00-17:00']
+transcode_windows = []
+
+# deadline_presets
+#      [] => (Default) the preset is chosen by resolution (preset_HD, preset_nonHD)
+#      [preset, ...] => the slowest (best compressing) of these presets that is predicted to finish
+#                       DEADLINE_MARGIN secs before the next busy window is used, the first time
+#                       governor_throttle_recordings recordings are scheduled at once. The encode
+#                       speed of each preset is predicted from the throughput learned for the channel
+#                       (see profile_cache) or for recordings of other resolutions, and the encode is
+#                       restarted with a faster preset when its throughput drifts and it would run
+#                       into the busy window, e.g. ['slow', 'medium', 'fast', 'veryfast']
+deadline_presets = []
+DEADLINE_MARGIN = 600 # secs
+# a running encode is re-evaluated when its fps differs from the prediction by more than
+# this fraction, or when the schedule changed (the schedule is read every DEADLINE_RECHECK secs)
+DEADLINE_DRIFT = 0.25
+DEADLINE_RECHECK = 300 # secs
+# encode speed of the x264 presets relative to 'slow', refined by the throughput learned per preset
+PRESET_SPEED = {'ultrafast':9.0, 'superfast':6.5, 'veryfast':5.0, 'faster':3.0, 'fast':2.3,
+                'medium':1.9, 'slow':1.0, 'slower':0.45, 'veryslow':0.2}
+
+# size of the reads and writes used by the script to copy recordings, the written data is
+# flushed to disk and dropped from the page cache every IO_FLUSH_SIZE bytes so that
+# multi-GB copies do not push the backend and database out of memory
+IO_CHUNK_SIZE = 8*1024*1024        # bytes
+IO_FLUSH_SIZE = 64*1024*1024       # bytes
 
-def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
-    global estimateBitrate
+# cache_policy_cmd
+#      command prefix for ffmpeg and mythtranscode that limits their use of the page cache
+#      e.g., 'nocache' (needs the nocache package) drops the pages of the files they read and write
+#            'systemd-run --scope --quiet -p MemoryHigh=1G' caps the memory (and page cache)
+#            they can use in a cgroup
+#      '' => (Default) the tools are run without a cache policy
+cache_policy_cmd = ''
+
+# prioritize_policy
+#      order in which --prioritize ranks the backlog of recordings that are not transcoded yet
+#      'reclaim'   => (Default) most bytes reclaimed per cpu-hour first
+#      'oldest'    => oldest recordings first
+#      'shortest'  => shortest transcodes first
+#      'watchsoon' => unwatched episodes of the most recently watched titles first
+prioritize_policy = 'reclaim'
+# estimated cpu seconds needed per second of recording, used to rank the backlog
+encode_cost_HD = 2.0
+encode_cost_nonHD = 0.6
+commflag_cost = 0.1
+
+# watch_userjob
+#      user job number (1-4) that runs this script as "transcode-h264-v3.py %JOBID%",
+#      --watch queues this user job for every recording that is finished and commflagged
+watch_userjob = 1
+# storage group directories watched by --watch, [] => (Default) all recording storage
+# groups of this host from the mythtv database
+watch_dirs = []
+# file extensions of the recordings --watch queues for transcoding
+watch_extensions = ('.ts', '.mpg')
+# recordings changed in the last watch_rescan_hours are checked once when --watch starts,
+# their events were missed while it was not running
+watch_rescan_hours = 24
+# a recording that is not finished or flagged yet when its file is closed is checked again
+# on its next close or after watch_retry secs, doubling up to watch_retry_max secs, until
+# it is queued or watch_rescan_hours passed
+watch_retry = 30
+watch_retry_max = 1800
+
+# queue_dir
+#      directory on storage shared by all transcoding hosts (e.g., an NFS export next to the
+#      recordings) holding the work queue, --enqueue and --watch put recordings in it and any
+#      number of hosts running --worker transcode them in parallel
+#      '' => (Default) no shared work queue, --watch queues mythtv user jobs
+queue_dir = ''
+# a worker touches the lease of its recording every LEASE_HEARTBEAT secs, a lease not
+# touched for LEASE_TIMEOUT secs is stale and the recording is taken over by another worker
+LEASE_HEARTBEAT = 30   # secs
+LEASE_TIMEOUT = 300    # secs
+# a recording whose transcode raised an error MAX_ATTEMPTS times (e.g., it was deleted while
+# queued) is taken out of the queue as <name>.failed instead of being retried
+MAX_ATTEMPTS = 3
+# storage group directories mounted at a different path on this host
+# e.g., {'/var/lib/mythtv/recordings': '/mnt/backend/recordings'}
+storage_path_map = {}
+
+# an encode that produced no ffmpeg output for ENCODE_HANG_TIMEOUT secs (while not paused)
+# is considered hung and terminated, 0 = only report a possible hang
+ENCODE_HANG_TIMEOUT = 1800 # secs
+# interval between ffmpeg status lines (ffmpeg >= 4.4), a longer period lowers the monitoring
+# overhead of many concurrent encodes, 0 = (Default) ffmpeg's default of 0.5 secs
+ffmpeg_stats_period = 0
+# the output of ffmpeg and the other tools is kept in memory, bounded to its first
+# OUTPUT_HEAD_SIZE bytes (banner and stream information) and its last OUTPUT_TAIL_SIZE
+# bytes, ffmpeg status lines only replace the latest status line
+OUTPUT_HEAD_SIZE = 16*1024 # bytes
+OUTPUT_TAIL_SIZE = 32*1024 # bytes
+# the job comment column of the mythtv job queue holds at most JOB_COMMENT_SIZE characters
+JOB_COMMENT_SIZE = 128
+
+# preview_offsets
+#      [] => no previews are written, mythtv regenerates the preview of the transcoded recording
+#      [secs, ...] => (Default [64]) preview images taken at these offsets into the recording are
+#                     written by the encoder from the same decode as the transcode. The first one
+#                     is the mythtv preview of the recording (<basename>.png), the others are
+#                     written to <basename>.<secs>.png
+preview_offsets = [64]
+preview_width = 320 # pixels
+# storyboard_tiles
+#      '' => (Default) no storyboard is written
+#      'COLSxROWS' => a storyboard of COLS*ROWS thumbnails evenly spaced over the recording is
+#                     written to <basename>.storyboard.jpg, e.g., '5x4'
+storyboard_tiles = ''
+storyboard_width = 160 # pixels per thumbnail
+
+# renditions
+#      [] => (Default) only the archive transcode is written
+#      [{...}, ...] => further renditions are encoded from the same decode and de-interlace as the
+#                      archive, each scaled down to 'height' lines and encoded with its own 'crf'
+#                      (or 'bitrate' in kbps), 'preset' and 'audio' parameters. A rendition is
+#                      written next to the recording as <basename without .mp4>.<name>.mp4
+# e.g., a mobile proxy
+# renditions = [{'name':'480p', 'height':480, 'crf':24, 'preset':'veryfast',
+#                'audio':'-c:a aac -b:a 96k -ac 2'}]
+renditions = []
+# rendition_videos_dir
+#      '' => (Default) renditions stay next to the recording
+#      path => renditions are moved into this directory of the Videos storage group
+#              and added to the mythvideo library
+rendition_videos_dir = ''
+
+# profile_cache
+#      '' => no encode profiles are kept
+#      path => (Default) file keeping an encode profile for every channel: the fingerprint of its
+#              streams, the settings its encodes ended with and the compression they achieved.
+#              The profile is applied to new recordings of the channel and forgotten when the
+#              fingerprint changes. See --profiles, --set-profile and --clear-profile.
+profile_cache = os.path.expanduser('~/.transcode-h264-profiles.json')
+
+# audit_cache
+#      path => (Default) file caching the probed duration of the transcoded recordings by file size
+#              and modification time, --audit only probes files that are new or changed since
+audit_cache = os.path.expanduser('~/.transcode-h264-audit.json')
+# a duration markup that differs from the probed duration by more than this is corrected
+AUDIT_DURATION_TOLERANCE = 1.0 # secs
+
+# verify_windows
+#      0 => the transcode is trusted by the exit status of ffmpeg
+#      N => (Default 6) before the original recording is deleted, N windows of VERIFY_WINDOW_SECS
+#           spread over the transcode (the last one at its end) are decoded in parallel, its
+#           duration is compared with the source and its streams are counted. The original is
+#           kept when the verification fails.
+verify_windows = 6
+VERIFY_WINDOW_SECS = 2 # secs
+# allowed difference between the durations of the transcode and the source,
+# as a fraction of the duration but at least VERIFY_WINDOW_SECS
+VERIFY_DURATION_TOLERANCE = 0.01
+
+class JobStopped(Exception):
+    pass
+
+def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None, lease=None, supervisor=None):
+    # a failed estimate only falls back to CRF for this job, the setting is shared by threads
+    estimate_bitrate = estimateBitrate
     db = MythDB()
 
     if jobid:
@@ -172,6 +483,9 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
         print('utcstarttime "%s"' % utcstarttime)
 
     rec = Recorded((chanid, utcstarttime), db=db);
+    # a job started outside of the transcode windows is held until the next window opens
+    if transcode_windows:
+        wait_for_window(jobid, job)
     utcstarttime = rec.starttime;
     starttime_datetime = utcstarttime
    
@@ -180,29 +494,23 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
     if debug:
         print('mythtv format starttime "%s"' % starttime)
     input_filesize = rec.filesize
+
+    # a recording transcoded with cut_after_encode is only cut again by its edited cutlist
+    if cut_after_encode and rec.transcoded and rec.basename.endswith('.mp4'):
+        infile = find_recording(db, rec)
+        if infile is None:
+            print('Local access to recording not found.')
+            sys.exit(1)
+        recut(db, rec, jobid, job, infile, chanid, starttime)
+        return
     
+    # with cut_after_encode the commercial flagging runs while the recording is encoded
+    commflag_proc = None
     if rec.commflagged:
         if debug:
             print('Recording has been scanned to detect commerical breaks.')
-        waititer=1
-        keepWaiting = True
-        while keepWaiting == True:
-            keepWaiting=False;
-            for index,jobitem in reversed(list(enumerate(db.searchJobs(chanid=chanid, starttime=starttime_datetime)))):
-                if jobitem.type == jobitem.COMMFLAG:  # Commercial flagging job
-                    if debug:
-                        print('Commercial flagging job detected with status %s' % jobitem.status)
-                    if jobitem.status == jobitem.RUNNING: # status = RUNNING?
-                        job.update({'status':job.PAUSED, 
-                                    'comment':'Waited %d secs for the commercial flagging job' % (waititer*POLL_INTERVAL) \
-                                     + ' currently running on this recording to complete.'})
-                        if debug:
-                            print('Waited %d secs for the commercial flagging job' % (waititer*POLL_INTERVAL) \
-                                  + ' currently running on this recording to complete.')
-                        time.sleep(POLL_INTERVAL);
-                        keepWaiting=True
-                        waititer = waititer + 1
-                        break
+        if not cut_after_encode:
+            wait_for_commflag(db, jobid, job, chanid, starttime_datetime)
     else:
         if debug:
             print('Recording has not been scanned to detect/remove commercial breaks.')
@@ -227,76 +535,91 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
                                     + ' this recording and cancelled this job.'})
             if debug:
                 print('Flagging Commercials...')
-            # Call "mythcommflag --chanid $CHANID --starttime $STARTTIME"
-            task = System(path='mythcommflag', db=db)
-            try:
-                output = task('--chanid "%s"' % chanid,
-                              '--starttime "%s"' % starttime,
-                              '2> /dev/null')
-            except MythError as e:
-                # it seems mythcommflag always exits with an decoding error "eno: Unknown error 541478725 (541478725)"
-                pass
-                #print 'Command failed with output:\n%s' % e.stderr
-                #if jobid:
-                #    job.update({'status':304, 'comment':'Flagging commercials failed'})
-                #sys.exit(e.retcode)
+            if cut_after_encode:
+                # flagged in the background, the cut waits for it after the encode
+                commflag_proc = start_process('mythcommflag --chanid "%s" --starttime "%s"' % (chanid, starttime),
+                                              OutputBuffer())
+            else:
+                # Call "mythcommflag --chanid $CHANID --starttime $STARTTIME"
+                task = System(path='mythcommflag', db=db)
+                try:
+                    output = task('--chanid "%s"' % chanid,
+                                  '--starttime "%s"' % starttime,
+                                  '2> /dev/null')
+                except MythError:
+                    # it seems mythcommflag always exits with an decoding error "eno: Unknown error 541478725 (541478725)"
+                    pass
+                    #print 'Command failed with output:\n%s' % e.stderr
+                    #if jobid:
+                    #    job.update({'status':304, 'comment':'Flagging commercials failed'})
+                    #sys.exit(e.retcode)
 
 
-    sg = findfile(rec.basename, rec.storagegroup, db=db)
-    if sg is None:
+    infile = find_recording(db, rec)
+    if infile is None:
         print('Local access to recording not found.')
         sys.exit(1)
 
-    infile = os.path.join(sg.dirname, rec.basename)
-    tmpfile = '%s.tmp' % infile.rsplit('.',1)[0]
+    # temporary files are named after the host and process so that workers
+    # sharing the storage never write the same file
+    tmpbase = '%s.%s-%d' % (infile.rsplit('.',1)[0], socket.gethostname(), os.getpid())
+    tmpfile = '%s.tmp' % tmpbase
  #   tmpfile = infile
+    # the encoder writes partfile which becomes outfile when the transcode is finalized
+    partfile = '%s.part.mp4' % tmpbase
     outfile = '%s.mp4' % infile.rsplit('.',1)[0]
     if debug:
         print('tmpfile "%s"' % tmpfile)
 
 
+    # measure the growth of the page cache over the transcode
+    meter = CacheMeter()
+    # the governor yields cpu and disk to live recordings during mythtranscode and the encode,
+    # and pauses them outside of the transcode windows
+    gov = None
+    if governor or transcode_windows:
+        gov = Governor(db)
+
     clipped_bytes=0;
     # If selected, create a cutlist to remove commercials via mythtranscode by running:
     # mythutil --gencutlist --chanid $CHANID --starttime $STARTTIME
-    if generate_commcutlist:
-        if jobid:
-            job.update({'status':job.RUNNING, 'comment':'Generating Cutlist for commercial removal'})
-        task = System(path='mythutil', db=db)
-        try:
-            output = task('--gencutlist',
-                          '--chanid "%s"' % chanid,
-                          '--starttime "%s"' % starttime)
-#                          '--loglevel debug',
-#                          '2> /dev/null')
-        except MythError as e:
-            print('Command "mythutil --gencutlist" failed with output:\n%s' % e.stderr)
+    if generate_commcutlist and not cut_after_encode:
+        returncode, output = generate_cutlist(db, jobid, job, chanid, starttime)
+        if returncode != 0:
             if jobid:
-                job.update({'status':job.ERRORED, 'comment':'Generation of commercial Cutlist failed'})
-            sys.exit(e.retcode)
+                job.update({'status':job.ERRORED,
+                            'comment':failure_comment('Generation of commercial Cutlist failed', output)})
+            sys.exit(returncode)
 
     # Lossless transcode to strip cutlist
-    if generate_commcutlist or rec.cutlist==1:
+    if (generate_commcutlist or rec.cutlist==1) and not cut_after_encode:
         if jobid:
             job.update({'status':job.RUNNING, 'comment':'Removing Cutlist'})
-        task = System(path='mythtranscode', db=db)
         try:
-            output = task('--chanid "%s"' % chanid,
-                          '--starttime "%s"' % starttime,
-                          '--mpeg2',
-                          '--honorcutlist',
-                          '-o "%s"' % tmpfile,
-                          '1>&2')
-#                          '2> /dev/null')
+            returncode, output = run_controlled(jobid, job, gov, meter,
+                                        cache_policy_args() +
+                                        ['mythtranscode',
+                                         '--chanid "%s"' % chanid,
+                                         '--starttime "%s"' % starttime,
+                                         '--mpeg2',
+                                         '--honorcutlist',
+                                         '-o "%s"' % tmpfile,
+                                         '1>&2'], supervisor)
+#                                         '2> /dev/null'])
+        except JobStopped:
+            stop_job(jobid, job, tmpfile)
+        if returncode == 0:
             clipped_filesize = os.path.getsize(tmpfile)
             clipped_bytes = input_filesize - clipped_filesize
             clipped_compress_pct = float(clipped_bytes)/input_filesize 
             rec.commflagged = 0
-        except MythError as e:
-            print('Command "mythtranscode --honorcutlist" failed with output:\n%s' % e.stderr)
+        else:
+            print('Command "mythtranscode --honorcutlist" failed with exit code %d and output:\n%s' \
+                  % (returncode, output.text()))
             if jobid:
                 job.update({'status':job.ERRORED, 'comment':'Removing Cutlist failed. Copying file instead.'})
 #            sys.exit(e.retcode)
-            copyfile('%s' % infile, '%s' % tmpfile)
+            stream_copy(infile, tmpfile, meter)
             clipped_filesize = input_filesize
             clipped_bytes = 0
             clipped_compress_pct = 0
@@ -304,28 +627,65 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
     else:
         if jobid:
             job.update({'status':job.RUNNING, 'comment':'Creating temporary file for transcoding.'})
-        copyfile('%s' % infile, '%s' % tmpfile)
+        stream_copy(infile, tmpfile, meter)
         clipped_filesize = input_filesize
         clipped_bytes = 0
         clipped_compress_pct = 0
 
+    # a recording with broken timestamps, missing video at the start or corrupt packets is
+    # repaired before the encode instead of failing or losing sync hours into it
+    cut_offset = 0.0
+    if stream_health_scan:
+        if jobid:
+            job.update({'status':job.RUNNING, 'comment':'Scanning the streams for timestamp and packet errors'})
+        began = time.time()
+        health = scan_health(tmpfile)
+        problems = health_problems(health) if health is not None else ''
+        print('Stream health scan took %.1f secs%s' % (time.time() - began, ': %s' % problems if problems else ''))
+        if health is not None and health['repeats'] > 0:
+            print('%d repeated video timestamps, kept by -vsync passthrough' % health['repeats'])
+        if problems:
+            if jobid:
+                job.update({'status':job.RUNNING, 'comment':('Repairing %s' % problems)[:JOB_COMMENT_SIZE]})
+            repairedfile = '%s.repaired.ts' % tmpbase
+            try:
+                returncode, output = run_controlled(jobid, job, gov, meter,
+                                                    cache_policy_args() + repair_args(health, tmpfile, repairedfile),
+                                                    supervisor)
+            except JobStopped:
+                remove_tmpfiles(repairedfile)
+                stop_job(jobid, job, tmpfile)
+            if returncode == 0:
+                os.replace(repairedfile, tmpfile)
+                clipped_filesize = os.path.getsize(tmpfile)
+                # the cutlist of the recording is shifted by the start cut by the repair
+                if health['lead'] > HEALTH_LEAD_SECS:
+                    cut_offset = health['lead']
+            else:
+                # the encode of the unrepaired recording may still succeed
+                print('Repair of the recording failed, encoding it as it is:\n%s' % output.text())
+                remove_tmpfiles(repairedfile)
+
     duration_secs = 0
+    framerate = 0
+    isHD = False
+    probe = ''
     # Estimate bitrate, and detect duration and number of frames
-    if estimateBitrate:
+    if estimate_bitrate:
         if jobid:
             job.update({'status':job.RUNNING, 'comment':'Estimating bitrate; detecting frames per second, and resolution.'})
 
-        duration_secs, e = get_duration(db, rec, transcoder, tmpfile);
+        duration_secs, probe = get_duration(db, rec, transcoder, tmpfile);
         if duration_secs>0:
             bitrate = int(clipped_filesize*8/(1024*duration_secs))
         else:
             print('Estimate bitrate failed falling back to constant rate factor encoding.\n')
-            estimateBitrate = False
+            estimate_bitrate = False
             duration_secs = 0
-        print(e.stderr.decode('utf-8'))
+        print(probe)
         # get framerate of mpeg2 video stream and detect if stream is HD
         r = re.compile('mpeg2video (.*?) fps,')
-        m = r.search(e.stderr.decode('utf-8'))
+        m = r.search(probe)
         strval = m.group(1)
         if debug:
             print(strval)
@@ -340,6 +700,18 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
         framerate = float(m.group(1).split(' ')[-1])
         if debug:
             print('Framerate %s' % framerate)
+        # the video bits of the input measured by a demux scan replace the estimate
+        if sampled_bitrate and duration_secs > 0:
+            rates = sample_bitrates(tmpfile, duration_secs)
+            if rates is not None:
+                resolution = re.search('([0-9]{2,})x([0-9]{2,})', strval)
+                bits_per_pixel = 0.0
+                if resolution and framerate > 0:
+                    bits_per_pixel = rates['video']*1024/(int(resolution.group(1))*int(resolution.group(2))*framerate)
+                print('Video %d kbps (peak %d kbps, %.3f bits/pixel), audio %d kbps, overhead and padding %d kbps' \
+                      % (rates['video'], rates['peak'], bits_per_pixel, rates['audio'],
+                         max(0, bitrate - rates['video'] - rates['audio'])))
+                bitrate = rates['video']
 
     # Setup transcode video bitrate and quality parameters
     # if estimateBitrate is true and the input content is HD:
@@ -347,30 +719,53 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
     # else:
     #     encode at user default preset and constant rate factor ('slow' and 20) 
     preset = preset_nonHD
-    if estimateBitrate:
+    encoder = encoder_nonHD
+    # video_bitrate = 0 selects CRF encoding at video_crf
+    video_crf = int(crf)
+    video_bitrate = 0
+    if estimate_bitrate:
         if isHD:
             h264_bitrate = int(bitrate*compressionRatio)
             # HD coding with specified target bitrate (CRB encoding)
             if hdvideo_tgt_bitrate > 0 and h264_bitrate > hdvideo_tgt_bitrate:
                 h264_bitrate = hdvideo_tgt_bitrate;
-                vbitrate_param = '-b:v %dk' % h264_bitrate
-            else:   # HD coding with disabled or acceptable target bitrate (CRF encoding)
-                vbitrate_param = '-crf:v %s' % crf
+                video_bitrate = h264_bitrate
+            # else HD coding with disabled or acceptable target bitrate (CRF encoding)
             preset = preset_HD
-        else: # non-HD encoding (CRF encoding)
-            vbitrate_param = '-crf:v %s' % crf            
-    else:
-        vbitrate_param = '-crf:v %s' % crf
-    if hdvideo_min_bitrate > 0:
-        vbitrate_param = vbitrate_param + ' -minrate %sk' % hdvideo_min_bitrate
-    if hdvideo_max_bitrate > 0:
-        vbitrate_param = vbitrate_param + ' -maxrate %sk' % hdvideo_max_bitrate
-    if hdvideo_max_bitrate > 0 or hdvideo_min_bitrate > 0:
-        vbitrate_param = vbitrate_param + ' -bufsize %sk' % device_bufsize
+            encoder = encoder_HD
+        # else non-HD encoding (CRF encoding)
+    # apply the encode profile learned for the channel and the overrides set for it
+    estimated_bitrate = video_bitrate
+    fingerprint = None
+    profile = {}
+    if profile_cache:
+        if not probe:
+            secs, probe = get_duration(db, rec, transcoder, tmpfile)
+        fingerprint = stream_fingerprint(probe)
+        profile = channel_profile(chanid, fingerprint)
+        if debug:
+            print('Channel %s profile %s' % (chanid, profile))
+        preset = profile.get('preset', preset)
+        encoder = profile.get('encoder', encoder)
+        if profile.get('bitrate', 0) > 0:
+            video_bitrate = int(profile['bitrate'])
+        elif video_bitrate > 0:
+            video_bitrate = int(video_bitrate*profile.get('bitrate_scale', 1.0))
+        else:
+            video_crf = int(profile.get('crf', video_crf + profile.get('crf_step', 0)))
+    if encoder not in ENCODERS:
+        print('Unknown encoder "%s", using libx264' % encoder)
+        encoder = 'libx264'
+    vbitrate_param = video_rate_param(video_crf, video_bitrate, encoder)
+    # the preset is chosen to finish before the next recordings, unless overridden for the channel
+    deadline = None
+    if deadline_presets and duration_secs*framerate > 0 and 'preset' not in profile:
+        deadline = Deadline(db, chanid, fingerprint, duration_secs*framerate, encoder)
+        preset = deadline.choose(preset)
 
     if debug:
         print('Video bitrate parameter "%s"' % vbitrate_param)
-        print('Video h264 preset parameter "%s"' % preset)
+        print('Video %s preset parameter "%s"' % (encoder, preset))
 
     # Setup transcode audio bitrate and quality parameters
     # Right now, the setup is as follows:
@@ -385,111 +780,304 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
     if debug:
         print('Audio bitrate parameter "%s"' % abitrate_param)
 
+    # select the streams to keep, the audio is encoded in parallel with the video
+    plan = None
+    if stream_plan:
+        if not probe:
+            secs, probe = get_duration(db, rec, transcoder, tmpfile)
+        plan = select_streams(probe)
+        if debug:
+            print('Stream plan %s' % plan)
+    audiofile = '%s.audio.mp4' % tmpfile
+    audio_proc = None
+    if parallel_audio and plan is not None and plan['audio']:
+        audio_output = OutputBuffer()
+        audio_proc = encode_audio(abitrate_param, tmpfile, audiofile, plan, audio_output)
+    # the audio encode is paused, resumed and throttled along with the video encoder
+    companions = [audio_proc] if audio_proc is not None else []
+
     # Transcode to mp4
 #    if jobid:
 #        job.update({'status':4, 'comment':'Transcoding to mp4'})
 
-    # ffmpeg output is redirected to the temporary file tmpstatusfile and
-    # a second thread continuously reads this file while
-    # the transcode is in-process. see while loop below for the monitoring thread
-    tf = tempfile.NamedTemporaryFile()
-    tmpstatusfile = tf.name
-#    tmpstatusfile = '/tmp/ffmpeg-transcode.txt'
-    if debug:
-        print('Using temporary file "%s" for ffmpeg status updates.' % tmpstatusfile)
-    res = []
-    # create a thread to perform the encode
-    ipq = queue.Queue()
-    t = threading.Thread(target=wrapper, args=(encode, 
-                        (jobid, db, job, ipq, preset, vbitrate_param, abitrate_param,
-                         tmpfile, outfile, tmpstatusfile,), res))
-    t.start()
-    # wait for ffmpeg to open the file and emit its initialization information 
-    # before we start the monitoring process
-    time.sleep(1) 
-    # open the temporary file having the ffmeg output text and process it to generate status updates
-    hangiter=0;
-    with open(tmpstatusfile) as f:
-        # read all the opening ffmpeg status/analysis lines
-        lines = f.readlines()
-        # set initial progress to -1
-        prev_progress=-1
-        framenum=0
-        fps=1.0
-        while t.is_alive():
-            # read all output since last readline() call
-            lines = f.readlines()
-            if len(lines) > 0:
-                # every ffmpeg output status line ends with a carriage return '\r'
-                # split the last read line at these locations
-                lines=lines[-1].split('\r')
-#                if debug:
-#                    print lines;
-                hangiter=0
-                if len(lines) > 1 and lines[-2].startswith('frame'):
-                    # since typical reads will have the last line ending with \r the last status
-                    # message is at index=[-2] start processing this line
-                    # replace multiple spaces with one space
-                    lines[-2] = re.sub(' +',' ',lines[-2])
-                    # remove any spaces after equals signs
-                    lines[-2] = re.sub('= +','=',lines[-2])
-                    # split the fields at the spaces the first two fields for typical
-                    # status lines will be framenum=XXXX and fps=YYYY parse the values
-                    values = lines[-2].split(' ')
-                    if len(values) > 1:
-                        if debug:
-                            print('values %s' % values)
-                        prev_framenum = framenum
-                        prev_fps = fps
-                        try:
-                            # framenum = current frame number being encoded
-                            framenum = int(values[0].split('=')[1])
-                            # fps = frames per second for the encoder
-                            fps = float(values[1].split('=')[1])
-                        except ValueError as e:
-                            print('ffmpeg status parse exception: "%s"' % e)
-                            framenum = prev_framenum
-                            fps = prev_fps
-                            pass
-                    # progress = 0-100 represent percent complete for the transcode
-                    progress = int((100*framenum)/(duration_secs*framerate))
-                    # eta_secs = estimated number of seconds until transcoding is complete
-                    eta_secs = int((float(duration_secs*framerate)-framenum)/fps)
-                    # pct_realtime = how many real seconds it takes to encode 1 second of video
-                    pct_realtime = float(fps/framerate) 
-                    if debug:
-                        print('framenum = %d fps = %.2f' % (framenum, fps))                
-                    if progress != prev_progress:
-                        if debug:
-                            print('Progress %d%% encoding %.1f frames per second ETA %d mins' \
-                                  % ( progress, fps, float(eta_secs)/60))
+    # output size budget for the early abort of encodes that are not worth keeping
+    size_budget = 0
+    if abortSizeRatio > 0 and duration_secs > 0:
+        size_budget = int(abortSizeRatio*clipped_filesize)
+    # the stats of the first pass are kept with the recording until the transcode is finished
+    passlogfile = None
+    if two_pass and ENCODERS[encoder]['two_pass']:
+        passlogfile = '%s.pass' % infile.rsplit('.',1)[0]
+    elif two_pass and video_bitrate > 0:
+        print('Encoder %s runs single pass, encoding at an average bitrate of %d kbps' % (encoder, video_bitrate))
+    # with a memory budget the x264 settings are bounded to fit it, and the encode waits
+    # until its predicted memory fits next to the other encodes of this host
+    pixels = fingerprint_pixels(probe) or 1920*1080
+    rss_scale = profile.get('rss_scale', 1.0)*ENCODERS[encoder]['memory_scale']
+    reservation = os.path.basename(partfile)
+    rss_meter = RssMeter()
+    limits = None
+    try:
+        restarts = 0
+        reserved_mb = 0
+        while True:
+            if memory_budget > 0:
+                limits = memory_limits(preset, pixels, memory_budget, rss_scale)
+            # the reservation follows the preset of a restarted encode, the memory of the
+            # exited encoder is given back while the new size waits to fit
+            if limits is not None and limits['rss'] != reserved_mb:
+                print('Encode predicted to need %d MB with rc-lookahead=%d, ref=%d and %d threads' \
+                      % (limits['rss'], limits['rc-lookahead'], limits['ref'], limits['threads']))
+                if reserved_mb > 0:
+                    release_memory(reservation)
+                try:
+                    reserve_memory(jobid, job, reservation, limits['rss'])
+                except JobStopped:
+                    stop_job(jobid, job, tmpfile, partfile)
+                reserved_mb = limits['rss']
+            if passlogfile is not None and video_bitrate > 0:
+                key = first_pass_key(preset, video_bitrate, clipped_filesize, duration_secs, limits)
+                if first_pass_cached(passlogfile, key):
+                    print('Reusing the first pass of an earlier run of the job.')
+                else:
+                    if jobid:
+                        job.update({'status':job.RUNNING, 'comment':'Analysis pass of a two-pass encode at %dkbps' \
+                                    % video_bitrate})
+                    try:
+                        returncode, output = run_controlled(jobid, job, gov, meter,
+                                                            first_pass_args(preset, vbitrate_param, tmpfile,
+                                                                            passlogfile, limits, encoder),
+                                                            supervisor)
+                    except JobStopped:
+                        stop_job(jobid, job, tmpfile, partfile)
+                    if returncode != 0:
+                        print('Command failed with output:\n%s' % output.text())
                         if jobid:
-                            progress_str = 'Transcoding to mp4 %d%% complete ETA %d mins fps=%.1f.' \
-                                  % ( progress, float(eta_secs)/60, fps)
-                            job.update({'status':job.RUNNING, 'comment': progress_str})
-                        prev_progress = progress
-                elif len(lines) > 1:
-                    if debug:
-                        print('Read pathological output %s' % lines[-2])
-            else:
+                            job.update({'status':job.ERRORED,
+                                        'comment':failure_comment('Analysis pass failed', output)})
+                        sys.exit(returncode)
+                    save_json('%s.json' % passlogfile, key)
+            encode_began = time.time()
+            if supervisor is not None:
+                # the encoder is spawned and monitored by the event loop of the supervisor
+                state = SupervisedEncode(jobid, duration_secs, framerate, size_budget, gov, meter,
+                                         partfile, deadline, rss_meter, companions)
+                cmd = ' '.join(encode_args(preset, vbitrate_param, abitrate_param, tmpfile, partfile,
+                                           duration_secs, plan, audio_proc is not None,
+                                           passlogfile if video_bitrate > 0 else None, limits, encoder))
                 if debug:
-                    print('Read no lines of ffmpeg output for %s secs. Possible hang?' % (POLL_INTERVAL*hangiter))
-                hangiter = hangiter + 1
+                    print('Encoder command "%s"' % cmd)
+                returncode = supervisor.run_process(state, cmd)
+                if state.stopped:
+                    stop_job(jobid, job, tmpfile, partfile)
+                projected_size = state.projected_size
+                output = state.output
+                paused_secs = state.paused_secs
+            else:
+                # ffmpeg output is captured into the bounded OutputBuffer output by a reader
+                # thread and the encoder process is monitored from its latest status line while
+                # the transcode is in-process. see monitor_encode() for the monitoring loop
+                output = OutputBuffer()
+                proc = encode(preset, vbitrate_param, abitrate_param, tmpfile, partfile, output, duration_secs,
+                              plan, audio_proc is not None, passlogfile if video_bitrate > 0 else None, limits,
+                              encoder)
+                proc.companions = companions
+                try:
+                    projected_size = monitor_encode(jobid, job, proc, output,
+                                                    duration_secs, framerate, size_budget, gov, meter,
+                                                    partfile, deadline, rss_meter)
+                except JobStopped:
+                    stop_job(jobid, job, tmpfile, partfile)
+                output.wait()
+                returncode = proc.returncode
+                paused_secs = getattr(proc, 'paused_secs', 0)
+            if deadline is not None and deadline.restart is not None:
+                # the encode would have run into the next recordings, restart it faster
+                preset, deadline.restart = deadline.restart, None
                 if jobid:
-                    progress_str = 'Read no lines of ffmpeg output for %s secs. Possible hang?' % (POLL_INTERVAL*hangiter)
-                    job.update({'status':job.RUNNING, 'comment': progress_str})
-            time.sleep(POLL_INTERVAL)
-        if debug:
-            print('res = "%s"' % res)
+                    job.update({'status':job.RUNNING,
+                                'comment':'Encode would not finish before the next recordings, restarting with preset %s' \
+                                % preset})
+                continue
+            if projected_size == 0:
+                break
+            # the encode was aborted, restart it with a stronger setting if allowed
+            if restarts >= abortRestarts:
+                print('Transcode aborted, projected output size %d MB exceeds the budget of %d MB.' \
+                      % (projected_size/(1024*1024), size_budget/(1024*1024)))
+                if jobid:
+                    job.update({'status':job.ERRORED,
+                                'comment':'Transcode aborted, projected output size %d MB exceeds the budget of %d MB' \
+                                % (projected_size/(1024*1024), size_budget/(1024*1024))})
+                sys.exit(1)
+            restarts = restarts + 1
+            if video_bitrate > 0:
+                # scale the bitrate to fit the budget with 10% headroom
+                video_bitrate = int(0.9*video_bitrate*size_budget/projected_size)
+            else:
+                video_crf = video_crf + abortCrfStep
+            vbitrate_param = video_rate_param(video_crf, video_bitrate, encoder)
+            if debug:
+                print('Restarting encode with video bitrate parameter "%s"' % vbitrate_param)
+            if jobid:
+                job.update({'status':job.RUNNING,
+                            'comment':'Projected output size %d MB exceeded the budget, restarting with "%s"' \
+                            % (projected_size/(1024*1024), vbitrate_param)})
 
-    t.join(1)
-    try:
-        if ipq.get_nowait() == CleanExit:
-            sys.exit()
-    except queue.Empty:
-        pass
+        # the time the job was paused from the frontend or mythweb is not encode time
+        encode_secs = time.time() - encode_began - paused_secs
+        if memory_budget > 0:
+            release_memory(reservation)
+        if rss_meter.peak > 0:
+            print('Peak encoder memory %d MB%s' \
+                  % (rss_meter.peak, ' (predicted %d MB)' % limits['rss'] if limits else ''))
+        if returncode != 0:
+            print('Command failed with output:\n%s' % output.text())
+            if jobid:
+                job.update({'status':job.ERRORED, 'comment':failure_comment('Transcoding to mp4 failed', output)})
+            sys.exit(returncode)
+        # the video stream of the second pass is checked against its target, the muxed
+        # video is a stream copy of it. A miss is noted in the comment of the finished job
+        rate_str = ''
+        if passlogfile is not None and video_bitrate > 0 and duration_secs > 0:
+            video_kbps = encoded_video_kbytes(output)*8.0/duration_secs
+            if video_kbps > 0:
+                missed = video_kbps/video_bitrate - 1
+                print('Two-pass encode %d kbps for a target of %d kbps (%+.1f%%)%s' \
+                      % (video_kbps, video_bitrate, 100*missed,
+                         ', missing the target' if abs(missed) > TWO_PASS_TOLERANCE else ''))
+                if abs(missed) > TWO_PASS_TOLERANCE:
+                    rate_str = ', two-pass missed the %d kbps target by %+.1f%%' % (video_bitrate, 100*missed)
 
-    if flush_commskip:
+        # mux the video with the audio encoded in parallel
+        if audio_proc is not None:
+            if jobid:
+                job.update({'status':job.RUNNING, 'comment':'Muxing audio and video'})
+            # the rest of the audio encode runs under job control and the governor
+            if supervisor is not None:
+                state = SupervisedProcess(jobid, gov, meter)
+                state.proc = audio_proc
+                supervisor.run_wait(state)
+                if state.stopped:
+                    stop_job(jobid, job, tmpfile, partfile)
+            while audio_proc.poll() is None:
+                if gov is not None:
+                    gov.update(jobid, job, audio_proc)
+                try:
+                    sleep_job_control(jobid, job, audio_proc)
+                except JobStopped:
+                    stop_job(jobid, job, tmpfile, partfile)
+            audio_output.wait()
+            if audio_proc.returncode == 0:
+                try:
+                    returncode, output = run_controlled(jobid, job, gov, meter,
+                                                        cache_policy_args() +
+                                                        mux_args(partfile, audiofile, '%s.mux.mp4' % partfile),
+                                                        supervisor)
+                except JobStopped:
+                    stop_job(jobid, job, tmpfile, partfile)
+            else:
+                returncode, output = audio_proc.returncode, audio_output
+            if returncode != 0:
+                print('Command failed with output:\n%s' % output.text())
+                if jobid:
+                    job.update({'status':job.ERRORED, 'comment':failure_comment('Muxing audio and video failed', output)})
+                sys.exit(returncode)
+            os.replace('%s.mux.mp4' % partfile, partfile)
+            os.remove(audiofile)
+    except BaseException:
+        # the job is leaving, the audio encode and the temporary files are not needed anymore
+        if memory_budget > 0:
+            release_memory(reservation)
+        if audio_proc is not None:
+            stop_process(audio_proc)
+        remove_tmpfiles(tmpfile, partfile, passlogfile)
+        raise
+
+    # the original recording is only deleted once the transcode decodes
+    if verify_windows > 0:
+        if jobid:
+            job.update({'status':job.RUNNING, 'comment':'Verifying the transcode'})
+        error = verify_transcode(partfile, duration_secs, plan, probe)
+        if error is not None:
+            print('Verification of the transcode failed: %s' % error)
+            if jobid:
+                job.update({'status':job.ERRORED,
+                            'comment':('Verification of the transcode failed: %s' % error)[:JOB_COMMENT_SIZE]})
+            remove_tmpfiles(tmpfile, partfile, passlogfile)
+            sys.exit(1)
+
+    # the commercials flagged while the recording was encoded are cut from the encode at its keyframes,
+    # the uncut encode is only replaced once the cut passed the verification
+    out_secs = duration_secs
+    cut = False
+    encoded_filesize = os.path.getsize(partfile)
+    if cut_after_encode:
+        flagged = True
+        try:
+            if commflag_proc is not None:
+                if jobid:
+                    job.update({'status':job.RUNNING, 'comment':'Waiting for the commercial flagging to complete'})
+                while commflag_proc.poll() is None:
+                    sleep_job_control(jobid, job, commflag_proc)
+            else:
+                flagged = wait_for_commflag(db, jobid, job, chanid, starttime_datetime, True, COMMFLAG_WAIT_TIMEOUT)
+        except JobStopped:
+            stop_job(jobid, job, tmpfile, partfile, passlogfile)
+        returncode = 0
+        if not flagged:
+            print('Commercial flagging did not complete within %d secs, the transcode is not cut.' \
+                  % COMMFLAG_WAIT_TIMEOUT)
+        elif generate_commcutlist:
+            returncode, output = generate_cutlist(db, jobid, job, chanid, starttime)
+        segments = cut_segments(rec, duration_secs, framerate, cut_offset) if flagged and returncode == 0 else None
+        if segments == []:
+            print('The cutlist removes the whole recording, the transcode is not cut.')
+        elif segments is not None:
+            if jobid:
+                job.update({'status':job.RUNNING, 'comment':'Cutting the transcode to %d secs in %d parts' \
+                            % (kept_secs(segments, duration_secs), len(segments))})
+            check = None
+            if verify_windows > 0:
+                check = functools.partial(verify_transcode, duration_secs=kept_secs(segments, duration_secs),
+                                          plan=plan, probe=probe)
+            try:
+                for filename in [partfile] + [rendition_file(partfile, rendition) for rendition in renditions]:
+                    returncode, output = cut_encode(jobid, job, gov, meter, filename, segments,
+                                                    check if filename == partfile else None, supervisor)
+                    if returncode != 0:
+                        break
+            except JobStopped:
+                stop_job(jobid, job, tmpfile, partfile, passlogfile)
+            if returncode != 0:
+                # the cut can be applied later by running the job on the transcoded recording
+                print('Cutting the transcode failed, keeping it uncut:\n%s' % output.text())
+            else:
+                out_secs = kept_secs(segments, duration_secs)
+                cut = True
+                print('Cut the transcode from %d to %d secs in %d parts' % (duration_secs, out_secs, len(segments)))
+
+    # a worker of the shared work queue only replaces the recording while it holds the lease
+    if lease is not None and not lease.held():
+        print('Lease on the recording was taken over by another worker, discarding the transcode.')
+        remove_tmpfiles(tmpfile, partfile, passlogfile)
+        sys.exit(1)
+    os.rename(partfile, outfile)
+    for suffix in side_output_suffixes():
+        if os.path.exists(partfile + suffix):
+            os.rename(partfile + suffix, outfile + suffix)
+            # mythtv regenerates previews older than the recording file
+            os.utime(outfile + suffix)
+    for rendition in renditions:
+        install_rendition(db, rec, rendition_file(partfile, rendition),
+                          rendition_file(outfile, rendition), out_secs)
+
+    # a cutlist not yet applied to the transcode is kept for cutting it later
+    if cut:
+        clear_cutlist(rec)
+        rec.commflagged = 0
+    flush_commskip_marks = flush_commskip and (cut or not cut_after_encode)
+    if flush_commskip_marks:
         task = System(path='mythutil')
         task.command('--chanid %s' % chanid,
                      '--starttime %s' % starttime,
@@ -501,7 +1089,7 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
                      '--clearskiplist',
                      '2> /dev/null')
 
-    if flush_commskip:
+    if flush_commskip_marks:
         for index,mark in reversed(list(enumerate(rec.markup))):
             if mark.type in (rec.markup.MARK_COMM_START, rec.markup.MARK_COMM_END):
                 del rec.markup[index]
@@ -511,6 +1099,9 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
 
 #    tf.close();
 #    os.remove(tmpstatusfile);
+    # the encoded output is not read again soon, keep it out of the page cache
+    drop_file_cache(outfile)
+    meter.update()
     rec.basename = os.path.basename(outfile)
     rec.filesize = os.path.getsize(outfile)
 #    rec.commflagged = 0
@@ -522,29 +1113,72 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
     # Cleanup the old *.png files
     for filename in glob('%s*.png' % infile):
         os.remove(filename)
-    os.remove(tmpfile)
-    try:
-        os.remove('%s.map' % tmpfile)
-    except OSError:
-        pass
+    remove_tmpfiles(tmpfile, None, passlogfile)
 
     output_filesize = rec.filesize
-    if duration_secs > 0:
-        output_bitrate = int(output_filesize*8/(1024*duration_secs)) # kbps
-    actual_compression_ratio = 1 - float(output_filesize)/clipped_filesize
+    output_bitrate = 0
+    if out_secs > 0:
+        output_bitrate = int(output_filesize*8/(1024*out_secs)) # kbps
+    # the compression of the transcoder is measured before the commercials were cut from the encode
+    actual_compression_ratio = 1 - float(output_filesize if not cut else encoded_filesize)/clipped_filesize
     compressed_pct = 1 - float(output_filesize)/input_filesize
 
+    # the settings the encode ended with are kept for the next recording of the channel
+    if fingerprint is not None:
+        learned = {'ratio':actual_compression_ratio, 'kbps':output_bitrate}
+        # the throughput of the preset predicts the encode time of the next recordings,
+        # encodes that yielded to recordings or load would underestimate it
+        if duration_secs*framerate > 0 and (gov is None or gov.throttled_secs == 0):
+            learned['fps'] = {fps_key(encoder, preset):duration_secs*framerate/max(1.0, encode_secs)}
+        # the peak memory corrects the memory predicted for the next recordings
+        if rss_meter.peak > 0:
+            used = limits or memory_limits(preset, pixels)
+            learned['peak_mb'] = rss_meter.peak
+            learned['rss_scale'] = rss_meter.peak/predict_rss(pixels, used['rc-lookahead'], used['threads'], used['ref'],
+                                                              ENCODERS[encoder]['memory_scale'])
+        if video_bitrate > 0 and estimated_bitrate > 0 and 'bitrate' not in profile:
+            learned['bitrate_scale'] = float(video_bitrate)/estimated_bitrate
+        elif video_bitrate == 0 and 'crf' not in profile:
+            # an encode that fit without a restart relaxes the step learned from the
+            # restarts of earlier recordings by one
+            learned['crf_step'] = max(0, video_crf - int(crf) - (1 if restarts == 0 else 0))
+        learn_profile(chanid, fingerprint, learned)
+
     if build_seektable:
-        if jobid:
-            job.update({'status':job.RUNNING, 'comment':'Rebuilding seektable'})
-        task = System(path='mythcommflag')
-        task.command('--chanid %s' % chanid,
-                     '--starttime %s' % starttime,
-                     '--rebuild',
-                     '2> /dev/null')
+        rebuild_seektable(jobid, job, chanid, starttime)
 
     # fix during in the recorded markup table this will be off if commercials are removed
-    duration_msecs, e = get_duration(db, rec, transcoder, outfile)
+    fix_duration_markup(db, rec, outfile)
+
+    throttle_str = ''
+    if gov is not None and gov.throttled_secs > 0:
+        throttle_str = ', throttled %d mins (paused %d mins) for recordings/load%s' \
+                       % (gov.throttled_secs/60, gov.paused_secs/60,
+                          '/transcode windows' if transcode_windows else '')
+    if debug and throttle_str:
+        print('Encode%s' % throttle_str)
+    cut_str = ''
+    if cut:
+        cut_str = ', commercials cut from %d to %d mins' % (duration_secs/60, out_secs/60)
+    print('Page cache grew by at most %d MB during the transcode' % (meter.growth()/(1024*1024)))
+    if jobid:
+        if output_bitrate:
+            job.update({'status':job.FINISHED, 'comment':'Transcode Completed @ %dkbps, compressed file by %d%% (clipped %d%%, transcoder compressed %d%%)%s%s%s' % (output_bitrate,int(compressed_pct*100),int(clipped_compress_pct*100),int(actual_compression_ratio*100),cut_str,rate_str,throttle_str)})
+        else:
+            job.update({'status':job.FINISHED, 'comment':'Transcode Completed%s%s%s' % (cut_str, rate_str, throttle_str)})
+
+def rebuild_seektable(jobid=None, job=None, chanid=None, starttime=None):
+    if jobid:
+        job.update({'status':job.RUNNING, 'comment':'Rebuilding seektable'})
+    task = System(path='mythcommflag')
+    task.command('--chanid %s' % chanid,
+                 '--starttime %s' % starttime,
+                 '--rebuild',
+                 '2> /dev/null')
+
+def fix_duration_markup(db=None, rec=None, filename=None):
+    # set the duration markup of rec to the duration of its file filename
+    duration_msecs, e = get_duration(db, rec, transcoder, filename)
     duration_msecs = 1000*duration_msecs
     for index,mark in reversed(list(enumerate(rec.markup))):
         # find the duration markup entry and correct any error in the video duration that might be there
@@ -560,24 +1194,20 @@ def runjob(jobid=None, chanid=None, starttime=None, tzoffset=None):
                 #rec.cutlist = 0
                 rec.markup.commit()
 
-    if jobid:
-        if output_bitrate:
-            job.update({'status':job.FINISHED, 'comment':'Transcode Completed @ %dkbps, compressed file by %d%% (clipped %d%%, transcoder compressed %d%%)' % (output_bitrate,int(compressed_pct*100),int(clipped_compress_pct*100),int(actual_compression_ratio*100))})
-        else:
-            job.update({'status':job.FINISHED, 'comment':'Transcode Completed'})
-
 def get_duration(db=None, rec=None, transcoder='/usr/bin/ffmpeg', filename=None):
-    task = System(path=transcoder, db=db)
+    # duration of filename in secs (-1 if unknown) and the bounded text of the
+    # ffmpeg probe output holding its stream information
     if filename is None:
-        return -1
-    try:
-        output = task('-i "%s"' % filename, '1>&2')
-    except MythError as e:
-        err = e
-        pass
+        return -1, ''
+    proc = subprocess.Popen([transcoder, '-i', filename], stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = OutputBuffer()
+    output.read(proc.stderr)
+    proc.wait()
+    err = output.text()
 
     r = re.compile('Duration: (.*?), start')
-    m = r.search(err.stderr.decode('utf-8'))
+    m = r.search(err)
     if m:
         duration = m.group(1).split(':')
         duration_secs = float((int(duration[0])*60+int(duration[1]))*60+float(duration[2]))
@@ -590,72 +1220,2564 @@ def get_duration(db=None, rec=None, transcoder='/usr/bin/ffmpeg', filename=None)
         return duration_secs, err
     return -1, err
 
-def encode(jobid=None, db=None, job=None, 
-           procqueue=None, preset='slow', 
+def video_rate_param(video_crf=21, video_bitrate=0, encoder='libx264'):
+    # ffmpeg video rate control parameters, video_bitrate > 0 (kbps) selects
+    # a target bitrate encode, otherwise a constant rate factor encode at the
+    # crf of the encoder equivalent to the x264 crf video_crf
+    if video_bitrate > 0:
+        vbitrate_param = '-b:v %dk' % video_bitrate
+    else:
+        vbitrate_param = '-crf:v %s' % (int(video_crf) + ENCODERS[encoder]['crf_offset'])
+    if hdvideo_min_bitrate > 0:
+        vbitrate_param = vbitrate_param + ' -minrate %sk' % hdvideo_min_bitrate
+    if hdvideo_max_bitrate > 0:
+        vbitrate_param = vbitrate_param + ' -maxrate %sk' % hdvideo_max_bitrate
+    if hdvideo_max_bitrate > 0 or hdvideo_min_bitrate > 0:
+        vbitrate_param = vbitrate_param + ' -bufsize %sk' % device_bufsize
+    return vbitrate_param
+
+def encode_args(preset='slow',
+                vbitrate_param='-crf:v 18',
+                abitrate_param='-c:a libfdk_aac -b:a 128k',
+                tmpfile=None, outfile=None, duration_secs=0, plan=None, separate_audio=False,
+                passlogfile=None, limits=None, encoder='libx264'):
+    # ffmpeg arguments of the transcode to outfile. With a stream plan only its streams are
+    # mapped, with separate_audio the audio is left to encode_audio() and mux_args(). With
+    # a passlogfile the video is the second pass using the stats of first_pass_args(). The
+    # video is encoded by the backend encoder of ENCODERS, with the memory limits of
+    # memory_limits() bounding its lookahead, references and threads.
+    args = cache_policy_args() + [
+            'nice',
+            '-n %s' % NICELEVEL,
+            '%s' % transcoder,
+            '-i "%s"' % tmpfile,
+            # parameter to overwrite output file if present without prompt
+            '-y',
+            # parameter to set the interval between status lines
+            '-stats_period %s' % ffmpeg_stats_period if ffmpeg_stats_period > 0 else '',
+            # parameter de-interlacing filter, split for the renditions and side outputs, and the stream maps
+            video_filter_args(plan, separate_audio, side_outputs(duration_secs)),
+            # parameter to allow streaming content (applied by the final mux with separate audio)
+            '-movflags faststart' if not separate_audio else '',
+            # parameter needed when hdhomerun prime mpeg2 files sometime repeat timestamps
+            '-vsync passthrough',
+            # video codec with its preset that effect encode speed/output filesize, and the
+            # parameters bounding its memory and threads
+            video_codec_args(encoder, preset, limits),
+            # ##########  IMPORTANT  ############
+            # ffmpeg versions after 08-18-2015 include a change to force explicit IDR frames, 
+            # setting this flag helps/corrects myth seektable indexing h264-encoded files
+            # uncomment the  line below if you have a recent version of ffmpeg that supports this option
+#            '-forced-idr 1',
+            # parameters to determine video encode target bitrate
+            vbitrate_param,
+            # parameter forcing the keyframes the encode is cut at later
+            keyframe_args(),
+            # parameters of the second pass of a two-pass encode
+            '-pass 2 -passlogfile "%s"' % passlogfile if passlogfile else '',
+            # parameters to determine audio encode target bitrate
+            abitrate_param if not separate_audio else '',
+            # parameter to encode all input audio streams into the output
+#            '-map 0:a',
+            # parameters to set the first output audio stream 
+            # to be an audio stream having the specified language (default=eng -> English)
+#            '-metadata:s:a:0',
+#            'language=%s' % language,
+            # parameter to copy input subtitle streams into the output,
+            # the text subtitles of a stream plan are converted
+            '-c:s copy' if plan is None else '-c:s mov_text',
+#           '-c:s mov_text',
+            # parameters to set the first output subtitle stream 
+            # to be an english subtitle stream
+#            '-metadata:s:s:0',
+#            'language=%s' % language,
+            # we can control the number of encode threads
+            '-threads %d' % (limits['threads'] if limits else encode_threads),
+            # output file parameter
+            '"%s"' % outfile]
+    # the renditions are encoded from the branches of the split de-interlaced video
+    for index, rendition in enumerate(renditions):
+        args = args + ['-map "[v%d]"' % (index + 1),
+                       '-map 0:%d' % plan['audio'][0] if plan is not None and plan['audio'] else '-map "0:a:0?"',
+                       '-movflags faststart',
+                       '-vsync passthrough',
+                       '-c:v libx264',
+                       '-preset:v %s' % rendition.get('preset', preset),
+                       rendition_rate_param(rendition),
+                       keyframe_args(),
+                       rendition.get('audio', abitrate_param),
+                       '"%s"' % rendition_file(outfile, rendition)]
+    # the previews and the storyboard are further outputs fed by the de-interlaced video
+    for index, (suffix, filtergraph) in enumerate(side_outputs(duration_secs)):
+        args = args + ['-map "[p%d]"' % index, '-an', '-sn',
+                       '-frames:v 1', '-update 1',
+                       '"%s%s"' % (outfile, suffix)]
+    return args
+
+def video_codec_args(encoder='libx264', preset='slow', limits=None, params=''):
+    # the options of the encoder backend for the speed tier preset (an x264 preset name),
+    # the thread budget and the memory limits of memory_limits(). params are further
+    # encoder parameters that take precedence over the limits
+    backend = ENCODERS[encoder]
+    threads = limits['threads'] if limits else encode_threads
+    values = []
+    if limits:
+        values.append('%s=%d' % (backend['lookahead'], limits['rc-lookahead']))
+        if backend['ref']:
+            values.append('%s=%d' % (backend['ref'], limits['ref']))
+    if backend['threads'] and threads > 0:
+        values.append('%s=%d' % (backend['threads'], threads))
+    if params:
+        values.append(params)
+    args = ['-c:v %s' % encoder,
+            '-preset:v %s' % backend['presets'].get(preset, preset),
+            '%s %s' % (backend['params'], ':'.join(values)) if values else '',
+            backend['args']]
+    return ' '.join([arg for arg in args if arg])
+
+def keyframe_args():
+    # with cut_after_encode a keyframe every CUT_KEYFRAME_SECS, the points cut_segments() snaps to
+    if not cut_after_encode:
+        return ''
+    return '-force_key_frames "expr:gte(t,n_forced*%d)"' % CUT_KEYFRAME_SECS
+
+def video_filter_args(plan=None, separate_audio=False, side=[]):
+    # the video is de-interlaced once. With renditions or side outputs the de-interlaced
+    # video is split into the archive branch [v0], a branch [vN] scaled down for each
+    # rendition and a branch [pN] through the filtergraph of each side output in side.
+    # The archive maps the streams of the plan, without a plan ffmpeg picks its audio
+    # and subtitle streams unless the branches require explicit maps.
+    if renditions or side:
+        graph = '[0:v:0]%s,split=%d[v0]%s%s' \
+                % (deinterlace_filter, len(renditions) + len(side) + 1,
+                   ''.join(['[s%d]' % (index + 1) for index in range(len(renditions))]),
+                   ''.join(['[q%d]' % index for index in range(len(side))]))
+        for index, rendition in enumerate(renditions):
+            graph = graph + ";[s%d]scale=-2:'min(ih,%d)'[v%d]" % (index + 1, rendition['height'], index + 1)
+        for index, (suffix, filtergraph) in enumerate(side):
+            graph = graph + ';[q%d]%s[p%d]' % (index, filtergraph, index)
+        args = '-filter_complex "%s" -map "[v0]"' % graph
+    elif plan is not None:
+        args = '-filter:v %s -map 0:v:0' % deinterlace_filter
+    else:
+        return '-filter:v %s' % deinterlace_filter
+    if plan is None:
+        return args + ' -map "0:a:0?" -map "0:s:0?"'
+    if not separate_audio:
+        args = args + ''.join([' -map 0:%d' % index for index in plan['audio']])
+    return args + ''.join([' -map 0:%d' % index for index in plan['subtitle']])
+
+def select_streams(probe=''):
+    # the audio and subtitle streams of the input to keep, selected by language from the
+    # ffmpeg probe output, as {'audio':[index, ...], 'subtitle':[index, ...]}
+    plan = {'audio':[], 'subtitle':[]}
+    first_audio = None
+    r = re.compile('Stream #0:([0-9]+)[^:(\n]*(?:\\(([a-z]+)\\))?[^:\n]*: (Audio|Subtitle): ([a-z0-9_]+)(.*)')
+    for m in r.finditer(probe):
+        index = int(m.group(1))
+        language = m.group(2)
+        if m.group(3) == 'Audio':
+            if first_audio is None:
+                first_audio = index
+            # audio descriptions are tagged with the language of the program
+            if language in audio_languages and 'visual impaired' not in m.group(5):
+                plan['audio'].append(index)
+        elif language in subtitle_languages and m.group(4) in ('subrip', 'ass', 'ssa', 'mov_text', 'text', 'webvtt'):
+            plan['subtitle'].append(index)
+    if not plan['audio'] and first_audio is not None:
+        plan['audio'].append(first_audio)
+    return plan
+
+def first_pass_args(preset='slow', vbitrate_param='-b:v 5000k', tmpfile=None, passlogfile=None, limits=None,
+                    encoder='libx264'):
+    # ffmpeg arguments of the analysis pass of a two-pass encode, it sees the same de-interlaced
+    # frames as the second pass and writes only the encoder stats to passlogfile. libx264 runs
+    # the pass with its reduced fast first pass analysis (-fastfirstpass, on by default).
+    return cache_policy_args() + [
+            'nice',
+            '-n %s' % NICELEVEL,
+            '%s' % transcoder,
+            '-i "%s"' % tmpfile,
+            '-y',
+            '-stats_period %s' % ffmpeg_stats_period if ffmpeg_stats_period > 0 else '',
+            '-filter:v %s' % deinterlace_filter,
+            '-map 0:v:0', '-an', '-sn', '-dn',
+            '-vsync passthrough',
+            video_codec_args(encoder, preset, limits),
+            vbitrate_param,
+            keyframe_args(),
+            '-pass 1 -passlogfile "%s"' % passlogfile,
+            '-threads %d' % (limits['threads'] if limits else encode_threads),
+            '-f null', '/dev/null']
+
+def first_pass_key(preset='slow', video_bitrate=0, clipped_filesize=0, duration_secs=0, limits=None):
+    # what the stats of a first pass depend on, a retry reuses stats with the same key
+    return {'preset':preset, 'bitrate':video_bitrate, 'filter':deinterlace_filter,
+            'filesize':clipped_filesize, 'duration':duration_secs,
+            'lookahead':limits['rc-lookahead'] if limits else None}
+
+def first_pass_cached(passlogfile=None, key={}):
+    try:
+        with open('%s.json' % passlogfile) as f:
+            return json.load(f) == key and os.path.exists('%s-0.log' % passlogfile)
+    except (OSError, ValueError):
+        return False
+
+def encoded_video_kbytes(output=None):
+    # size (kB) of the video stream in the statistics ffmpeg prints for its first output
+    # once it is done, 0 if the output has none
+    m = re.search('video: *([0-9]+) *[kK]i?B', output.text())
+    return int(m.group(1)) if m else 0
+
+def remove_first_pass(passlogfile=None):
+    for filename in glob('%s-0.log*' % passlogfile) + ['%s.json' % passlogfile]:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+def audio_args(abitrate_param='-c:a libfdk_aac -b:a 128k', tmpfile=None, audiofile=None, plan=None):
+    # ffmpeg arguments encoding (or copying) only the audio streams of the plan
+    return cache_policy_args() + ['nice', '-n %s' % NICELEVEL, transcoder, '-i "%s"' % tmpfile, '-y',
+                                  '-vn', '-sn', '-dn'] \
+           + ['-map 0:%d' % index for index in plan['audio']] \
+           + [abitrate_param, '"%s"' % audiofile]
+
+def mux_args(videofile=None, audiofile=None, outfile=None):
+    # ffmpeg arguments muxing the video (and subtitles) of videofile with the audio of audiofile
+    return [transcoder, '-i "%s"' % videofile, '-i "%s"' % audiofile, '-y',
+            '-map 0:v', '-map 1:a', '-map "0:s?"', '-c copy', '-movflags faststart', '"%s"' % outfile]
+
+def rendition_rate_param(rendition={}):
+    # video rate parameters of a rendition, bitrate (kbps) or constant rate factor
+    if rendition.get('bitrate', 0) > 0:
+        return '-b:v %dk' % rendition['bitrate']
+    return '-crf:v %s' % rendition.get('crf', crf)
+
+def rendition_file(outfile=None, rendition={}):
+    # file of a rendition written next to outfile
+    return '%s.%s.mp4' % (os.path.splitext(outfile)[0], rendition['name'])
+
+def renditions_comment(outfile=None, duration_secs=0, out_secs=0):
+    # bytes written so far for each rendition of the encode to outfile, with the
+    # final size projected from them once it is known
+    comment = ''
+    for rendition in renditions:
+        try:
+            size = os.path.getsize(rendition_file(outfile, rendition))
+        except OSError:
+            continue
+        comment = comment + ' %s %d MB' % (rendition['name'], size/(1024*1024))
+        projected_size = project_size(size, out_secs, duration_secs)
+        if projected_size > 0:
+            comment = comment + ' of ~%d MB' % (projected_size/(1024*1024))
+    return comment
+
+def install_rendition(db=None, rec=None, partfile=None, filename=None, duration_secs=0):
+    # move a finished rendition to its place and optionally into the mythvideo library
+    if not os.path.exists(partfile):
+        print('Rendition "%s" was not written.' % filename)
+        return
+    os.rename(partfile, filename)
+    size = os.path.getsize(filename)
+    if duration_secs > 0:
+        print('Rendition "%s" %d MB @ %dkbps' % (filename, size/(1024*1024), size*8/(1024*duration_secs)))
+    if not rendition_videos_dir:
+        return
+    videofile = os.path.join(rendition_videos_dir, os.path.basename(filename))
+    try:
+        os.rename(filename, videofile)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        stream_copy(filename, videofile)
+        os.remove(filename)
+    try:
+        Video(db=db).create({'title':rec.title, 'subtitle':rec.subtitle, 'plot':rec.description,
+                             'season':rec.season, 'episode':rec.episode, 'inetref':rec.inetref,
+                             'length':int(duration_secs/60), 'filename':os.path.basename(videofile),
+                             'host':db.gethostname()})
+    except MythError as e:
+        print('Unable to add "%s" to the video library: %s' % (videofile, e))
+
+def side_output_suffixes():
+    # filename suffixes of every side output side_outputs() can write, whatever the duration
+    suffixes = ['.png' if index == 0 else '.%d.png' % offset for index, offset in enumerate(preview_offsets)]
+    if storyboard_tiles:
+        suffixes.append('.storyboard.jpg')
+    return suffixes
+
+def side_outputs(duration_secs=0):
+    # the preview images and the storyboard written by the encoder next to its output,
+    # as (filename suffix, video filtergraph) pairs. Previews past the end of a recording
+    # of known duration are taken from its middle, the storyboard needs the duration.
+    outputs = []
+    for suffix, offset in zip(side_output_suffixes(), preview_offsets):
+        if duration_secs > 0 and offset >= duration_secs:
+            offset = duration_secs/2
+        # the first frame at offset secs is selected and scaled to square pixels
+        outputs.append((suffix, "select='isnan(prev_selected_t)*gte(t-start_t,%s)',"
+                                "scale=iw*sar:ih,scale=%d:-2,setsar=1" % (offset, preview_width)))
+    if storyboard_tiles:
+        cols, rows = [int(n) for n in storyboard_tiles.split('x')]
+        if duration_secs > 0:
+            outputs.append(('.storyboard.jpg', 'fps=%d/%d,scale=iw*sar:ih,scale=%d:-2,setsar=1,tile=%s'
+                                               % (cols*rows, int(duration_secs) + 1,
+                                                  storyboard_width, storyboard_tiles)))
+    return outputs
+
+def encode(preset='slow',
            vbitrate_param='-crf:v 18',
            abitrate_param='-c:a libfdk_aac -b:a 128k',
-           tmpfile=None, outfile=None, statusfile=None):
-#    task = System(path=transcoder, db=db)
-    task = System(path='nice', db=db)
+           tmpfile=None, outfile=None, output=None, duration_secs=0, plan=None, separate_audio=False,
+           passlogfile=None, limits=None, encoder='libx264'):
+    # start the encoder in its own process group so it can be signalled as a whole,
+    # its output is captured into the OutputBuffer output for monitor_encode()
+    cmd = ' '.join(encode_args(preset, vbitrate_param, abitrate_param, tmpfile, outfile, duration_secs,
+                               plan, separate_audio, passlogfile, limits, encoder))
+    if debug:
+        print('Encoder command "%s"' % cmd)
+    return start_process(cmd, output)
+
+def encode_audio(abitrate_param='-c:a libfdk_aac -b:a 128k', tmpfile=None, audiofile=None, plan=None,
+                 output=None):
+    # start the encode of the audio streams of the plan into audiofile, it runs in parallel
+    # with the video encode
+    cmd = ' '.join(audio_args(abitrate_param, tmpfile, audiofile, plan))
+    if debug:
+        print('Audio encoder command "%s"' % cmd)
+    return start_process(cmd, output)
+
+def start_process(cmd=None, output=None):
+    # start cmd in its own process group, its output is captured into the OutputBuffer output
+    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+    output.follow(proc.stdout)
+    return proc
+
+class OutputBuffer:
+    # Bounded in-memory capture of the output of ffmpeg or another tool. The first
+    # OUTPUT_HEAD_SIZE bytes of lines (banner and stream information) and the last
+    # OUTPUT_TAIL_SIZE bytes of lines are kept, ffmpeg status lines only replace the
+    # latest status line, so memory use does not grow with the length of the recording.
+    def __init__(self, head_size=None, tail_size=None):
+        self.head_size = OUTPUT_HEAD_SIZE if head_size is None else head_size
+        self.tail_size = OUTPUT_TAIL_SIZE if tail_size is None else tail_size
+        self.head = []
+        self.head_bytes = 0
+        self.tail = collections.deque()
+        self.tail_bytes = 0
+        self.dropped = 0
+        # latest ffmpeg status line and the unterminated rest of the output
+        self.status = None
+        self.partial = ''
+        # characters of output seen so far, a change tells the output is progressing
+        self.seen = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def write(self, data=b''):
+        # add a chunk of output and return the complete lines it ended
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        with self.lock:
+            self.seen = self.seen + len(data)
+            # every ffmpeg output status line ends with a carriage return '\r'
+            lines = re.split('[\r\n]', self.partial + data)
+            self.partial = lines.pop()[-self.tail_size:]
+            lines = [line for line in lines if line]
+            for line in lines:
+                if line.startswith('frame'):
+                    self.status = line
+                elif not self.tail and self.head_bytes + len(line) < self.head_size:
+                    self.head.append(line)
+                    self.head_bytes = self.head_bytes + len(line) + 1
+                else:
+                    self.tail.append(line)
+                    self.tail_bytes = self.tail_bytes + len(line) + 1
+                    while self.tail_bytes > self.tail_size and len(self.tail) > 1:
+                        dropped = len(self.tail.popleft()) + 1
+                        self.tail_bytes = self.tail_bytes - dropped
+                        self.dropped = self.dropped + dropped
+        return lines
+
+    def read(self, pipe=None):
+        # capture pipe until its end
+        while True:
+            data = os.read(pipe.fileno(), 65536)
+            if not data:
+                break
+            self.write(data)
+        pipe.close()
+
+    def follow(self, pipe=None):
+        # capture pipe in a background thread
+        self.thread = threading.Thread(target=self.read, args=(pipe,), daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        # wait for the background thread to capture the rest of the output
+        if self.thread is not None:
+            self.thread.join()
+
+    def text(self):
+        with self.lock:
+            lines = list(self.head)
+            if self.dropped:
+                lines.append('[... %d bytes of output dropped ...]' % self.dropped)
+            lines.extend(self.tail)
+            if self.status is not None:
+                lines.append(self.status)
+            if self.partial:
+                lines.append(self.partial)
+        return '\n'.join(lines)
+
+    def last_line(self):
+        # last line of output that is not a status line, usually the error message
+        with self.lock:
+            if self.partial and not self.partial.startswith('frame'):
+                return self.partial
+            if self.tail:
+                return self.tail[-1]
+            if self.head:
+                return self.head[-1]
+        return ''
+
+def failure_comment(comment='', output=None):
+    # job comment for a failed step followed by the last line of its output
+    line = output.last_line().strip() if output is not None else ''
+    if line:
+        comment = '%s: %s' % (comment, line)
+    return comment[:JOB_COMMENT_SIZE]
+
+def parse_status_time(value):
+    # ffmpeg status time=HH:MM:SS.ss in seconds, 0 when not available yet
+    try:
+        hours, mins, secs = value.split(':')
+        return max(0.0, (int(hours)*60 + int(mins))*60 + float(secs))
+    except ValueError:
+        return 0.0
+
+def parse_status_size(value):
+    # ffmpeg status size=NNNNkB (or NNNNKiB) in bytes, 0 when not available yet
+    m = re.match('([0-9]+)(kB|KiB)', value)
+    if m:
+        return int(m.group(1))*1024
+    return 0
+
+def parse_status_line(line=''):
+    # values of an ffmpeg status line "frame= N fps= F ... size= NkB time=HH:MM:SS.ss ..."
+    # as a dict with frame, fps, size (bytes) and time (secs), None for other lines
+    if not line.startswith('frame'):
+        return None
+    # replace multiple spaces with one space and remove any spaces after equals signs
+    line = re.sub('= +', '=', re.sub(' +', ' ', line))
+    status = {}
+    for value in line.split(' '):
+        key, sep, value = value.partition('=')
+        try:
+            if key == 'frame':
+                status['frame'] = int(value)
+            elif key == 'fps':
+                status['fps'] = float(value)
+            elif key == 'size':
+                status['size'] = parse_status_size(value)
+            elif key == 'time':
+                status['time'] = parse_status_time(value)
+        except ValueError as e:
+            print('ffmpeg status parse exception: "%s"' % e)
+    return status
+
+def encode_progress(framenum=0, fps=1.0, duration_secs=0, framerate=0):
+    # progress = 0-100 represent percent complete for the transcode and
+    # the job comment reporting it
+    progress = int((100*framenum)/(duration_secs*framerate))
+    # eta_secs = estimated number of seconds until transcoding is complete
+    eta_secs = int((float(duration_secs*framerate)-framenum)/max(fps, 0.1))
+    return progress, 'Transcoding to mp4 %d%% complete ETA %d mins fps=%.1f.' \
+                     % (progress, float(eta_secs)/60, fps)
+
+def project_size(out_bytes=0, out_secs=0, duration_secs=0):
+    # final output size projected from the bytes written for the time encoded so far,
+    # 0 until abortMinProgress percent of the recording has been encoded
+    if out_bytes > 0 and out_secs > duration_secs*abortMinProgress/100.0:
+        return int(out_bytes*duration_secs/out_secs)
+    return 0
+
+def monitor_encode(jobid=None, job=None, proc=None, output=None,
+                   duration_secs=0, framerate=0, size_budget=0, gov=None, meter=None, outfile=None,
+                   deadline=None, rss_meter=None):
+    # follow the ffmpeg status output until the encoder exits and post progress
+    # to the job. If the output size projected from the bytes written so far exceeds
+    # size_budget the encoder is terminated and the projected size is returned,
+    # otherwise 0 is returned once the encoder has exited. When a Governor is given
+    # the encoder yields to live recordings and load. When a Deadline is given the
+    # encoder is terminated once it decides on a restart with a faster preset. The
+    # progress of the renditions is reported from the files written next to outfile,
+    # the peak memory of the encoder is sampled into the RssMeter rss_meter.
+    #
+    # the ffmpeg output is captured into output by its reader thread, only its
+    # latest status line is processed to generate status updates
+    hangiter=0;
+    seen = 0
+    # set initial progress to -1
+    prev_progress=-1
+    framenum=0
+    fps=1.0
+    while proc.poll() is None:
+        if gov is not None:
+            gov.update(jobid, job, proc)
+        if meter is not None:
+            meter.update()
+        if rss_meter is not None:
+            rss_meter.update(proc)
+        # has there been output since the last poll
+        if output.seen != seen:
+            seen = output.seen
+            hangiter=0
+            status = parse_status_line(output.status) if output.status else None
+            if status is not None:
+                if debug:
+                    print('status %s' % status)
+                # framenum = current frame number being encoded
+                framenum = status.get('frame', framenum)
+                # fps = frames per second for the encoder
+                fps = status.get('fps', fps)
+                if duration_secs*framerate <= 0:
+                    # duration or framerate unknown, no progress can be computed
+                    sleep_job_control(jobid, job, proc)
+                    continue
+                progress, progress_str = encode_progress(framenum, fps, duration_secs, framerate)
+                if debug:
+                    print('framenum = %d fps = %.2f' % (framenum, fps))                
+                if progress != prev_progress:
+                    if renditions and outfile is not None:
+                        progress_str = (progress_str + renditions_comment(outfile, duration_secs,
+                                                                          status.get('time', 0)))[:JOB_COMMENT_SIZE]
+                    if debug:
+                        print(progress_str)
+                    if jobid:
+                        job.update({'status':job.RUNNING, 'comment': progress_str})
+                    prev_progress = progress
+                # project the final output size from the bytes written for the time encoded so far
+                if size_budget > 0:
+                    projected_size = project_size(status.get('size', 0), status.get('time', 0),
+                                                  duration_secs)
+                    if projected_size > 0:
+                        if debug:
+                            print('Projected output size %d bytes, budget %d bytes' \
+                                  % (projected_size, size_budget))
+                        if projected_size > size_budget:
+                            print('Projected output size %d MB (%dkbps) exceeds the budget of %d MB, aborting encode.' \
+                                  % (projected_size/(1024*1024), projected_size*8/(1024*duration_secs),
+                                     size_budget/(1024*1024)))
+                            stop_process(proc)
+                            return projected_size
+                if deadline is not None and deadline.check(framenum, fps):
+                    stop_process(proc)
+                    return 0
+        elif gov is not None and gov.level == Governor.PAUSE:
+            # no output is expected while the encoder is paused
+            hangiter=0
+        else:
+            if debug:
+                print('Read no lines of ffmpeg output for %s secs. Possible hang?' % (POLL_INTERVAL*hangiter))
+            hangiter = hangiter + 1
+            if jobid:
+                progress_str = 'Read no lines of ffmpeg output for %s secs. Possible hang?' % (POLL_INTERVAL*hangiter)
+                job.update({'status':job.RUNNING, 'comment': progress_str})
+            if ENCODE_HANG_TIMEOUT > 0 and POLL_INTERVAL*hangiter >= ENCODE_HANG_TIMEOUT:
+                print('No ffmpeg output for %s secs, terminating the encode.' % (POLL_INTERVAL*hangiter))
+                stop_process(proc)
+                return 0
+        sleep_job_control(jobid, job, proc)
+    return 0
+
+def signal_process(proc=None, sig=signal.SIGTERM, companions=True):
+    # send sig to the process group started for proc and, with companions, to the groups
+    # of the processes running alongside it (proc.companions, the parallel audio encode),
+    # so pausing or throttling the encoder holds the whole encode. Groups that already
+    # exited are ignored.
+    procs = [proc]
+    if companions:
+        procs = procs + getattr(proc, 'companions', [])
+    for p in procs:
+        try:
+            os.killpg(p.pid, sig)
+        except OSError:
+            pass
+
+def stop_process(proc=None):
+    # terminate the process group of proc, a stopped group is continued first
+    # so it can act on SIGTERM. Its companions keep running for a restarted encoder,
+    # the job stops them when it leaves.
+    signal_process(proc, signal.SIGTERM, False)
+    signal_process(proc, signal.SIGCONT)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        signal_process(proc, signal.SIGKILL, False)
+        proc.wait()
+
+def job_command(job=None):
+    # re-read the job queue entry and return the command sent to the job
     try:
-        output = task(
-                      '-n %s' % NICELEVEL,
-                      '%s' % transcoder,
-                      '-i "%s"' % tmpfile,
-                      # parameter to overwrite output file if present without prompt
-                      '-y',
-                      # parameter de-interlacing filter
-                      '-filter:v yadif=0:-1:1',
-                      # parameter to allow streaming content
-                      '-movflags faststart',
-                      # parameter needed when hdhomerun prime mpeg2 files sometime repeat timestamps
-                      '-vsync passthrough',
-                      # h264 video codec
-                      '-c:v libx264',
-                      # presets for h264 encode that effect encode speed/output filesize
-                      '-preset:v %s' % preset,
-                      # ##########  IMPORTANT  ############
-                      # ffmpeg versions after 08-18-2015 include a change to force explicit IDR frames, 
-                      # setting this flag helps/corrects myth seektable indexing h264-encoded files
-                      # uncomment the  line below if you have a recent version of ffmpeg that supports this option
-#                      '-forced-idr 1',
-                      # parameters to determine video encode target bitrate
-                      vbitrate_param,
-                      # parameters to determine audio encode target bitrate
-                      abitrate_param,
-                      # parameter to encode all input audio streams into the output
-#                      '-map 0:a',
-                      # parameters to set the first output audio stream 
-                      # to be an audio stream having the specified language (default=eng -> English)
-#                      '-metadata:s:a:0',
-#                      'language=%s' % language,
-                      # parameter to copy input subtitle streams into the output
-                      '-c:s copy',
-#                     '-c:s mov_text',
-                      # parameters to set the first output subtitle stream 
-                      # to be an english subtitle stream
-#                      '-metadata:s:s:0',
-#                      'language=%s' % language,
-                      # we can control the number of encode threads (disabled)
-                      '-threads 4',
-                      # output file parameter
-                      '"%s"' % outfile,
-                      # redirection of output to temporaryfile
-                      '> %s 2>&1 < /dev/null' % statusfile)
+        job._pull()
+    except MythError:
+        return job.RUN
+    return job.cmds
+
+def sleep_job_control(jobid=None, job=None, proc=None, secs=None):
+    # wait up to secs for proc to exit while honoring the pause/resume/stop commands
+    # sent to the job from the frontend or mythweb. Pause and resume signal the process
+    # group of proc with SIGSTOP/SIGCONT, stop terminates it and raises JobStopped.
+    # A paused job does not return until it is resumed or stopped, the time it was
+    # paused is added up in proc.paused_secs. Without a proc it only sleeps secs
+    # under job control.
+    if secs is None:
+        secs = POLL_INTERVAL
+    deadline = time.time() + secs
+    paused = False
+    paused_at = 0
+    while paused or time.time() < deadline:
+        timeout = JOBCTL_INTERVAL if jobid else secs
+        if not paused:
+            timeout = min(timeout, max(0.0, deadline - time.time()))
+        if proc is None:
+            time.sleep(timeout)
+        else:
+            try:
+                proc.wait(timeout=timeout)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+        if not jobid:
+            continue
+        cmds = job_command(job)
+        if cmds == job.STOP:
+            if debug:
+                print('Stop requested%s' % (', terminating process group %d' % proc.pid if proc else ''))
+            job.update({'status':job.STOPPING, 'cmds':job.RUN, 'comment':'Stopping'})
+            if proc is not None:
+                stop_process(proc)
+            raise JobStopped()
+        elif cmds == job.PAUSE and not paused:
+            if debug:
+                print('Pause requested%s' % (', stopping process group %d' % proc.pid if proc else ''))
+            if proc is not None:
+                signal_process(proc, signal.SIGSTOP)
+            paused = True
+            paused_at = time.time()
+            job.update({'status':job.PAUSED, 'cmds':job.RUN, 'comment':'Paused'})
+        elif cmds == job.RESUME:
+            if debug:
+                print('Resume requested%s' % (', continuing process group %d' % proc.pid if proc else ''))
+            if proc is not None:
+                signal_process(proc, signal.SIGCONT)
+            if paused and proc is not None:
+                proc.paused_secs = getattr(proc, 'paused_secs', 0) + time.time() - paused_at
+            paused = False
+            job.update({'status':job.RUNNING, 'cmds':job.RUN, 'comment':'Resumed'})
+
+def run_controlled(jobid=None, job=None, gov=None, meter=None, args=[], supervisor=None):
+    # run an external tool in its own process group under job control and
+    # the optional Governor and CacheMeter, returns its exit code and its
+    # stdout/stderr captured into an OutputBuffer. With a supervisor the tool
+    # is run by its event loop like the encoders
+    cmd = ' '.join(args)
+    if debug:
+        print('Running command "%s"' % cmd)
+    if supervisor is not None:
+        state = SupervisedProcess(jobid, gov, meter)
+        returncode = supervisor.run_process(state, cmd)
+        if state.stopped:
+            raise JobStopped()
+        return returncode, state.output
+    output = OutputBuffer()
+    proc = start_process(cmd, output)
+    while proc.poll() is None:
+        if gov is not None:
+            gov.update(jobid, job, proc)
+        if meter is not None:
+            meter.update()
+        sleep_job_control(jobid, job, proc)
+    output.wait()
+    return proc.returncode, output
+
+def cache_policy_args():
+    # command prefix running an external tool under cache_policy_cmd
+    if cache_policy_cmd:
+        return [cache_policy_cmd]
+    return []
+
+def fadvise(fd, offset=0, length=0, advice=None):
+    # posix_fadvise where the platform supports it, the advice is only a hint
+    if advice is not None and hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+def drop_file_cache(filename=None):
+    # flush filename to disk and drop its pages from the page cache
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fdatasync(fd)
+        fadvise(fd, 0, 0, getattr(os, 'POSIX_FADV_DONTNEED', None))
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def stream_copy(src=None, dst=None, meter=None):
+    # copy src to dst with large sequential reads. Pages of src are dropped from the page
+    # cache once read, pages of dst once they have been flushed to disk, so the copy
+    # only ever holds about IO_FLUSH_SIZE bytes of cache.
+    sequential = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+    dontneed = getattr(os, 'POSIX_FADV_DONTNEED', None)
+    buf = bytearray(IO_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(src, 'rb', buffering=0) as fin, open(dst, 'wb', buffering=0) as fout:
+        fadvise(fin.fileno(), 0, 0, sequential)
+        offset = 0
+        flushed = 0
+        while True:
+            n = fin.readinto(buf)
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += fout.write(view[written:n])
+            fadvise(fin.fileno(), offset, n, dontneed)
+            offset += n
+            if offset - flushed >= IO_FLUSH_SIZE:
+                os.fdatasync(fout.fileno())
+                fadvise(fout.fileno(), flushed, offset - flushed, dontneed)
+                flushed = offset
+                if meter is not None:
+                    meter.update()
+        os.fdatasync(fout.fileno())
+        fadvise(fout.fileno(), 0, 0, dontneed)
+
+def page_cache_bytes():
+    # size of the system page cache ("Cached" in /proc/meminfo), 0 if unavailable
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('Cached:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+class CacheMeter:
+    # Tracks the peak growth of the system page cache over a transcode to measure
+    # how much of the backend and database working set it pushed out.
+    def __init__(self):
+        self.baseline = page_cache_bytes()
+        self.peak = self.baseline
+
+    def update(self):
+        cached = page_cache_bytes()
+        if cached > self.peak:
+            self.peak = cached
+            if debug:
+                print('Page cache grew to %d MB (%+d MB)' % (cached/(1024*1024), self.growth()/(1024*1024)))
+
+    def growth(self):
+        return self.peak - self.baseline
+
+def group_rss(pgid=None):
+    # summed peak RSS (VmHWM, MB) of the processes of the process group pgid, 0 if unavailable
+    rss = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                # the fields after the command name, which may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+            if int(fields[2]) != pgid:
+                continue
+            with open('/proc/%s/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        rss = rss + int(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            pass
+    return rss/1024.0
+
+class RssMeter:
+    # Tracks the peak memory of the encoder process groups of a transcode, sampled
+    # while they run as the peak of an exited process cannot be read anymore.
+    def __init__(self):
+        self.peak = 0
+
+    def update(self, proc=None):
+        rss = group_rss(proc.pid)
+        if rss > self.peak:
+            self.peak = rss
+            if debug:
+                print('Encoder memory grew to %d MB' % rss)
+
+def predict_rss(pixels=0, lookahead=40, threads=4, refs=3, scale=1.0):
+    # predicted peak RSS (MB) of an encode of frames of pixels with the x264 settings,
+    # every frame in flight is a yuv420 frame times MEMORY_FRAME_FACTOR
+    frames = lookahead + threads + refs + 3
+    return scale*(MEMORY_BASE + frames*pixels*1.5*MEMORY_FRAME_FACTOR/(1024*1024))
+
+def memory_limits(preset='slow', pixels=0, budget=0, scale=1.0):
+    # the x264 lookahead, threads and reference frames of the preset, reduced until the
+    # predicted RSS of the encode fits budget MB: the lookahead first down to 10 frames,
+    # then the threads and last the reference frames. A budget of 0 reduces nothing
+    lookahead, refs = PRESET_LIMITS.get(preset, (40, 3))
+    limits = {'rc-lookahead':lookahead, 'threads':encode_threads or os.cpu_count() or 1, 'ref':refs}
+    def predicted():
+        return predict_rss(pixels, limits['rc-lookahead'], limits['threads'], limits['ref'], scale)
+    for key, floor in (('rc-lookahead', 10), ('threads', 1), ('ref', 1)):
+        while budget > 0 and predicted() > budget and limits[key] > floor:
+            limits[key] = limits[key] - 1
+    limits['rss'] = int(predicted())
+    return limits
+
+def load_reservations():
+    # the memory reserved by the running transcodes of this host as {name:[pid, MB]},
+    # without the reservations of processes that exited
+    try:
+        with open(memory_reservations) as f:
+            reserved = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    for name, (pid, mb) in list(reserved.items()):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            del reserved[name]
+        except OSError:
+            pass
+    return reserved
+
+def reserve_memory(jobid=None, job=None, name=None, mb=0):
+    # wait until the mb of the encode name fit memory_budget next to the encodes of this
+    # host already running and reserve them. An encode is always admitted when no other
+    # encode runs. The wait honors pause and resume, raises JobStopped when the job is
+    # stopped while waiting
+    waiting = False
+    while True:
+        with open('%s.lock' % memory_reservations, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            reserved = load_reservations()
+            others = sum([used for other, (pid, used) in reserved.items() if other != name])
+            if others == 0 or others + mb <= memory_budget:
+                reserved[name] = [os.getpid(), mb]
+                save_json(memory_reservations, reserved)
+                break
+        if not waiting:
+            print('Encode needs %d MB but %d MB of the memory budget of %d MB are in use, waiting.' \
+                  % (mb, others, memory_budget))
+            if jobid:
+                job.update({'status':job.RUNNING,
+                            'comment':'Waiting for %d MB of memory, %d of %d MB in use by other transcodes' \
+                            % (mb, others, memory_budget)})
+            waiting = True
+        # a paused job keeps waiting until it is resumed
+        sleep_job_control(jobid, job, None, POLL_INTERVAL)
+    if waiting and jobid:
+        job.update({'status':job.RUNNING, 'comment':'Memory available, starting the encode'})
+
+def release_memory(name=None):
+    try:
+        with open('%s.lock' % memory_reservations, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            reserved = load_reservations()
+            if reserved.pop(name, None) is not None:
+                save_json(memory_reservations, reserved)
+    except OSError as e:
+        print('Unable to release the memory reservation of "%s": %s' % (name, e))
+
+def read_pressure(resource='io'):
+    # percent of time some tasks stalled on resource over the last 10 secs (linux PSI), 0 if unavailable
+    try:
+        with open('/proc/pressure/%s' % resource) as f:
+            for line in f:
+                if line.startswith('some'):
+                    for value in line.split():
+                        if value.startswith('avg10='):
+                            return float(value[6:])
+    except (OSError, ValueError):
+        pass
+    return 0.0
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+def parse_window(spec=''):
+    # weekdays (0 = Monday), start and end minute of a transcode window 'DAYS HH:MM-HH:MM'
+    days, times = spec.split()
+    weekdays = set()
+    for part in days.split(','):
+        if part == '*':
+            weekdays.update(range(7))
+        elif '-' in part:
+            first, last = [WEEKDAYS.index(day.capitalize()) for day in part.split('-')]
+            weekdays.update([day % 7 for day in range(first, last + 7 + 1 if last < first else last + 1)])
+        else:
+            weekdays.add(WEEKDAYS.index(part.capitalize()))
+    start, end = [int(t.split(':')[0])*60 + int(t.split(':')[1]) for t in times.split('-')]
+    return weekdays, start, end
+
+def window_intervals(start=None):
+    # the transcode windows from start (default now) on as (begin, end) epoch secs in
+    # chronological order, with overlapping and adjacent windows merged. Without
+    # transcode_windows it is one window without end.
+    if start is None:
+        start = time.time()
+    if not transcode_windows:
+        yield start, float('inf')
+        return
+    windows = [parse_window(spec) for spec in transcode_windows]
+    today = time.localtime(start)
+    current = None
+    # a window of the previous day can still be open at start
+    day = -1
+    while True:
+        midnight = time.mktime((today.tm_year, today.tm_mon, today.tm_mday + day, 0, 0, 0, 0, 0, -1))
+        weekday = time.localtime(midnight).tm_wday
+        intervals = []
+        for weekdays, begin, end in windows:
+            if weekday in weekdays:
+                # mktime from the broken down time keeps the local times across dst changes
+                intervals.append((time.mktime((today.tm_year, today.tm_mon, today.tm_mday + day,
+                                               begin//60, begin % 60, 0, 0, 0, -1)),
+                                  time.mktime((today.tm_year, today.tm_mon,
+                                               today.tm_mday + day + (1 if end <= begin else 0),
+                                               end//60, end % 60, 0, 0, 0, -1))))
+        for begin, end in sorted(intervals):
+            if end <= start:
+                continue
+            begin = max(begin, start)
+            if current is not None and begin <= current[1]:
+                current = (current[0], max(current[1], end))
+                if current[1] - current[0] > 8*24*3600:
+                    # the windows cover the whole week
+                    yield current[0], float('inf')
+                    return
+                continue
+            if current is not None:
+                yield current
+            current = (begin, end)
+        day = day + 1
+        if day > 7 and current is None:
+            # no window is set for any weekday
+            return
+
+def window_time(t=0):
+    return time.strftime('%a %H:%M', time.localtime(t))
+
+def wait_for_window(jobid=None, job=None):
+    # hold a job (or a worker of the shared work queue) until a transcode window is open,
+    # a job stopped from the frontend or mythweb meanwhile exits
+    begin, end = next(window_intervals())
+    if begin <= time.time():
+        return
+    print('Outside of the transcode windows, waiting until %s' % window_time(begin))
+    if jobid:
+        job.update({'status':job.PAUSED, 'comment':'Held until the transcode window opens %s' % window_time(begin)})
+    while time.time() < begin:
+        time.sleep(min(POLL_INTERVAL, max(0, begin - time.time())))
+        if jobid and job_command(job) == job.STOP:
+            job.update({'status':job.ABORTED, 'cmds':job.RUN,
+                        'comment':'Transcode stopped by user while held for the transcode window'})
+            sys.exit(0)
+    if jobid:
+        job.update({'status':job.RUNNING, 'comment':'Transcode window opened'})
+
+def project_backlog(candidates=[], cpus=None, start=None):
+    # the time each of the ranked candidates is projected to be transcoded by, when the
+    # backlog is worked through in order using all cpus during the transcode windows
+    if cpus is None:
+        cpus = os.cpu_count() or 1
+    intervals = window_intervals(start)
+    begin, end = next(intervals)
+    done = []
+    for c in candidates:
+        secs = c['cpu_secs']/cpus
+        while begin + secs > end:
+            secs = secs - (end - begin)
+            begin, end = next(intervals)
+        begin = begin + secs
+        done.append(begin)
+    return done
+
+class Governor:
+    # Yields cpu and disk to live recordings. Each update() samples the number of
+    # recordings in progress, the load average and the i/o pressure and moves the
+    # encoder process group between full speed, throttled (nice 19, ionice idle)
+    # and paused (SIGSTOP). The time spent throttled and paused is accumulated for
+    # the job report.
+    FULL, THROTTLE, PAUSE = range(3)
+
+    def __init__(self, db=None):
+        self.db = db
+        self.proc = None
+        self.level = Governor.FULL
+        self.last_update = None
+        self.throttled_secs = 0
+        self.paused_secs = 0
+
+    def recordings(self):
+        # number of recordings currently in progress on any backend
+        try:
+            with self.db as cursor:
+                cursor.execute("""SELECT COUNT(*) FROM recorded
+                                  WHERE starttime <= UTC_TIMESTAMP()
+                                    AND endtime > UTC_TIMESTAMP()""")
+                return cursor.fetchone()[0]
+        except MythError:
+            return 0
+
+    def wanted_level(self):
+        # the level the encode should run at and the job comment explaining it, outside of
+        # the transcode windows the encode is paused until the next window opens
+        if transcode_windows:
+            begin, end = next(window_intervals())
+            if begin > time.time():
+                return Governor.PAUSE, 'Paused until the transcode window opens %s' % window_time(begin)
+            if not governor:
+                return Governor.FULL, 'Transcode window opened, transcoding at full speed'
+        recordings = self.recordings()
+        load = os.getloadavg()[0]/(os.cpu_count() or 1)
+        iopressure = read_pressure('io')
+        if debug:
+            print('Governor: %d recordings, load %.2f/cpu, io pressure %.1f%%' % (recordings, load, iopressure))
+        for level, limits in ((Governor.PAUSE, (governor_pause_recordings, governor_pause_load,
+                                                governor_pause_iopressure)),
+                              (Governor.THROTTLE, (governor_throttle_recordings, governor_throttle_load,
+                                                   governor_throttle_iopressure))):
+            for value, limit in zip((recordings, load, iopressure), limits):
+                if limit > 0 and value >= limit:
+                    return level, '%s while %d recordings in progress or system is loaded' \
+                                  % ('Paused' if level == Governor.PAUSE else 'Throttled', recordings)
+        return Governor.FULL, 'Recordings/load finished, transcoding at full speed'
+
+    def set_priority(self, proc=None, nicelevel=19, ioclass=3):
+        # renice and ionice all processes (and threads) in the groups of proc and its
+        # companions, lowering the nice level again needs CAP_SYS_NICE so a failure to
+        # restore is only reported
+        for p in [proc] + getattr(proc, 'companions', []):
+            try:
+                os.setpriority(os.PRIO_PGRP, p.pid, nicelevel)
+            except OSError as e:
+                if debug:
+                    print('Governor: unable to set nice level %d: %s' % (nicelevel, e))
+            subprocess.call(['ionice', '-c', str(ioclass), '-P', str(p.pid)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def update(self, jobid=None, job=None, proc=None, wanted=None):
+        # wanted is a (level, comment) sample shared between several encodes,
+        # by default the level is sampled for this encode
+        now = time.time()
+        if proc is not self.proc:
+            # a newly started process runs at full speed
+            self.proc = proc
+            self.level = Governor.FULL
+            self.last_update = None
+        if self.last_update is not None:
+            if self.level != Governor.FULL:
+                self.throttled_secs += now - self.last_update
+            if self.level == Governor.PAUSE:
+                self.paused_secs += now - self.last_update
+        self.last_update = now
+        level, comment = wanted if wanted is not None else self.wanted_level()
+        if level == self.level:
+            if level == Governor.PAUSE:
+                # stay paused even if the job was resumed from the frontend meanwhile
+                signal_process(proc, signal.SIGSTOP)
+            return self.level
+        if debug:
+            print('Governor: changing level %d -> %d' % (self.level, level))
+        if self.level == Governor.PAUSE:
+            signal_process(proc, signal.SIGCONT)
+        if level == Governor.FULL:
+            self.set_priority(proc, os.getpriority(os.PRIO_PROCESS, 0) + NICELEVEL, 2)
+        elif level == Governor.THROTTLE:
+            self.set_priority(proc, 19, 3)
+        else:
+            signal_process(proc, signal.SIGSTOP)
+        if jobid:
+            job.update({'status':job.RUNNING, 'comment':comment})
+        self.level = level
+        return self.level
+
+def next_busy_window(db=None):
+    # start (epoch secs) of the next time governor_throttle_recordings recordings are
+    # scheduled at once, now if they are in progress, None if the schedule has no such
+    # time or cannot be read from the backend
+    try:
+        times = [(p.recstartts.timestamp(), p.recendts.timestamp())
+                 for p in MythBE(db=db).getUpcomingRecordings()]
+    except (MythError, OSError) as e:
+        print('Unable to read the upcoming recordings: %s' % e)
+        return None
+    now = time.time()
+    for start in sorted([now] + [start for start, end in times if start > now]):
+        if len([1 for s, e in times if s <= start < e]) >= max(1, governor_throttle_recordings):
+            return start
+    return None
+
+def fingerprint_pixels(fingerprint=''):
+    # pixels per frame of the video of a stream fingerprint, 0 if unknown
+    m = re.search(' ([0-9]{2,})x([0-9]{2,})', fingerprint or '')
+    return int(m.group(1))*int(m.group(2)) if m else 0
+
+def fps_key(encoder='libx264', preset='slow'):
+    # key of the throughput learned for the preset of the encoder in a profile
+    return preset if encoder == 'libx264' else '%s:%s' % (encoder, preset)
+
+def encoder_fps(fps={}, encoder='libx264'):
+    # the throughput of the presets of the encoder of the learned throughput fps
+    return dict([(key.split(':')[-1], value) for key, value in fps.items()
+                 if key == fps_key(encoder, key.split(':')[-1])])
+
+def preset_rates(chanid=None, fingerprint=None, encoder='libx264'):
+    # predicted encode fps of each of the deadline_presets for a recording of the channel,
+    # from the throughput learned for the channel or else the throughput per pixel learned
+    # for the other channels, scaled between presets by PRESET_SPEED. {} without history
+    # of the encoder
+    profiles = load_profiles() if profile_cache else {}
+    profile = profiles.get(str(chanid), {})
+    channel = {}
+    if fingerprint and profile.get('fingerprint') == fingerprint:
+        channel = encoder_fps(profile.get('fps', {}), encoder)
+    # throughput of each learned preset as fps at the speed of 'slow'
+    samples = [fps/PRESET_SPEED.get(preset, 1.0) for preset, fps in channel.items()]
+    pixels = fingerprint_pixels(fingerprint)
+    if not samples and pixels > 0:
+        for other in profiles.values():
+            other_pixels = fingerprint_pixels(other.get('fingerprint'))
+            if other_pixels > 0:
+                samples = samples + [fps*other_pixels/pixels/PRESET_SPEED.get(preset, 1.0)
+                                     for preset, fps in encoder_fps(other.get('fps', {}), encoder).items()]
+    if not samples:
+        return {}
+    slow_fps = sum(samples)/len(samples)
+    rates = dict([(preset, slow_fps*PRESET_SPEED.get(preset, 1.0)) for preset in deadline_presets])
+    # the presets measured on the channel keep their own throughput
+    rates.update([(preset, fps) for preset, fps in channel.items() if preset in rates])
+    return rates
+
+class Deadline:
+    # Chooses the preset of an encode so it finishes DEADLINE_MARGIN secs before the next
+    # busy window of the recording schedule. check() re-evaluates the running encode when
+    # its fps drifts from the prediction or the schedule changed, and sets restart to a
+    # faster preset when the encode would run into the busy window but a restart with the
+    # faster preset would not.
+    def __init__(self, db=None, chanid=None, fingerprint=None, total_frames=0, encoder='libx264'):
+        self.db = db
+        self.total_frames = total_frames
+        self.rates = preset_rates(chanid, fingerprint, encoder)
+        self.window = None
+        self.read_at = 0
+        self.preset = None
+        self.restart = None
+
+    def time_left(self):
+        # secs until the busy window less the margin, None without a busy window
+        if time.time() - self.read_at >= DEADLINE_RECHECK:
+            self.window = next_busy_window(self.db)
+            self.read_at = time.time()
+        if self.window is None:
+            return None
+        return self.window - DEADLINE_MARGIN - time.time()
+
+    def presets(self):
+        # deadline_presets from the slowest to the fastest
+        return sorted(deadline_presets, key=lambda preset: PRESET_SPEED.get(preset, 1.0))
+
+    def choose(self, default=None):
+        left = self.time_left()
+        self.preset = default
+        if not self.rates:
+            print('No encode throughput learned yet, using preset %s' % default)
+            return self.preset
+        presets = self.presets()
+        self.preset = presets[-1]
+        for preset in presets:
+            if left is None or self.total_frames/self.rates[preset] <= left:
+                self.preset = preset
+                break
+        if left is None:
+            print('No recordings scheduled, using preset %s' % self.preset)
+        else:
+            print('Next recordings start in %d mins, using preset %s predicted to take %d mins' \
+                  % ((self.window - time.time())/60, self.preset, self.total_frames/self.rates[self.preset]/60))
+        return self.preset
+
+    def check(self, framenum=0, fps=0.0):
+        # returns True when the encode is to be restarted with the preset self.restart
+        if fps <= 0 or framenum < self.total_frames*abortMinProgress/100.0:
+            return False
+        window = self.window
+        left = self.time_left()
+        predicted = self.rates.get(self.preset)
+        if left is None or (predicted is not None and abs(fps/predicted - 1) <= DEADLINE_DRIFT
+                            and self.window == window):
+            return False
+        # the predictions are corrected by the throughput observed, which is also
+        # the reference for the next drift
+        if predicted is not None:
+            self.rates = dict([(preset, rate*fps/predicted) for preset, rate in self.rates.items()])
+        else:
+            self.rates = dict([(preset, fps*PRESET_SPEED.get(preset, 1.0)/PRESET_SPEED.get(self.preset, 1.0))
+                               for preset in deadline_presets])
+        self.rates[self.preset] = fps
+        remaining = (self.total_frames - framenum)/fps
+        if debug:
+            print('Deadline: %.1f fps, %d mins to go, %d mins left' % (fps, remaining/60, left/60))
+        if remaining <= left:
+            return False
+        for preset in self.presets():
+            if PRESET_SPEED.get(preset, 1.0) <= PRESET_SPEED.get(self.preset, 1.0):
+                continue
+            secs = self.total_frames/self.rates[preset]
+            if secs <= left and secs < remaining:
+                print('Encode at %.1f fps needs %d more mins but the next recordings start in %d mins, '
+                      'restarting with preset %s.' % (fps, remaining/60, (self.window - time.time())/60, preset))
+                self.preset = self.restart = preset
+                return True
+        return False
+
+class SupervisedProcess:
+    # State of an external tool run under job control by the Supervisor (the cutlist
+    # removal, the analysis pass, the mux, the cut or the wait for the parallel audio
+    # encode). Its output is captured on the event loop, pause/resume/stop and the
+    # governor are applied by the supervisor tick.
+    def __init__(self, jobid=None, gov=None, meter=None, companions=[]):
+        self.jobid = jobid
+        self.gov = gov
+        self.meter = meter
+        # processes paused and resumed along with it, see signal_process()
+        self.companions = companions
+        self.proc = None
+        self.comment = None
+        self.paused = False
+        # time paused from the frontend or mythweb
+        self.paused_at = 0
+        self.paused_secs = 0
+        self.stopped = False
+        self.last_output = time.time()
+        # bounded output for error reports
+        self.output = OutputBuffer()
+
+    def feed(self, line=''):
+        # called on the event loop for every line of output, returns True when the
+        # process is to be terminated
+        self.last_output = time.time()
+        return False
+
+    def check(self, now=0):
+        # called by the supervisor tick while the process runs, returns True when it
+        # is to be terminated
+        return False
+
+class SupervisedEncode(SupervisedProcess):
+    # State of one encode monitored by the Supervisor. The progress comment feed()
+    # produces is written to the job by the next supervisor tick.
+    def __init__(self, jobid=None, duration_secs=0, framerate=0, size_budget=0,
+                 gov=None, meter=None, outfile=None, deadline=None, rss_meter=None, companions=[]):
+        SupervisedProcess.__init__(self, jobid, gov, meter, companions)
+        self.duration_secs = duration_secs
+        self.framerate = framerate
+        self.size_budget = size_budget
+        self.outfile = outfile
+        self.deadline = deadline
+        self.rss_meter = rss_meter
+        self.framenum = 0
+        self.fps = 1.0
+        self.prev_progress = -1
+        self.projected_size = 0
+
+    def feed(self, line=''):
+        SupervisedProcess.feed(self, line)
+        status = parse_status_line(line)
+        if status is None:
+            return False
+        self.framenum = status.get('frame', self.framenum)
+        self.fps = status.get('fps', self.fps)
+        if self.duration_secs*self.framerate > 0:
+            progress, comment = encode_progress(self.framenum, self.fps, self.duration_secs, self.framerate)
+            if progress != self.prev_progress:
+                if renditions and self.outfile is not None:
+                    comment = (comment + renditions_comment(self.outfile, self.duration_secs,
+                                                            status.get('time', 0)))[:JOB_COMMENT_SIZE]
+                if debug:
+                    print('%s %s' % (self.jobid, comment))
+                self.comment = comment
+                self.prev_progress = progress
+        if self.size_budget > 0 and self.projected_size == 0:
+            projected_size = project_size(status.get('size', 0), status.get('time', 0), self.duration_secs)
+            if projected_size > self.size_budget:
+                print('Projected output size %d MB exceeds the budget of %d MB, aborting encode.' \
+                      % (projected_size/(1024*1024), self.size_budget/(1024*1024)))
+                self.projected_size = projected_size
+                return True
+        return False
+
+    def check(self, now=0):
+        if self.rss_meter is not None:
+            self.rss_meter.update(self.proc)
+        if ENCODE_HANG_TIMEOUT > 0 and now - self.last_output > ENCODE_HANG_TIMEOUT:
+            print('No ffmpeg output for %d secs, terminating the encode.' % (now - self.last_output))
+            return True
+        return self.deadline is not None and self.deadline.check(self.framenum, self.fps)
+
+class Supervisor:
+    # Runs several transcodes concurrently in one process. The blocking preparation
+    # and finalization of each runjob() run in a pool of threads, while all encoders and
+    # the other external tools of the jobs are spawned and monitored by a single asyncio
+    # event loop that reads their output as it arrives. One tick every POLL_INTERVAL secs
+    # applies job control, the governor and the hang timeout to all of them and writes
+    # their progress to the database from a single thread with Job objects of its own,
+    # so the wake-ups per encode do not grow with concurrency.
+    def __init__(self, jobs=1):
+        self.loop = asyncio.new_event_loop()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.dbthread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.processes = set()
+        self.db = None
+        # jobid => Job on the connection of the database thread
+        self.jobs = {}
+
+    def run(self, calls=[]):
+        # run the callables in calls concurrently, each of them calling
+        # runjob(supervisor=self) for one or more recordings
+        async def supervise():
+            ticker = asyncio.ensure_future(self.tick())
+            try:
+                await asyncio.gather(*[self.loop.run_in_executor(self.pool, call_job, call)
+                                       for call in calls])
+            finally:
+                ticker.cancel()
+        try:
+            self.loop.run_until_complete(supervise())
+        finally:
+            # when the supervisor stops early (e.g. on ctrl-c) the processes still running
+            # are killed and their waits cancelled, so the job threads return and do not
+            # keep the process from exiting
+            for state in list(self.processes):
+                signal_process(state.proc, signal.SIGKILL)
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.dbthread.shutdown(wait=False, cancel_futures=True)
+
+    def run_process(self, state=None, cmd=None):
+        # called from a runjob() thread, blocks until the process has exited and
+        # returns its exit code
+        return asyncio.run_coroutine_threadsafe(self.spawn(state, cmd), self.loop).result()
+
+    def run_wait(self, state=None):
+        # called from a runjob() thread for the process state.proc it started itself
+        # (the parallel audio encode), blocks until it has exited and returns its exit code
+        return asyncio.run_coroutine_threadsafe(self.wait(state), self.loop).result()
+
+    async def spawn(self, state=None, cmd=None):
+        state.proc = await asyncio.create_subprocess_shell(cmd, stdin=subprocess.DEVNULL,
+                                                           stdout=subprocess.PIPE,
+                                                           stderr=subprocess.STDOUT,
+                                                           start_new_session=True)
+        state.proc.companions = state.companions
+        self.processes.add(state)
+        try:
+            while True:
+                data = await state.proc.stdout.read(65536)
+                if not data:
+                    break
+                for line in state.output.write(data):
+                    if state.feed(line):
+                        self.terminate(state)
+            await state.proc.wait()
+        finally:
+            self.processes.discard(state)
+        return state.proc.returncode
+
+    async def wait(self, state=None):
+        self.processes.add(state)
+        try:
+            if state.proc.poll() is None:
+                # the exit of the process is signalled on a pidfd, no polling needed
+                exited = self.loop.create_future()
+                fd = os.pidfd_open(state.proc.pid)
+                self.loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+                try:
+                    await exited
+                finally:
+                    self.loop.remove_reader(fd)
+                    os.close(fd)
+                state.proc.wait()
+        finally:
+            self.processes.discard(state)
+        return state.proc.returncode
+
+    def terminate(self, state=None):
+        # terminate the process group, killing it if it did not exit after 30 secs
+        signal_process(state.proc, signal.SIGTERM, False)
+        signal_process(state.proc, signal.SIGCONT)
+        self.loop.call_later(30, lambda: state.proc.returncode is None
+                                         and signal_process(state.proc, signal.SIGKILL, False))
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            processes = list(self.processes)
+            if processes:
+                for state in await self.loop.run_in_executor(self.dbthread, self.tick_processes, processes):
+                    self.terminate(state)
+
+    def job(self, jobid=None):
+        # Job of jobid on the connection of the database thread, the Job objects of the
+        # runjob() threads belong to the connections of their threads. None if the job
+        # cannot be read
+        jobid = int(jobid)
+        if jobid not in self.jobs:
+            try:
+                self.jobs[jobid] = Job(jobid, db=self.db)
+            except MythError as e:
+                print('Unable to read job %d: %s' % (jobid, e))
+                return None
+        return self.jobs[jobid]
+
+    def tick_processes(self, processes=[]):
+        # runs on the database thread, returns the processes to terminate
+        now = time.time()
+        terminate = []
+        jobids = [int(state.jobid) for state in processes if state.jobid]
+        if self.db is None and (jobids or [state for state in processes if state.gov is not None]):
+            self.db = MythDB()
+        # the commands sent to all supervised jobs are read with one query
+        cmds = {}
+        if jobids:
+            try:
+                with self.db as cursor:
+                    cursor.execute('SELECT id, cmds FROM jobqueue WHERE id IN (%s)'
+                                   % ','.join(['%s']*len(jobids)), jobids)
+                    cmds = dict(cursor.fetchall())
+            except MythError as e:
+                print('Unable to read job commands: %s' % e)
+        wanted = None
+        for state in processes:
+            job = self.job(state.jobid) if state.jobid else None
+            if job is not None:
+                cmd = cmds.get(int(state.jobid), job.RUN)
+                if cmd == job.STOP:
+                    job.update({'status':job.STOPPING, 'cmds':job.RUN, 'comment':'Stopping'})
+                    state.stopped = True
+                    terminate.append(state)
+                    continue
+                elif cmd == job.PAUSE and not state.paused:
+                    signal_process(state.proc, signal.SIGSTOP)
+                    state.paused = True
+                    state.paused_at = now
+                    job.update({'status':job.PAUSED, 'cmds':job.RUN, 'comment':'Paused'})
+                elif cmd == job.RESUME:
+                    signal_process(state.proc, signal.SIGCONT)
+                    if state.paused:
+                        state.paused_secs = state.paused_secs + now - state.paused_at
+                    state.paused = False
+                    job.update({'status':job.RUNNING, 'cmds':job.RUN, 'comment':'Resumed'})
+            if state.paused:
+                state.last_output = now
+                continue
+            if state.gov is not None:
+                # load and recordings are sampled once for all processes
+                if wanted is None:
+                    wanted = Governor(self.db).wanted_level()
+                if state.gov.update(state.jobid if job is not None else None, job, state.proc,
+                                    wanted) == Governor.PAUSE:
+                    state.last_output = now
+            if state.meter is not None:
+                state.meter.update()
+            if state.check(now):
+                terminate.append(state)
+                continue
+            comment, state.comment = state.comment, None
+            if comment and job is not None:
+                job.update({'status':job.RUNNING, 'comment':comment})
+        # the Job objects of the jobs without a running process are read again when needed
+        for jobid in set(self.jobs) - set(jobids):
+            del self.jobs[jobid]
+        return terminate
+
+def generate_cutlist(db=None, jobid=None, job=None, chanid=None, starttime=None):
+    # turn the flagged commercials of the recording into its cutlist, returns the exit code
+    # of mythutil and its output captured into an OutputBuffer
+    if jobid:
+        job.update({'status':job.RUNNING, 'comment':'Generating Cutlist for commercial removal'})
+    task = System(path='mythutil', db=db)
+    output = OutputBuffer()
+    try:
+        output.write(task('--gencutlist',
+                          '--chanid "%s"' % chanid,
+                          '--starttime "%s"' % starttime))
+#                          '--loglevel debug',
+#                          '2> /dev/null')
     except MythError as e:
-        print('Command failed with output:\n%s' % e.stderr)
+        output.write(e.stderr)
+        print('Command "mythutil --gencutlist" failed with output:\n%s' % output.text())
+        return e.retcode, output
+    return 0, output
+
+def wait_for_commflag(db=None, jobid=None, job=None, chanid=None, starttime=None, queued=False, timeout=None):
+    # wait for the commercial flagging job running on the recording to complete, with queued
+    # also for one that is yet to run. Returns False if it did not complete within timeout secs
+    waititer = 1
+    while True:
+        flagging = [jobitem for jobitem in db.searchJobs(chanid=chanid, starttime=starttime)
+                    if jobitem.type == jobitem.COMMFLAG]  # Commercial flagging job
+        if debug:
+            for jobitem in flagging:
+                print('Commercial flagging job detected with status %s' % jobitem.status)
+        waiting = [jobitem for jobitem in flagging if jobitem.status == jobitem.RUNNING or
+                   queued and jobitem.status in (jobitem.QUEUED, jobitem.PENDING, jobitem.STARTING)]
+        if not waiting:
+            return True
+        if timeout is not None and (waititer - 1)*POLL_INTERVAL >= timeout:
+            return False
+        if jobid:
+            job.update({'status':job.PAUSED,
+                        'comment':'Waited %d secs for the commercial flagging job' % (waititer*POLL_INTERVAL) \
+                         + ' of this recording to complete.'})
+        if debug:
+            print('Waited %d secs for the commercial flagging job' % (waititer*POLL_INTERVAL) \
+                  + ' of this recording to complete.')
+        time.sleep(POLL_INTERVAL)
+        waititer = waititer + 1
+
+def call_job(call=None):
+    # runs call in a supervisor thread, a job leaving through sys.exit() or failing with
+    # an exception only ends its call while the other jobs keep running
+    try:
+        call()
+    except SystemExit as e:
+        if e.code:
+            print('Transcode job exited with %s' % e.code)
+    except Exception as e:
+        print('Transcode job failed:\n%s' % traceback.format_exc())
+        jobid = getattr(call, 'keywords', {}).get('jobid')
+        if jobid:
+            try:
+                job = Job(jobid, db=MythDB())
+                job.update({'status':job.ERRORED, 'comment':'Transcode failed (%s: %s)' % (type(e).__name__, e)})
+            except MythError as e:
+                print('Unable to mark job %s errored: %s' % (jobid, e))
+
+def stop_job(jobid=None, job=None, tmpfile=None, outfile=None, passlogfile=None):
+    # clean up after the job was stopped from the frontend or mythweb, the recording is left untouched
+    remove_tmpfiles(tmpfile, outfile, passlogfile)
+    if jobid:
+        job.update({'status':job.ABORTED, 'comment':'Transcode stopped by user, temporary files removed'})
+    sys.exit(0)
+
+def find_recording(db=None, rec=None):
+    # path of the recording on this host, hosts without a storage group of their
+    # own find the recording in the storage groups of the other hosts, mounted
+    # at the same path or at the path given by storage_path_map
+    sg = findfile(rec.basename, rec.storagegroup, db=db)
+    if sg is not None:
+        return os.path.join(sg.dirname, rec.basename)
+    with db as cursor:
+        cursor.execute("""SELECT DISTINCT dirname FROM storagegroup WHERE groupname = %s""",
+                       (rec.storagegroup,))
+        dirnames = [row[0] for row in cursor.fetchall()]
+    for dirname in dirnames:
+        for remote, local in storage_path_map.items():
+            if dirname.rstrip('/') == remote.rstrip('/'):
+                dirname = local
+        filename = os.path.join(dirname, rec.basename)
+        if os.path.exists(filename):
+            return filename
+    return None
+
+def scan_window(filename=None, start=0):
+    # bytes of the video and audio streams of filename in BITRATE_WINDOW_SECS from start secs,
+    # as {'video':bytes, 'audio':bytes}, read by demuxing the packets without decoding them.
+    # None if ffmpeg failed
+    cmd = [transcoder, '-v', 'verbose', '-nostdin', '-ss', '%.3f' % start, '-i', filename,
+           '-t', '%d' % BITRATE_WINDOW_SECS, '-map', '0:v?', '-map', '0:a?', '-c', 'copy', '-f', 'null', '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    output = OutputBuffer()
+    output.read(proc.stderr)
+    proc.wait()
+    if proc.returncode != 0:
+        return None
+    sizes = {'video':0, 'audio':0}
+    for m in re.finditer('Input stream #0:[0-9]+ \\((video|audio)\\): [0-9]+ packets read \\(([0-9]+) bytes\\)',
+                         output.text()):
+        sizes[m.group(1)] = sizes[m.group(1)] + int(m.group(2))
+    return sizes
+
+def sample_bitrates(filename=None, duration_secs=0):
+    # video and audio bitrates (kbps) of filename measured over bitrate_windows windows
+    # spread over its duration and scanned in parallel, with the video bitrate of the
+    # busiest window as 'peak', a rough indicator of the complexity of the content.
+    # None if the scan failed
+    last = max(0, duration_secs - BITRATE_WINDOW_SECS)
+    starts = [last*index/max(1, bitrate_windows - 1) for index in range(max(1, bitrate_windows))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(starts)) as pool:
+        windows = list(pool.map(functools.partial(scan_window, filename), starts))
+    windows = [w for w in windows if w is not None and w['video'] > 0]
+    if not windows:
+        print('Sampling the bitrate of "%s" failed.' % filename)
+        return None
+    secs = min(BITRATE_WINDOW_SECS, duration_secs)
+    rates = {'video':int(sum([w['video'] for w in windows])*8/(1024*secs*len(windows))),
+             'audio':int(sum([w['audio'] for w in windows])*8/(1024*secs*len(windows))),
+             'peak':int(max([w['video'] for w in windows])*8/(1024*secs))}
+    if debug:
+        print('Sampled bitrates %s from %d windows' % (rates, len(windows)))
+    return rates
+
+def scan_health(filename=None):
+    # demux filename without decoding it and return the problems of its first video stream
+    # as {'gaps':[secs], 'repeats':n, 'lead':secs, 'corrupt':[secs]}: the times of the
+    # timestamp discontinuities, the number of repeated timestamps, the secs the video
+    # starts after the first audio and the times of the packets ffmpeg reported corrupt.
+    # The timestamps are read unaltered from the packet list of the framecrc muxer.
+    # None if ffmpeg failed
+    cmd = [transcoder, '-v', 'warning', '-nostdin', '-copyts', '-i', filename,
+           '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-f', 'framecrc', '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output = OutputBuffer()
+    output.follow(proc.stderr)
+    timebase = {}
+    first = {}
+    prev = None
+    health = {'gaps':[], 'repeats':0, 'lead':0.0, 'corrupt':[]}
+    for line in proc.stdout:
+        line = line.decode('utf-8', 'replace')
+        if line.startswith('#tb '):
+            # time base of an output stream, "#tb 0: 1/90000"
+            index, sep, tb = line[4:].partition(':')
+            num, sep, den = tb.strip().partition('/')
+            timebase[int(index)] = float(num)/float(den)
+            continue
+        fields = line.split(',')
+        if line.startswith('#') or len(fields) < 5:
+            continue
+        index, dts = int(fields[0]), int(fields[1])
+        secs = dts*timebase.get(index, 1/90000.0)
+        first.setdefault(index, secs)
+        if index != 0:
+            continue
+        if prev is not None:
+            if secs == prev:
+                health['repeats'] = health['repeats'] + 1
+            elif secs < prev or secs - prev > HEALTH_GAP_SECS:
+                health['gaps'].append(prev - first[0])
+        prev = secs
+    proc.wait()
+    output.wait()
+    if proc.returncode != 0 or 0 not in first:
+        print('Stream health scan of "%s" failed: %s' % (filename, output.last_line()))
+        return None
+    if 1 in first:
+        health['lead'] = max(0.0, first[0] - first[1])
+    # "Packet corrupt (stream = 0, dts = 123456)", the transport stream counts in 1/90000 secs
+    for m in re.finditer('Packet corrupt \\(stream = [0-9]+, dts = ([0-9]+)\\)', output.text()):
+        health['corrupt'].append(int(m.group(1))/90000.0 - first[0])
+    return health
+
+def health_problems(health={}):
+    # description of the problems found by scan_health() that call for a repair, '' if none
+    problems = []
+    if health['gaps']:
+        problems.append('%d timestamp discontinuities (first at %d secs)' % (len(health['gaps']), health['gaps'][0]))
+    if health['lead'] > HEALTH_LEAD_SECS:
+        problems.append('no video for the first %.1f secs' % health['lead'])
+    if health['corrupt']:
+        problems.append('%d corrupt packets (first at %d secs)' % (len(health['corrupt']), health['corrupt'][0]))
+    return ', '.join(problems)
+
+def repair_args(health={}, tmpfile=None, repairedfile=None):
+    # ffmpeg arguments of a lossless remux of tmpfile to repairedfile that fixes the problems
+    # found by scan_health(): timestamp jumps beyond HEALTH_GAP_SECS are closed, corrupt
+    # packets are dropped and the audio before the first video is cut
+    return [transcoder,
+            '-nostdin',
+            '-fflags +discardcorrupt' if health['corrupt'] else '',
+            '-dts_delta_threshold %s' % HEALTH_GAP_SECS if health['gaps'] else '',
+            '-ss %.3f' % health['lead'] if health['lead'] > HEALTH_LEAD_SECS else '',
+            '-i "%s"' % tmpfile,
+            '-y',
+            '-map 0:v -map "0:a?" -map "0:s?"',
+            '-c copy',
+            '-f mpegts',
+            '"%s"' % repairedfile]
+
+def count_streams(probe='', kind='Video'):
+    # number of streams of a kind in the ffmpeg probe output
+    return len(re.findall('Stream #0:[0-9]+.*?: %s: ' % kind, probe))
+
+def decode_window(filename=None, start=0):
+    # decode VERIFY_WINDOW_SECS of filename from start secs, returns the errors reported
+    cmd = [transcoder, '-v', 'error', '-nostdin', '-ss', '%.3f' % start, '-i', filename,
+           '-t', '%d' % VERIFY_WINDOW_SECS, '-map', '0:v:0', '-map', '0:a?', '-f', 'null', '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    output = OutputBuffer()
+    output.read(proc.stderr)
+    proc.wait()
+    if proc.returncode != 0 or output.last_line():
+        return 'decode error at %d secs: %s' % (start, output.last_line() or 'exit code %d' % proc.returncode)
+    return None
+
+def verify_transcode(filename=None, duration_secs=0, plan=None, probe=''):
+    # Check the transcode filename before the original recording is deleted: its duration
+    # against the duration_secs of the source, its stream counts against the stream plan
+    # (or the source probe) and verify_windows short windows spread over it, decoded in
+    # parallel. Returns a description of the first problem found or None.
+    secs, output_probe = get_duration(None, None, transcoder, filename)
+    if secs <= 0:
+        return 'unable to read the duration'
+    if duration_secs > 0 and abs(secs - duration_secs) > max(VERIFY_WINDOW_SECS,
+                                                             VERIFY_DURATION_TOLERANCE*duration_secs):
+        return 'duration %d secs, source %d secs' % (secs, duration_secs)
+    if count_streams(output_probe, 'Video') != 1:
+        return '%d video streams' % count_streams(output_probe, 'Video')
+    if plan is not None:
+        expected = {'Audio':len(plan['audio']), 'Subtitle':len(plan['subtitle'])}
+    else:
+        expected = {'Audio':min(1, count_streams(probe, 'Audio'))} if probe else {}
+    for kind, count in expected.items():
+        if count_streams(output_probe, kind) < count:
+            return '%d %s streams, expected %d' % (count_streams(output_probe, kind), kind.lower(), count)
+    # the windows are spread evenly with the last one ending at the end of the transcode
+    last = max(0, secs - VERIFY_WINDOW_SECS - 1)
+    starts = [last*index/max(1, verify_windows - 1) for index in range(verify_windows)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=verify_windows) as pool:
+        for error in pool.map(functools.partial(decode_window, filename), starts):
+            if error is not None:
+                return error
+    if debug:
+        print('Verified %d secs of transcode in %d windows' % (secs, verify_windows))
+    return None
+
+def cut_segments(rec=None, duration_secs=0, framerate=0, offset=0.0):
+    # the (start, end) secs of an encode of rec that the cutlist of rec keeps, with every cut
+    # snapped to the nearest keyframe forced by keyframe_args() and an end of None for the
+    # rest of the encode. offset is the secs cut from the start of the recording before it
+    # was encoded. None if the recording has no cutlist
+    marks = sorted([(mark.mark, mark.type) for mark in rec.markup
+                    if mark.type in (rec.markup.MARK_CUT_START, rec.markup.MARK_CUT_END)])
+    if not marks or framerate <= 0:
+        return None
+    def snap(frame):
+        secs = max(0.0, frame/framerate - offset)
+        return round(secs/CUT_KEYFRAME_SECS)*CUT_KEYFRAME_SECS
+    segments = []
+    # the recording is kept from its start unless the cutlist starts with a cut end
+    start = 0.0
+    for frame, kind in marks:
+        if kind == rec.markup.MARK_CUT_START:
+            if start is not None:
+                segments.append((start, snap(frame)))
+            start = None
+        else:
+            start = snap(frame)
+    if start is not None and start < duration_secs:
+        segments.append((start, None))
+    return [(start, end) for start, end in segments if end is None or end > start]
+
+def kept_secs(segments=[], duration_secs=0):
+    return sum([(duration_secs if end is None else end) - start for start, end in segments])
+
+def cut_encode(jobid=None, job=None, gov=None, meter=None, filename=None, segments=[], check=None,
+               supervisor=None):
+    # cut the h264 encode filename to the segments of cut_segments() by a stream copy of the
+    # parts between its keyframes (concat demuxer), filename is only replaced once the cut
+    # succeeded and check, called with the cut file, found no problem (returned None).
+    # Returns the exit code of ffmpeg and its output captured into an OutputBuffer
+    listfile = '%s.cut.txt' % filename
+    cutfile = '%s.cut.mp4' % filename
+    with open(listfile, 'w') as f:
+        for start, end in segments:
+            f.write("file '%s'\ninpoint %.3f\n" % (filename.replace("'", "'\\''"), start))
+            if end is not None:
+                f.write('outpoint %.3f\n' % end)
+    try:
+        returncode, output = run_controlled(jobid, job, gov, meter,
+                                            cache_policy_args() +
+                                            [transcoder, '-nostdin', '-f concat', '-safe 0',
+                                             '-i "%s"' % listfile, '-y', '-map 0', '-c copy',
+                                             '-movflags faststart', '"%s"' % cutfile], supervisor)
+    finally:
+        os.remove(listfile)
+    if returncode == 0 and check is not None:
+        if jobid:
+            job.update({'status':job.RUNNING, 'comment':'Verifying the cut'})
+        error = check(cutfile)
+        if error is not None:
+            output.write('Verification of the cut failed: %s\n' % error)
+            returncode = 1
+    if returncode == 0:
+        os.replace(cutfile, filename)
+    elif os.path.exists(cutfile):
+        os.remove(cutfile)
+    return returncode, output
+
+def clear_cutlist(rec=None):
+    # remove the cut marks of rec once its cutlist was applied to the file
+    for index,mark in reversed(list(enumerate(rec.markup))):
+        if mark.type in (rec.markup.MARK_CUT_START, rec.markup.MARK_CUT_END):
+            del rec.markup[index]
+    rec.cutlist = 0
+    rec.markup.commit()
+
+def recut(db=None, rec=None, jobid=None, job=None, filename=None, chanid=None, starttime=None):
+    # apply the cutlist of a recording transcoded with cut_after_encode, e.g. edited after
+    # the transcode, to its file filename by a stream copy without encoding it again
+    secs, probe = get_duration(db, rec, transcoder, filename)
+    m = re.search(' ([0-9.]+) fps', probe)
+    segments = cut_segments(rec, secs, float(m.group(1)) if m else 0)
+    if segments is None:
+        print('The transcoded recording has no cutlist to apply.')
+        if jobid:
+            job.update({'status':job.FINISHED, 'comment':'Recording already transcoded, no cutlist to apply'})
+        return
+    if not segments:
+        print('The cutlist removes the whole recording, not cutting it.')
         if jobid:
-            job.update({'status':job.ERRORED, 'comment':'Transcoding to mp4 failed'})
-        procqueue.put(CleanExit)
-        os.remove(tmpfile)
+            job.update({'status':job.ERRORED, 'comment':'The cutlist removes the whole recording'})
+        sys.exit(1)
+    if jobid:
+        job.update({'status':job.RUNNING, 'comment':'Cutting the transcoded recording to %d secs in %d parts' \
+                    % (kept_secs(segments, secs), len(segments))})
+    # the recording is only replaced by a cut that passes the verification
+    check = None
+    if verify_windows > 0:
+        check = functools.partial(verify_transcode, duration_secs=kept_secs(segments, secs), probe=probe)
+    try:
+        returncode, output = cut_encode(jobid, job, None, None, filename, segments, check)
+    except JobStopped:
+        stop_job(jobid, job)
+    if returncode != 0:
+        print('Command failed with output:\n%s' % output.text())
+        if jobid:
+            job.update({'status':job.ERRORED, 'comment':failure_comment('Cutting the transcoded recording failed', output)})
+        sys.exit(returncode)
+    clear_cutlist(rec)
+    rec.commflagged = 0
+    rec.filesize = os.path.getsize(filename)
+    rec.seek.clean()
+    rec.update()
+    if build_seektable:
+        rebuild_seektable(jobid, job, chanid, starttime)
+    fix_duration_markup(db, rec, filename)
+    if jobid:
+        job.update({'status':job.FINISHED, 'comment':'Cut the transcoded recording from %d to %d secs' \
+                    % (secs, kept_secs(segments, secs))})
+
+def remove_tmpfiles(tmpfile=None, outfile=None, passlogfile=None):
+    # remove the temporary transcode input, its cutlist map and optionally a partial output
+    # with its side outputs and the separately encoded audio, and the stats of a first pass
+    if passlogfile is not None:
+        remove_first_pass(passlogfile)
+    filenames = [tmpfile, '%s.map' % tmpfile, '%s.audio.mp4' % tmpfile]
+    if outfile is not None:
+        filenames = filenames + [outfile, '%s.mux.mp4' % outfile] \
+                    + [outfile + suffix for suffix in side_output_suffixes()] \
+                    + [rendition_file(outfile, rendition) for rendition in renditions]
+    for filename in filenames:
+        if filename is None:
+            continue
         try:
-            os.remove('%s.map' % tmpfile)
+            os.remove(filename)
         except OSError:
             pass
-        sys.exit(e.retcode)
 
-def wrapper(func, args, res):
-    res.append(func(*args))
+def stream_fingerprint(probe=''):
+    # the properties of the streams of a recording that its encode profile depends on:
+    # video codec, resolution, frame rate and field order and the audio codecs and layouts
+    video = ''
+    m = re.search('Stream #0:[0-9]+.*?: Video: ([a-z0-9_]+).*?([0-9]{2,}x[0-9]{2,}).*? ([0-9.]+) fps', probe)
+    if m:
+        video = '%s %s %s' % (m.group(1), m.group(2), m.group(3))
+        for order in ('top first', 'bottom first', 'progressive'):
+            if order in m.group(0):
+                video = '%s %s' % (video, order)
+    audio = []
+    for m in re.finditer('Stream #0:[0-9]+.*?: Audio: ([a-z0-9_]+)[^,\n]*, [^,\n]*, ([^,\n]*)', probe):
+        audio.append('%s %s' % (m.group(1), m.group(2)))
+    return ' | '.join([video] + audio)
+
+def load_profiles():
+    try:
+        with open(profile_cache) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def update_profiles(update=None):
+    # read-modify-write of the profile cache under an exclusive lock, as concurrent
+    # jobs of this host finish
+    with open('%s.lock' % profile_cache, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        profiles = load_profiles()
+        update(profiles)
+        save_json(profile_cache, profiles)
+
+def save_json(filename=None, data=None):
+    # replace filename atomically with data
+    tmpname = '%s.%d' % (filename, os.getpid())
+    with open(tmpname, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmpname, filename)
+
+def channel_profile(chanid=None, fingerprint=''):
+    # the settings learned for the channel while its streams keep the fingerprint,
+    # with the overrides set from the command line
+    profile = load_profiles().get(str(chanid), {})
+    settings = {}
+    if profile.get('fingerprint') == fingerprint:
+        for key in ('crf_step', 'bitrate_scale', 'rss_scale'):
+            if key in profile:
+                settings[key] = profile[key]
+    elif 'fingerprint' in profile:
+        print('Streams of channel %s changed from "%s" to "%s", forgetting its encode profile.' \
+              % (chanid, profile['fingerprint'], fingerprint))
+    settings.update(profile.get('override', {}))
+    return settings
+
+def learn_profile(chanid=None, fingerprint='', learned={}):
+    def update(profiles):
+        profile = profiles.setdefault(str(chanid), {})
+        if profile.get('fingerprint') != fingerprint:
+            # only the overrides survive a change of the streams
+            override = profile.get('override')
+            profile.clear()
+            if override:
+                profile['override'] = override
+            profile['fingerprint'] = fingerprint
+        jobs = profile.get('jobs', 0)
+        # the compression achieved and the throughput of each preset are averaged over
+        # the last few jobs
+        for key in ('ratio', 'kbps', 'peak_mb', 'rss_scale'):
+            if key in profile and key in learned:
+                learned[key] = 0.75*profile[key] + 0.25*learned[key]
+        if 'fps' in learned:
+            fps = dict(profile.get('fps', {}))
+            for preset, value in learned['fps'].items():
+                fps[preset] = 0.75*fps[preset] + 0.25*value if preset in fps else value
+            learned['fps'] = fps
+        profile.update(learned)
+        profile['jobs'] = jobs + 1
+    try:
+        update_profiles(update)
+    except OSError as e:
+        print('Unable to update the encode profile cache "%s": %s' % (profile_cache, e))
+
+def set_profile(chanid=None, settings=''):
+    # set the overrides KEY=VALUE[,KEY=VALUE...] of the channel, preset, encoder, crf and bitrate (kbps)
+    override = {}
+    for setting in settings.split(','):
+        key, sep, value = setting.partition('=')
+        if key not in ('preset', 'encoder', 'crf', 'bitrate') or not value:
+            print('Unknown profile setting "%s", use preset=, encoder=, crf= or bitrate=' % setting)
+            sys.exit(1)
+        if key == 'encoder' and value not in ENCODERS:
+            print('Unknown encoder "%s", use one of %s' % (value, ', '.join(sorted(ENCODERS))))
+            sys.exit(1)
+        try:
+            override[key] = value if key in ('preset', 'encoder') else int(value)
+        except ValueError:
+            print('Profile setting "%s" needs a whole number, e.g. %s=23' % (setting, key))
+            sys.exit(1)
+    def update(profiles):
+        profiles.setdefault(str(chanid), {}).setdefault('override', {}).update(override)
+    update_profiles(update)
+
+def clear_profile(chanid=None):
+    update_profiles(lambda profiles: profiles.pop(str(chanid), None))
+
+def print_profiles():
+    print('%6s %4s %6s %6s %6s %6s %6s  %-24s %-20s %s' % ('chanid', 'jobs', 'crf+', 'rate*', 'ratio', 'kbps',
+                                                           'MB', 'override', 'fps', 'fingerprint'))
+    profiles = load_profiles()
+    for chanid in sorted(profiles, key=int):
+        p = profiles[chanid]
+        print('%6s %4d %6s %6s %5d%% %6d %6s  %-24s %-20s %s' \
+              % (chanid, p.get('jobs', 0), p.get('crf_step', ''),
+                 '%.2f' % p['bitrate_scale'] if 'bitrate_scale' in p else '',
+                 int(p.get('ratio', 0)*100), p.get('kbps', 0),
+                 '%d' % p['peak_mb'] if 'peak_mb' in p else '',
+                 ','.join(['%s=%s' % item for item in sorted(p.get('override', {}).items())]),
+                 ','.join(['%s:%d' % item for item in sorted(p.get('fps', {}).items())]),
+                 p.get('fingerprint', '')))
+
+def audit(db=None, repair=False, jobs=1):
+    # Compare the filesize, duration markup and seektable of every transcoded recording
+    # with its file, as transcodes by older versions of this script or interrupted runs
+    # can leave them wrong. The recordings and their markup come from grouped queries,
+    # the files are probed by up to jobs concurrent ffmpeg processes and files whose size
+    # and modification time are unchanged since the last audit are not probed again.
+    # With repair the filesizes and duration markups are corrected in bulk.
+    with db as cursor:
+        cursor.execute("""SELECT chanid, starttime, basename, storagegroup, filesize
+                          FROM recorded WHERE transcoded = 1""")
+        recordings = cursor.fetchall()
+        cursor.execute("""SELECT chanid, starttime, data FROM recordedmarkup WHERE type = 33""")
+        durations = dict(((chanid, start), data) for chanid, start, data in cursor.fetchall())
+        cursor.execute("""SELECT DISTINCT chanid, starttime FROM recordedseek""")
+        seektables = set(cursor.fetchall())
+        cursor.execute("""SELECT DISTINCT groupname, dirname FROM storagegroup""")
+        dirnames = cursor.fetchall()
+
+    # the files of every storage group, listed once instead of searched per recording
+    files = {}
+    for groupname, dirname in dirnames:
+        for remote, local in storage_path_map.items():
+            if dirname.rstrip('/') == remote.rstrip('/'):
+                dirname = local
+        try:
+            for basename in os.listdir(dirname):
+                files.setdefault((groupname, basename), os.path.join(dirname, basename))
+        except OSError:
+            pass
+
+    cache = {}
+    if audit_cache:
+        try:
+            with open(audit_cache) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+    found = []
+    missing = 0
+    for chanid, start, basename, storagegroup, filesize in recordings:
+        filename = files.get((storagegroup, basename))
+        if filename is None:
+            print('%6d %s: file "%s" not found' % (chanid, start, basename))
+            missing = missing + 1
+            continue
+        try:
+            st = os.stat(filename)
+        except OSError:
+            missing = missing + 1
+            continue
+        found.append((chanid, start, filename, filesize, st.st_size, st.st_mtime))
+
+    def probe(filename):
+        return get_duration(db, None, transcoder, filename)[0]
+    # only new and changed files are probed, in parallel
+    stale = [f for f in found if cache.get(f[2], {}).get('size') != f[4]
+                                 or cache.get(f[2], {}).get('mtime') != f[5]]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for (chanid, start, filename, filesize, size, mtime), secs in \
+                zip(stale, pool.map(probe, [f[2] for f in stale])):
+            cache[filename] = {'size':size, 'mtime':mtime, 'duration':secs}
+
+    size_fixes = []
+    duration_fixes = []
+    duration_marks = []
+    no_seektable = []
+    for chanid, start, filename, filesize, size, mtime in found:
+        if size != filesize:
+            print('%6d %s: filesize %d in the database, %d on disk' % (chanid, start, filesize, size))
+            size_fixes.append((size, chanid, start))
+        secs = cache[filename]['duration']
+        if secs > 0:
+            msecs = int(1000*secs)
+            mark = durations.get((chanid, start))
+            if mark is None:
+                print('%6d %s: no duration markup, %d msecs probed' % (chanid, start, msecs))
+                duration_marks.append((chanid, start, msecs))
+            elif abs(mark - msecs) > 1000*AUDIT_DURATION_TOLERANCE:
+                print('%6d %s: duration markup %d msecs, %d msecs probed' % (chanid, start, mark, msecs))
+                duration_fixes.append((msecs, chanid, start))
+        else:
+            print('%6d %s: unable to probe the duration of "%s"' % (chanid, start, filename))
+        if (chanid, start) not in seektables:
+            no_seektable.append((chanid, start))
+
+    if audit_cache:
+        # files of deleted recordings are dropped from the cache
+        save_json(audit_cache, dict((f[2], cache[f[2]]) for f in found))
+    print('Audited %d recordings, probed %d: %d missing files, %d wrong filesizes, '
+          '%d wrong and %d missing durations, %d without seektable' \
+          % (len(recordings), len(stale), missing, len(size_fixes), len(duration_fixes),
+             len(duration_marks), len(no_seektable)))
+    if not repair:
+        return
+    with db as cursor:
+        cursor.executemany("""UPDATE recorded SET filesize = %s
+                              WHERE chanid = %s AND starttime = %s""", size_fixes)
+        cursor.executemany("""UPDATE recordedmarkup SET data = %s
+                              WHERE chanid = %s AND starttime = %s AND type = 33""", duration_fixes)
+        cursor.executemany("""INSERT INTO recordedmarkup (chanid, starttime, mark, type, data)
+                              VALUES (%s, %s, 0, 33, %s)""", duration_marks)
+    print('Corrected %d filesizes and %d durations' % (len(size_fixes), len(duration_fixes) + len(duration_marks)))
+    if build_seektable:
+        for chanid, start in no_seektable:
+            task = System(path='mythcommflag')
+            task.command('--chanid %s' % chanid,
+                         '--starttime %s' % start.strftime('%Y%m%d%H%M%S'),
+                         '--rebuild',
+                         '2> /dev/null')
+
+def prioritize(db=None, policy='reclaim'):
+    # Rank the recordings that are not transcoded yet. All inputs come from three grouped
+    # or joined queries (recordings with their resolution, the bytes per second the
+    # transcoded recordings of each channel achieved and the last playback activity of
+    # each title) so the ranking stays cheap for libraries of tens of thousands of
+    # recordings. Returns a list of dicts in transcode order.
+    with db as cursor:
+        # output bytes per second of recording achieved on each channel so far
+        cursor.execute("""SELECT chanid, SUM(filesize),
+                                 SUM(TIMESTAMPDIFF(SECOND, starttime, endtime))
+                          FROM recorded
+                          WHERE transcoded = 1 AND basename LIKE '%%.mp4'
+                          GROUP BY chanid""")
+        channel_rate = {}
+        for chanid, size, secs in cursor.fetchall():
+            if secs:
+                channel_rate[chanid] = float(size)/float(secs)
+        # titles being watched are the ones with the latest bookmark updates
+        cursor.execute("""SELECT title, MAX(bookmarkupdate) FROM recorded
+                          WHERE bookmarkupdate IS NOT NULL GROUP BY title""")
+        title_activity = dict((title, last) for title, last in cursor.fetchall() if last)
+        cursor.execute("""SELECT r.chanid, r.starttime, r.endtime, r.title, r.filesize,
+                                 r.commflagged, r.watched, f.height
+                          FROM recorded r
+                          LEFT JOIN recordedfile f ON f.recordedid = r.recordedid
+                          WHERE r.transcoded = 0 AND r.basename NOT LIKE '%%.mp4'
+                            AND r.recgroup NOT IN ('LiveTV', 'Deleted')
+                            AND r.endtime < UTC_TIMESTAMP() AND r.filesize > 0""")
+        rows = cursor.fetchall()
+
+    candidates = []
+    for chanid, start, end, title, size, commflagged, watched, height in rows:
+        secs = max(1, (end - start).total_seconds())
+        if height:
+            hd = height >= 720
+        else:
+            # no stream information, mpeg2 above 10Mbps is HD
+            hd = size*8/secs > 10000000
+        if chanid in channel_rate:
+            out_size = min(size, channel_rate[chanid]*secs)
+        else:
+            out_size = compressionRatio*size
+        cpu_secs = secs*(encode_cost_HD if hd else encode_cost_nonHD)
+        if not commflagged and (require_commflagged or generate_commcutlist):
+            cpu_secs += secs*commflag_cost
+        reclaim = size - out_size
+        candidates.append({'chanid':chanid, 'starttime':start, 'title':title,
+                           'filesize':size, 'hd':hd, 'watched':watched,
+                           'reclaim':reclaim, 'cpu_secs':cpu_secs,
+                           'score':reclaim*3600/cpu_secs})
+
+    if policy == 'oldest':
+        candidates.sort(key=lambda c: c['starttime'])
+    elif policy == 'shortest':
+        candidates.sort(key=lambda c: c['cpu_secs'])
+    elif policy == 'watchsoon':
+        # unwatched episodes of the most recently watched titles first,
+        # the oldest episode of a title is the one played next
+        def watchsoon_key(c):
+            activity = title_activity.get(c['title'])
+            return (c['watched'], activity is None,
+                    -activity.timestamp() if activity else 0, c['starttime'])
+        candidates.sort(key=watchsoon_key)
+    else:
+        candidates.sort(key=lambda c: c['score'], reverse=True)
+    return candidates
+
+def print_prioritized(candidates=[]):
+    # the ranking with the time each recording is projected to be transcoded by
+    done = project_backlog(candidates)
+    print('%5s %10s %9s %8s %6s  %-19s %-16s %s' % ('rank', 'MB/cpu-h', 'reclaimMB', 'cpu-min',
+                                                    'chanid', 'starttime (UTC)', 'done by', 'title'))
+    for rank, c in enumerate(candidates, 1):
+        print('%5d %10.0f %9.0f %8.0f %6d  %-19s %-16s %s' % (rank, c['score']/(1024*1024),
+              c['reclaim']/(1024*1024), c['cpu_secs']/60, c['chanid'],
+              c['starttime'].strftime('%Y-%m-%d %H:%M:%S'),
+              time.strftime('%a %m-%d %H:%M', time.localtime(done[rank - 1])), c['title']))
+    if candidates:
+        print('Backlog of %d recordings (%d cpu-hours on %d cpus) clears by %s%s.' \
+              % (len(candidates), sum([c['cpu_secs'] for c in candidates])/3600, os.cpu_count() or 1,
+                 time.strftime('%a %Y-%m-%d %H:%M', time.localtime(done[-1])),
+                 ' in the transcode windows' if transcode_windows else ''))
+
+def transcode_prioritized(candidates=[], supervisor=None):
+    # transcode the ranked recordings in order, a failed recording does not stop the backlog.
+    # With a supervisor the recordings are started in order as its threads become free.
+    calls = []
+    for c in candidates:
+        starttime = c['starttime'].strftime('%Y%m%d%H%M%S+0000')
+        print('Transcoding chanid %d starttime %s "%s"' % (c['chanid'], starttime, c['title']))
+        call = functools.partial(runjob, chanid=c['chanid'], starttime=starttime, tzoffset=0,
+                                 supervisor=supervisor)
+        if supervisor is not None:
+            calls.append(call)
+            continue
+        try:
+            call()
+        except SystemExit as e:
+            print('Transcode of chanid %d starttime %s failed (%s)' % (c['chanid'], starttime, e.code))
+        except Exception as e:
+            print('Transcode of chanid %d starttime %s failed (%s: %s)' % (c['chanid'], starttime, type(e).__name__, e))
+    if supervisor is not None:
+        supervisor.run(calls)
+
+class Inotify:
+    # Minimal linux inotify binding through libc, read_events() blocks until files
+    # in the watched directories are closed so no directory polling is needed.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_CLOSE_NOWRITE = 0x00000010
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+
+    def add_watch(self, dirname=None, mask=IN_CLOSE_WRITE):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirname), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for %s' % dirname)
+        self.dirs[wd] = dirname
+
+    def read_events(self, timeout=None):
+        # returns a list of (dirname, filename, mask) for the events read, empty
+        # once timeout secs passed without events
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        buf = os.read(self.fd, 64*1024)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = Inotify.EVENT_HEADER.unpack_from(buf, offset)
+            offset += Inotify.EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self.dirs and name:
+                events.append((self.dirs[wd], os.fsdecode(name), mask))
+        return events
+
+def recording_dirs(db=None):
+    # directories of the recording storage groups of this host
+    if watch_dirs:
+        return list(watch_dirs)
+    with db as cursor:
+        cursor.execute("""SELECT DISTINCT dirname FROM storagegroup
+                          WHERE hostname = %s
+                            AND groupname NOT IN ('Videos', 'Trailers', 'Coverart', 'Fanart',
+                                                  'Banners', 'Screenshots', 'DB Backups',
+                                                  'Music', 'MusicArt')""", (db.gethostname(),))
+        return [row[0] for row in cursor.fetchall() if os.path.isdir(row[0])]
+
+def claim_recording(db=None, basename=None):
+    # Queue the transcode user job (or the shared work queue entry if queue_dir is set)
+    # for the recording stored as basename once it is finished, not transcoded and
+    # commercial flagging is done or not pending. The check and the insert hold a
+    # database lock so that of several watchers only one queues the job. Returns True
+    # when this call queued the recording, None when the recording is not finished or
+    # flagged yet and False when it is not to be queued.
+    jobtype = 0x100 << (watch_userjob - 1)
+    with db as cursor:
+        cursor.execute("""SELECT chanid, starttime, commflagged, endtime > UTC_TIMESTAMP() FROM recorded
+                          WHERE basename = %s AND transcoded = 0""", (basename,))
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        chanid, starttime, commflagged, recording = row
+        if recording:
+            return None
+        # commflagged 2 => flagging in progress, also wait for queued/running flagging jobs
+        cursor.execute("""SELECT COUNT(*) FROM jobqueue
+                          WHERE chanid = %s AND starttime = %s AND type = 2
+                            AND status < 256""", (chanid, starttime))
+        if commflagged == 2 or cursor.fetchone()[0] > 0:
+            if debug:
+                print('Waiting for commercial flagging of "%s"' % basename)
+            return None
+        if require_commflagged and commflagged == 0:
+            return None
+        if queue_dir:
+            # creating the queue entry is atomic, no database lock needed
+            return enqueue(chanid, starttime)
+        cursor.execute("SELECT GET_LOCK('transcode-h264-claim', 30)")
+        if not cursor.fetchone()[0]:
+            return None
+        try:
+            cursor.execute("""SELECT COUNT(*) FROM jobqueue
+                              WHERE chanid = %s AND starttime = %s AND type = %s""",
+                           (chanid, starttime, jobtype))
+            if cursor.fetchone()[0] > 0:
+                return False
+            cursor.execute("""INSERT INTO jobqueue (chanid, starttime, inserttime, type, cmds,
+                                                    flags, status, statustime, hostname, args,
+                                                    comment, schedruntime)
+                              VALUES (%s, %s, NOW(), %s, 0, 0, 1, NOW(), '', '',
+                                      'Queued by transcode-h264 watcher', NOW())""",
+                           (chanid, starttime, jobtype))
+            return True
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('transcode-h264-claim')")
+
+def server_time(dirname=None):
+    # current time of the file server holding dirname, lease ages are measured
+    # against it so that the clocks of the worker hosts do not matter
+    probe = os.path.join(dirname, '.clock-%s-%d-%d' % (socket.gethostname(), os.getpid(),
+                                                      threading.get_ident()))
+    with open(probe, 'w'):
+        pass
+    now = os.path.getmtime(probe)
+    os.remove(probe)
+    return now
+
+class Lease:
+    # Lease on one recording of the shared work queue. The queued recording is the
+    # file <name>.job in queue_dir and its leases are the files <name>.job.lease.<N>.
+    # Leases are created with O_EXCL so that of several workers only one gets each
+    # generation N, the holder of the highest generation owns the recording and
+    # touches its lease every LEASE_HEARTBEAT secs. A lease that has not been
+    # touched for LEASE_TIMEOUT secs is stale and taken over by creating the next
+    # generation, the former holder then loses the lease.
+    def __init__(self, jobfile=None):
+        self.jobfile = jobfile
+        self.path = None
+        self.generation = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def generations(self):
+        gens = []
+        for path in glob('%s.lease.*' % self.jobfile):
+            try:
+                gens.append(int(path.rsplit('.', 1)[1]))
+            except ValueError:
+                pass
+        return gens
+
+    def acquire(self):
+        gens = self.generations()
+        if gens:
+            try:
+                age = server_time(os.path.dirname(self.jobfile)) \
+                      - os.path.getmtime('%s.lease.%d' % (self.jobfile, max(gens)))
+            except OSError:
+                return False
+            if age < LEASE_TIMEOUT:
+                return False
+            if debug:
+                print('Taking over stale lease of "%s" (%d secs old)' % (self.jobfile, age))
+        generation = max(gens) + 1 if gens else 1
+        path = '%s.lease.%d' % (self.jobfile, generation)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError:
+            return False
+        os.write(fd, ('%s %d\n' % (socket.gethostname(), os.getpid())).encode())
+        os.close(fd)
+        if not os.path.exists(self.jobfile):
+            # the recording was finished meanwhile
+            os.remove(path)
+            return False
+        self.path = path
+        self.generation = generation
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+        return True
+
+    def heartbeat(self):
+        while not self.stopped.wait(LEASE_HEARTBEAT):
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def held(self):
+        return self.path is not None and os.path.exists(self.path) \
+               and max(self.generations()) == self.generation
+
+    def attempts(self):
+        # failed attempts to transcode the recording so far
+        try:
+            with open(self.jobfile) as f:
+                fields = f.read().split()
+        except OSError:
+            return 0
+        return int(fields[2]) if len(fields) > 2 else 0
+
+    def release(self, outcome='done'):
+        # outcome 'done' removes the recording from the queue, 'failed' keeps it as
+        # <name>.failed and 'retry' counts the attempt and leaves it queued for another
+        # worker, behind the recordings queued meanwhile
+        self.stopped.set()
+        if not self.held():
+            return
+        if outcome == 'done':
+            os.remove(self.jobfile)
+        elif outcome == 'failed':
+            os.rename(self.jobfile, '%s.failed' % self.jobfile.rsplit('.', 1)[0])
+        elif outcome == 'retry':
+            with open(self.jobfile) as f:
+                chanid, starttime = f.read().split()[:2]
+            with open('%s.tmp' % self.jobfile, 'w') as f:
+                f.write('%s %s %d\n' % (chanid, starttime, self.attempts() + 1))
+            os.replace('%s.tmp' % self.jobfile, self.jobfile)
+        for generation in self.generations():
+            try:
+                os.remove('%s.lease.%d' % (self.jobfile, generation))
+            except OSError:
+                pass
+        self.path = None
+
+def enqueue(chanid=None, starttime=None):
+    # put a recording into the shared work queue, returns False if it is queued already
+    # or left the queue as failed
+    name = '%d_%s' % (chanid, starttime.strftime('%Y%m%d%H%M%S'))
+    if os.path.exists(os.path.join(queue_dir, '%s.failed' % name)) \
+       or os.path.exists(os.path.join(queue_dir, '%s.done' % name)):
+        return False
+    try:
+        fd = os.open(os.path.join(queue_dir, '%s.job' % name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    os.write(fd, ('%d %s\n' % (chanid, starttime.strftime('%Y%m%d%H%M%S'))).encode())
+    os.close(fd)
+    return True
+
+def work(drain=False, run=None):
+    # Worker of the shared work queue: transcodes the queued recordings, oldest first,
+    # whose lease it gets. With drain the worker exits once no queued recording can be
+    # leased, otherwise it waits POLL_INTERVAL secs for new work.
+    if run is None:
+        run = runjob
+    while True:
+        if transcode_windows:
+            wait_for_window()
+        jobfiles = []
+        for jobfile in glob(os.path.join(queue_dir, '*.job')):
+            try:
+                jobfiles.append((os.path.getmtime(jobfile), jobfile))
+            except OSError:
+                pass
+        lease = None
+        for mtime, jobfile in sorted(jobfiles):
+            lease = Lease(jobfile)
+            if lease.acquire():
+                break
+            lease = None
+        if lease is None:
+            if drain:
+                return
+            time.sleep(POLL_INTERVAL)
+            continue
+        with open(lease.jobfile) as f:
+            chanid, starttime = f.read().split()[:2]
+        print('Worker %s-%d transcoding chanid %s starttime %s' % (socket.gethostname(), os.getpid(),
+                                                                  chanid, starttime))
+        try:
+            run(chanid=int(chanid), starttime='%s+0000' % starttime, tzoffset=0, lease=lease)
+            lease.release('done')
+        except SystemExit as e:
+            if e.code:
+                attempts = lease.attempts() + 1
+                print('Transcode of chanid %s starttime %s failed (%s), attempt %d of %d' \
+                      % (chanid, starttime, e.code, attempts, MAX_ATTEMPTS))
+                lease.release('failed' if attempts >= MAX_ATTEMPTS else 'retry')
+            else:
+                # stopped by the user
+                lease.release('done')
+        except Exception as e:
+            # keep working on the other recordings, a recording that keeps failing
+            # leaves the queue after MAX_ATTEMPTS
+            attempts = lease.attempts() + 1
+            print('Transcode of chanid %s starttime %s failed (%s: %s), attempt %d of %d' \
+                  % (chanid, starttime, type(e).__name__, e, attempts, MAX_ATTEMPTS))
+            lease.release('failed' if attempts >= MAX_ATTEMPTS else 'retry')
+
+def rescan_candidates(dirnames=[]):
+    # (dirname, filename) of the recordings in dirnames changed in the last watch_rescan_hours
+    candidates = []
+    since = time.time() - watch_rescan_hours*3600
+    for dirname in dirnames:
+        try:
+            filenames = os.listdir(dirname)
+        except OSError:
+            continue
+        for filename in filenames:
+            if not filename.endswith(watch_extensions):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(dirname, filename)) >= since:
+                    candidates.append((dirname, filename))
+            except OSError:
+                pass
+    return candidates
+
+def watch(db=None):
+    # Queue recordings for transcoding as they complete. A recording is looked up in
+    # the database whenever its file is closed: the recorder closing it at the end of
+    # the recording, or mythcommflag closing it once flagging is done. The directories
+    # are scanned once at startup, a recording the database does not show finished or
+    # flagged yet when its file is closed is checked again on its own, see watch_retry.
+    inotify = Inotify()
+    dirnames = recording_dirs(db)
+    for dirname in dirnames:
+        if debug:
+            print('Watching "%s"' % dirname)
+        inotify.add_watch(dirname, Inotify.IN_CLOSE_WRITE | Inotify.IN_CLOSE_NOWRITE)
+    claimed = set()
+    # filename => [dirname, time of the next check, secs to the check after it, time of the first check]
+    pending = {}
+    candidates = rescan_candidates(dirnames)
+    while True:
+        for dirname, filename in candidates:
+            if not filename.endswith(watch_extensions) or filename in claimed:
+                continue
+            try:
+                queued = claim_recording(db, filename)
+            except MythError as e:
+                print('Unable to queue transcode of "%s": %s' % (filename, e))
+                queued = None
+            if queued:
+                print('Queued transcode of "%s"' % os.path.join(dirname, filename))
+                claimed.add(filename)
+            if queued is not None:
+                pending.pop(filename, None)
+                continue
+            now = time.time()
+            retry = pending.setdefault(filename, [dirname, now, watch_retry/2.0, now])
+            if now - retry[3] >= watch_rescan_hours*3600:
+                if debug:
+                    print('Giving up on "%s"' % filename)
+                del pending[filename]
+                continue
+            retry[2] = min(2*retry[2], watch_retry_max)
+            retry[1] = now + retry[2]
+        timeout = max(0, min([retry[1] for retry in pending.values()]) - time.time()) if pending else None
+        candidates = []
+        for dirname, filename, mask in inotify.read_events(timeout):
+            if (dirname, filename) not in candidates:
+                candidates.append((dirname, filename))
+        now = time.time()
+        for filename, retry in pending.items():
+            if retry[1] <= now and (retry[0], filename) not in candidates:
+                candidates.append((retry[0], filename))
 
 def main():
     parser = OptionParser(usage="usage: %prog [options] [jobid]")
@@ -666,10 +3788,43 @@ def main():
             help='Use starttime with both chanid and tzoffset for manual operation')
     parser.add_option('--tzoffset', action='store', type='int', dest='tzoffset',
             help='Use tzoffset with both chanid and starttime for manual operation')
+    parser.add_option('--prioritize', action='store_true', dest='prioritize', default=False,
+            help='Rank the recordings that are not transcoded yet')
+    parser.add_option('--policy', action='store', type='choice', dest='policy',
+            choices=['reclaim', 'oldest', 'shortest', 'watchsoon'], default=prioritize_policy,
+            help='Ranking policy for --prioritize: reclaim, oldest, shortest or watchsoon')
+    parser.add_option('--limit', action='store', type='int', dest='limit', default=0,
+            help='Only use the first LIMIT recordings of the --prioritize ranking')
+    parser.add_option('--transcode', action='store_true', dest='transcode', default=False,
+            help='Transcode the recordings ranked by --prioritize in order')
+    parser.add_option('--enqueue', action='store_true', dest='enqueue', default=False,
+            help='Put the recordings ranked by --prioritize into the shared work queue')
+    parser.add_option('--worker', action='store_true', dest='worker', default=False,
+            help='Transcode recordings from the shared work queue')
+    parser.add_option('--drain', action='store_true', dest='drain', default=False,
+            help='Exit the --worker once no queued recording is left to lease')
+    parser.add_option('--jobs', action='store', type='int', dest='jobs', default=1,
+            help='Number of transcodes run concurrently for several jobids, --transcode and --worker')
+    parser.add_option('--watch', action='store_true', dest='watch', default=False,
+            help='Queue a transcode user job for every recording once it is finished and flagged')
+    parser.add_option('--audit', action='store_true', dest='audit', default=False,
+            help='Check filesize, duration and seektable of the transcoded recordings, probing --jobs files at once')
+    parser.add_option('--repair', action='store_true', dest='repair', default=False,
+            help='Correct the problems found by --audit')
+    parser.add_option('--profiles', action='store_true', dest='profiles', default=False,
+            help='Show the encode profiles learned for the channels')
+    parser.add_option('--set-profile', action='store', type='string', dest='set_profile',
+            help='Override the encode profile of --chanid, e.g. crf=23,preset=medium, bitrate=4000 '
+                 'or encoder=libx265')
+    parser.add_option('--clear-profile', action='store_true', dest='clear_profile', default=False,
+            help='Forget the encode profile and overrides of --chanid')
     parser.add_option('-v', '--verbose', action='store', type='string', dest='verbose',
             help='Verbosity level')
 
     opts, args = parser.parse_args()
+    supervisor = None
+    if opts.jobs > 1 or len(args) > 1:
+        supervisor = Supervisor(max(1, opts.jobs))
 
     if opts.verbose:
         if opts.verbose == 'help':
@@ -677,7 +3832,45 @@ def main():
             sys.exit(0)
         MythLog._setlevel(opts.verbose)
 
-    if len(args) == 1:
+    if (opts.profiles or opts.set_profile or opts.clear_profile) and not profile_cache:
+        print('Encode profiles require profile_cache to be set.')
+        sys.exit(1)
+    if (opts.set_profile or opts.clear_profile) and not opts.chanid:
+        print('--set-profile and --clear-profile require --chanid.')
+        sys.exit(1)
+    if (opts.enqueue or opts.worker) and not queue_dir:
+        print('The shared work queue requires queue_dir to be set.')
+        sys.exit(1)
+    if opts.set_profile or opts.clear_profile:
+        if opts.clear_profile:
+            clear_profile(opts.chanid)
+        if opts.set_profile:
+            set_profile(opts.chanid, opts.set_profile)
+        print_profiles()
+    elif opts.profiles:
+        print_profiles()
+    elif opts.audit:
+        audit(MythDB(), opts.repair, opts.jobs)
+    elif opts.worker and supervisor is not None:
+        supervisor.run([functools.partial(work, opts.drain,
+                                          functools.partial(runjob, supervisor=supervisor))] * opts.jobs)
+    elif opts.worker:
+        work(opts.drain)
+    elif opts.watch:
+        watch(MythDB())
+    elif opts.prioritize:
+        candidates = prioritize(MythDB(), opts.policy)
+        if opts.limit > 0:
+            candidates = candidates[:opts.limit]
+        print_prioritized(candidates)
+        if opts.enqueue:
+            for c in candidates:
+                enqueue(c['chanid'], c['starttime'])
+        elif opts.transcode:
+            transcode_prioritized(candidates, supervisor)
+    elif len(args) > 0 and supervisor is not None:
+        supervisor.run([functools.partial(runjob, jobid=jobid, supervisor=supervisor) for jobid in args])
+    elif len(args) == 1:
         runjob(jobid=args[0])
     elif opts.chanid and opts.starttime and opts.tzoffset is not None:
         runjob(chanid=opts.chanid, starttime=opts.starttime, tzoffset=opts.tzoffset)